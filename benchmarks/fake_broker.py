@@ -0,0 +1,266 @@
+"""In-process stand-in for the MQTT broker and paho client used by the benchmarks.
+
+Only the part of the paho-mqtt 1.6 client API that python2wb uses is implemented.
+Messages are queued and delivered when the network loop of the client runs,
+QoS 1/2 publishes are acknowledged on the next loop iteration.
+"""
+
+import collections
+import threading
+import time
+
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+def topic_matches_sub(sub, topic):
+    sub_levels = sub.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+class FakeMessage:
+    __slots__ = ("topic", "payload", "qos", "retain", "mid")
+
+    def __init__(self, topic, payload, retain=False, qos=0):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.qos = qos
+        self.mid = 0
+
+
+class FakeMessageInfo:
+    def __init__(self, mid, rc=MQTT_ERR_SUCCESS):
+        self.mid = mid
+        self.rc = rc
+        self._published = threading.Event()
+
+    def is_published(self):
+        return self._published.is_set()
+
+    def wait_for_publish(self, timeout=None):
+        self._published.wait(timeout)
+
+
+class FakeBroker:
+    """Broker with retained storage. Routes publishes to the subscribed clients."""
+
+    def __init__(self):
+        self.retained = {}
+        self.clients = []
+        self.published = 0
+        self._lock = threading.RLock()
+
+    def client_factory(self):
+        """Callable that replaces paho.mqtt.client.Client"""
+
+        broker = self
+
+        def factory(*args, **kwargs):
+            return FakeClient(broker, *args, **kwargs)
+
+        return factory
+
+    def publish(self, topic, payload, retain):
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            for client in self.clients:
+                if client.is_subscribed(topic):
+                    client.enqueue(FakeMessage(topic, payload))
+
+    def inject(self, topic, payload, retain=False):
+        """Publish from a foreign client, e.g. wb-mqtt-serial"""
+
+        if type(payload) == str:
+            payload = payload.encode()
+        self.publish(topic, payload, retain)
+
+
+class FakeClient:
+    def __init__(self, broker, client_id="", *args, **kwargs):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_socket_open = None
+        self.on_socket_close = None
+        self.on_socket_register_write = None
+        self.on_socket_unregister_write = None
+        self.subscriptions = set()
+        self.connected = False
+        self._mid = 0
+        self._inbox = collections.deque()
+        self._unacked = []
+        self._thread = None
+        self._running = False
+        self._lock = threading.RLock()
+
+    # Connection
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def max_queued_messages_set(self, queue_size):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60, *args, **kwargs):
+        with self.broker._lock:
+            if self not in self.broker.clients:
+                self.broker.clients.append(self)
+        self._inbox.append(("connack", 0))
+        return MQTT_ERR_SUCCESS
+
+    def connect_async(self, host, port=1883, keepalive=60, *args, **kwargs):
+        return MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        return self.connect(None)
+
+    def disconnect(self, *args, **kwargs):
+        with self.broker._lock:
+            if self in self.broker.clients:
+                self.broker.clients.remove(self)
+        was_connected = self.connected
+        self.connected = False
+        self.subscriptions.clear()
+        if was_connected and self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+        return MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self.connected
+
+    # Subscriptions
+    def is_subscribed(self, topic):
+        for sub in self.subscriptions:
+            if topic_matches_sub(sub, topic):
+                return True
+        return False
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        topics = [topic] if type(topic) == str else [item[0] for item in topic]
+        self._mid += 1
+        with self.broker._lock:
+            for sub in topics:
+                self.subscriptions.add(sub)
+                for retained_topic, payload in list(self.broker.retained.items()):
+                    if topic_matches_sub(sub, retained_topic):
+                        self._inbox.append(FakeMessage(retained_topic, payload, True))
+        return MQTT_ERR_SUCCESS, self._mid
+
+    def unsubscribe(self, topic, *args, **kwargs):
+        topics = [topic] if type(topic) == str else list(topic)
+        for sub in topics:
+            self.subscriptions.discard(sub)
+        self._mid += 1
+        return MQTT_ERR_SUCCESS, self._mid
+
+    def message_callback_add(self, sub, callback):
+        raise NotImplementedError("python2wb routes messages itself")
+
+    def message_callback_remove(self, sub):
+        raise NotImplementedError("python2wb routes messages itself")
+
+    # Publishing
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with self._lock:
+            self._mid += 1
+            info = FakeMessageInfo(self._mid)
+
+        if payload is None:
+            payload = b""
+        elif type(payload) in (int, float):
+            payload = str(payload).encode()
+        elif type(payload) == str:
+            payload = payload.encode()
+
+        self.broker.publish(topic, payload, retain)
+        if qos:
+            with self._lock:
+                self._unacked.append(info)
+        else:
+            info._published.set()
+        return info
+
+    # Network loop
+    def enqueue(self, message):
+        self._inbox.append(message)
+
+    def deliver(self, message):
+        """Deliver a message straight to on_message, bypassing the queue"""
+
+        self.on_message(self, None, message)
+
+    def loop(self, timeout=1.0, max_packets=1):
+        with self._lock:
+            unacked = self._unacked
+            self._unacked = []
+        for info in unacked:
+            info._published.set()
+            if self.on_publish:
+                self.on_publish(self, None, info.mid)
+
+        inbox = self._inbox
+        while inbox:
+            item = inbox.popleft()
+            if type(item) == tuple:
+                self.connected = True
+                if self.on_connect:
+                    self.on_connect(self, None, {}, item[1])
+            elif self.on_message:
+                self.on_message(self, None, item)
+        return MQTT_ERR_SUCCESS
+
+    def loop_forever(self, *args, **kwargs):
+        self._running = True
+        while self._running:
+            self.loop()
+            time.sleep(0.001)
+
+    def loop_start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.loop_forever, daemon=True)
+        self._thread.start()
+
+    def loop_stop(self, force=False):
+        self._running = False
+        thread = self._thread
+        self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def loop_read(self, max_packets=1):
+        return self.loop()
+
+    def loop_write(self, max_packets=1):
+        return MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        return MQTT_ERR_SUCCESS
+
+    def want_write(self):
+        return False
+
+    def socket(self):
+        return None
@@ -0,0 +1,418 @@
+"""Benchmarks of the python2wb hot paths against an in-process fake broker.
+
+Usage:
+    python -m benchmarks.run                      # JSON report to stdout
+    python -m benchmarks.run -o result.json       # JSON report to a file
+    python -m benchmarks.run --baseline old.json  # exit code 1 on a regression
+
+The synthetic topic tree mimics wb-mqtt-serial: every device is polled with its own
+period and publishes all of its controls on every poll, part of the values change.
+The trace is replayed as fast as possible, so messages/sec is the headroom
+over trace_rate, the message rate the same installation produces in real time.
+"""
+
+import argparse
+import atexit
+import contextlib
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+import python2wb.mqtt
+from python2wb.cache import parse_value
+from python2wb.mqtt import WbMqtt
+
+from .fake_broker import FakeBroker, FakeMessage
+
+REPORT_VERSION = 1
+
+# Poll periods of the devices in seconds and their shares
+POLL_PERIODS = ((0.1, 1), (0.5, 2), (1.0, 4), (5.0, 3))
+
+# Control types of a device, values are generated according to the type
+CONTROL_TYPES = ("temperature", "value", "switch", "voltage", "text")
+
+# Metrics compared with the baseline: higher is better and lower is better
+HIGHER_IS_BETTER = ("_per_sec",)
+LOWER_IS_BETTER = ("_us", "_seconds", "_bytes")
+
+
+def control_type(index):
+    return CONTROL_TYPES[index % len(CONTROL_TYPES)]
+
+
+def control_value(kind, rnd):
+    if kind == "switch":
+        return str(rnd.randint(0, 1))
+    if kind == "text":
+        return rnd.choice(("ok", "warning", "error"))
+    if kind == "value":
+        return str(rnd.randint(0, 1000))
+    return "%.2f" % rnd.uniform(0, 250)
+
+
+def topic_tree(devices, controls):
+    """Control topics of the synthetic installation
+
+    Returns:
+        list: Tuples (device_id, control_id, type)
+    """
+
+    return [
+        ("device%d" % d, "control%d" % c, control_type(c))
+        for d in range(devices)
+        for c in range(controls)
+    ]
+
+
+def meta_messages(tree):
+    """Retained /meta messages that declare the control types"""
+
+    return [
+        FakeMessage(
+            "/devices/%s/controls/%s/meta" % (device_id, control_id),
+            json.dumps({"type": kind}).encode(),
+            True,
+        )
+        for device_id, control_id, kind in tree
+    ]
+
+
+def poll_trace(tree, controls, duration, change_ratio, seed):
+    """Messages published during duration seconds of polling
+
+    Args:
+        tree (list): Control topics from topic_tree()
+        controls (int): Number of controls per device
+        duration (float): Length of the trace in seconds
+        change_ratio (float): Share of polls that change the value
+        seed (int): Seed of the random generator
+
+    Returns:
+        list: FakeMessage in the order of publishing
+    """
+
+    rnd = random.Random(seed)
+    periods = [period for period, share in POLL_PERIODS for _ in range(share)]
+    events = []
+
+    for start in range(0, len(tree), controls):
+        period = rnd.choice(periods)
+        offset = rnd.uniform(0, period)
+        device = tree[start : start + controls]
+        values = [control_value(kind, rnd) for _, _, kind in device]
+        topics = [
+            "/devices/%s/controls/%s" % (device_id, control_id)
+            for device_id, control_id, _ in device
+        ]
+
+        stamp = offset
+        while stamp < duration:
+            for index, (_, _, kind) in enumerate(device):
+                if rnd.random() < change_ratio:
+                    values[index] = control_value(kind, rnd)
+                events.append((stamp, topics[index], values[index]))
+            stamp += period
+
+    events.sort(key=lambda event: event[0])
+    return [FakeMessage(topic, value.encode()) for _, topic, value in events]
+
+
+def percentile(samples, share):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(share * (len(samples) - 1))))
+    return samples[index]
+
+
+def new_client(broker, **kwargs):
+    """WbMqtt connected to the fake broker, the network loop is not running"""
+
+    with mock.patch.object(python2wb.mqtt.mqtt, "Client", broker.client_factory()):
+        wb = WbMqtt("localhost", 1883, **kwargs)
+    wb.client.loop()
+    return wb
+
+
+def bench_parse_value(rounds):
+    payloads = ["21.5", "1", "0", "ok", "-3.25", "1000", " 42 ", "error"]
+    values = payloads * (rounds // len(payloads))
+
+    started = time.perf_counter()
+    for value in values:
+        parse_value(value)
+    elapsed = time.perf_counter() - started
+
+    return {"calls": len(values), "calls_per_sec": len(values) / elapsed}
+
+
+def bench_replay(tree, meta, trace, duration, subscribe=False, **kwargs):
+    """Replay of the poll trace through _on_message
+
+    Args:
+        subscribe (bool): Subscribe a callback to every control and measure its latency
+        kwargs: Parameters of WbMqtt and subscribe()
+    """
+
+    broker = FakeBroker()
+    on_change = kwargs.pop("on_change", None)
+    wb = new_client(broker, **kwargs)
+    client = wb.client
+
+    latencies = []
+    started_at = [0.0]
+    clock = time.perf_counter
+
+    def callback(device_id, control_id, new_value):
+        latencies.append(clock() - started_at[0])
+
+    if subscribe:
+        for device_id, control_id, _ in tree:
+            wb.subscribe("%s/%s" % (device_id, control_id), callback, on_change)
+
+    for msg in meta:
+        client.deliver(msg)
+
+    on_message = client.on_message
+    started = clock()
+    if subscribe:
+        for msg in trace:
+            started_at[0] = clock()
+            on_message(client, None, msg)
+    else:
+        for msg in trace:
+            on_message(client, None, msg)
+    elapsed = clock() - started
+
+    wb.clear()
+
+    result = {
+        "messages": len(trace),
+        "trace_rate": len(trace) / duration,
+        "msgs_per_sec": len(trace) / elapsed,
+    }
+    if subscribe:
+        result["callbacks"] = len(latencies)
+        result["latency_p50_us"] = percentile(latencies, 0.5) * 1e6
+        result["latency_p99_us"] = percentile(latencies, 0.99) * 1e6
+    return result
+
+
+def bench_memory(tree, meta, trace):
+    """Memory of the control cache per control, values and types included"""
+
+    broker = FakeBroker()
+    values = {}
+    for msg in trace:
+        values[msg.topic] = msg
+    first_values = list(values.values())
+
+    tracemalloc.start()
+    try:
+        wb = new_client(broker)
+        before = tracemalloc.get_traced_memory()[0]
+        for msg in meta:
+            wb.client.deliver(msg)
+        for msg in first_values:
+            wb.client.deliver(msg)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    wb.clear()
+
+    return {
+        "controls": len(tree),
+        "cache_bytes": after - before,
+        "per_control_bytes": (after - before) / max(1, len(tree)),
+    }
+
+
+def device_description(controls):
+    return [
+        {
+            "name": "control%d" % c,
+            "title": {"en": "Control %d" % c},
+            "type": control_type(c),
+            "default": 0 if control_type(c) != "text" else "ok",
+            "order": c + 1,
+        }
+        for c in range(controls)
+    ]
+
+
+def bench_provision(devices, controls):
+    """Creation of virtual devices: one by one and in batches, then removal"""
+
+    description = device_description(controls)
+    result = {"devices": devices, "controls": controls}
+
+    broker = FakeBroker()
+    wb = new_client(broker)
+    started = time.perf_counter()
+    for d in range(devices):
+        wb.create_virtual_device("virtual%d" % d, "Virtual %d" % d, description)
+    wb.client.loop()
+    result["create_seconds"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    wb.remove_all_virtual_devices()
+    result["remove_seconds"] = time.perf_counter() - started
+    wb.clear()
+
+    broker = FakeBroker()
+    wb = new_client(broker)
+    started = time.perf_counter()
+    for d in range(devices):
+        wb.provision_virtual_device(
+            "virtual%d" % d, "Virtual %d" % d, description, diff=False
+        )
+    result["provision_seconds"] = time.perf_counter() - started
+    wb.clear()
+
+    # Restart of the script: retained state is already on the broker,
+    # the diff is read with one retained fetch per device
+    broker = FakeBroker()
+    wb = new_client(broker)
+    for d in range(devices):
+        wb.provision_virtual_device(
+            "virtual%d" % d, "Virtual %d" % d, description, diff=False
+        )
+    wb.client.disconnect()
+    wb = new_client(broker)
+    started = time.perf_counter()
+    published = 0
+    for d in range(devices):
+        published += wb.provision_virtual_device(
+            "virtual%d" % d, "Virtual %d" % d, description, diff=True
+        )
+    result["reprovision_seconds"] = time.perf_counter() - started
+    result["reprovision_messages"] = published
+    wb.clear()
+
+    return result
+
+
+def run(args):
+    tree = topic_tree(args.devices, args.controls)
+    meta = meta_messages(tree)
+    trace = poll_trace(tree, args.controls, args.duration, args.change_ratio, args.seed)
+
+    results = {}
+    results["parse_value"] = bench_parse_value(args.parse_rounds)
+    results["watch"] = bench_replay(tree, meta, trace, args.duration)
+    results["subscribe"] = bench_replay(
+        tree, meta, trace, args.duration, subscribe=True
+    )
+    results["subscribe_metrics"] = bench_replay(
+        tree, meta, trace, args.duration, subscribe=True, metrics=True
+    )
+    results["subscribe_on_change"] = bench_replay(
+        tree, meta, trace, args.duration, subscribe=True, on_change=True
+    )
+    results["subscribe_targeted"] = bench_replay(
+        tree,
+        meta,
+        trace,
+        args.duration,
+        subscribe=True,
+        base_subscribe_topic=None,
+    )
+    results["memory"] = bench_memory(tree, meta, trace)
+    results["provision"] = bench_provision(args.provision_devices, args.controls)
+
+    return {
+        "version": REPORT_VERSION,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "params": {
+            "devices": args.devices,
+            "controls": args.controls,
+            "duration": args.duration,
+            "change_ratio": args.change_ratio,
+            "seed": args.seed,
+            "provision_devices": args.provision_devices,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Regressions of the report against the baseline
+
+    Returns:
+        list: Strings with the description of every regression
+    """
+
+    regressions = []
+    for name, metrics in report["results"].items():
+        old_metrics = baseline.get("results", {}).get(name, {})
+        for metric, value in metrics.items():
+            old = old_metrics.get(metric)
+            if not old or value is None:
+                continue
+            if metric.endswith(HIGHER_IS_BETTER):
+                change = (old - value) / old
+            elif metric.endswith(LOWER_IS_BETTER):
+                change = (value - old) / old
+            else:
+                continue
+            if change > tolerance:
+                regressions.append(
+                    "%s.%s: %.6g -> %.6g (%.1f%% worse)"
+                    % (name, metric, old, value, change * 100)
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--controls", type=int, default=20)
+    parser.add_argument(
+        "--duration", type=float, default=5, help="seconds of polling in the trace"
+    )
+    parser.add_argument("--change-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--parse-rounds", type=int, default=200000)
+    parser.add_argument("--provision-devices", type=int, default=10)
+    parser.add_argument("-o", "--output", help="write the JSON report to a file")
+    parser.add_argument("--baseline", help="JSON report to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed relative regression, 0.1 is 10%%",
+    )
+    args = parser.parse_args(argv)
+
+    # python2wb prints connection events, stdout is reserved for the report
+    atexit.unregister(python2wb.mqtt.goodbye)
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(data + "\n")
+    else:
+        print(data)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print("Regression: %s" % line, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1 @@
-__all__ = ["mqtt"]
+__all__ = ["mqtt", "aio"]
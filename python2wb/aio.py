@@ -0,0 +1,536 @@
+import asyncio
+import itertools
+import time
+
+import paho.mqtt.client as mqtt
+
+from .mqtt import WbMqtt
+
+
+class LoopScheduler:
+    """Планировщик отложенных вызовов поверх цикла событий asyncio"""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._timers = set()
+
+    def time(self):
+        return self._loop.time()
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self._loop.time() + max(0, delay), callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = None
+
+        def run():
+            self._timers.discard(handle)
+            callback(*args)
+
+        handle = self._loop.call_at(when, run)
+        self._timers.add(handle)
+        return handle
+
+    def __len__(self):
+        return len(self._timers)
+
+    def stop(self):
+        for handle in self._timers:
+            handle.cancel()
+        self._timers.clear()
+
+
+class AsyncWbMqtt(WbMqtt):
+    """Клиент для asyncio-приложений с той же семантикой устройств и контролов, что и WbMqtt.
+
+    Сокет клиента обслуживается циклом событий через add_reader/add_writer,
+    отдельный сетевой поток paho не запускается. Объект нужно создавать внутри
+    работающего цикла событий.
+
+    Обработчики выполняются в цикле событий, поэтому workers и processes
+    не поддерживаются. get() и set() синхронные, как в WbMqtt, ожидание значения
+    и подтверждения брокера — в aget() и aset().
+    """
+
+    def __init__(
+        self,
+        server_url,
+        port,
+        username=None,
+        password=None,
+        qos_pub=1,
+        qos_sub=0,
+        base_subscribe_topic="#",
+        client_id=None,
+        driver_name="python2wb",
+        loop=None,
+        **kwargs
+    ):
+        for name in ("workers", "processes"):
+            if kwargs.get(name):
+                raise ValueError(
+                    "AsyncWbMqtt runs callbacks in the event loop, %s is not supported"
+                    % (name)
+                )
+
+        if loop is None:
+            loop = asyncio.get_running_loop()
+
+        self._loop = loop
+        self._tasks = set()
+        self._publish_waiters = {}
+        self._value_waiters = {}
+        self._misc_task = None
+        self._disconnected = loop.create_future()
+        self._watch_keys = itertools.count()
+        self._connected_future = loop.create_future()
+        self._reconnect_delay = None
+        self._connecting = None
+        self._closing = False
+
+        super().__init__(
+            server_url,
+            port,
+            username=username,
+            password=password,
+            qos_pub=qos_pub,
+            qos_sub=qos_sub,
+            base_subscribe_topic=base_subscribe_topic,
+            client_id=client_id,
+            driver_name=driver_name,
+            **kwargs
+        )
+
+    def _connect(self, server_url, port):
+        """Внутреннее. Подключение к брокеру с обслуживанием сокета циклом событий.
+        Разрешение имени и установка TCP-соединения блокируют поток, поэтому
+        выполняются в пуле потоков цикла событий, а не в нём самом.
+        """
+
+        client = self.client
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        client.on_publish = self._on_publish
+
+        self._connect_started = time.monotonic()
+        client.connect_async(server_url, port, 60)
+        self._reconnect()
+
+    def _on_connected(self):
+        self._reconnect_delay = None
+        WbMqtt._on_connected(self)
+        if not self._connected_future.done():
+            self._connected_future.set_result(True)
+
+    def _on_disconnected(self, rc):
+        """Внутреннее. Сетевого цикла paho нет, поэтому после обрыва связи
+        переподключаемся сами с экспоненциальной задержкой. rc=0 — отключение
+        по disconnect(), после него переподключения нет.
+        """
+
+        WbMqtt._on_disconnected(self, rc)
+        if rc == 0:
+            if not self._disconnected.done():
+                self._disconnected.set_result(rc)
+            return
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        """Внутреннее. Планирование следующей попытки переподключения"""
+
+        min_delay, max_delay = self._reconnect_delays
+        if self._reconnect_delay is None:
+            self._reconnect_delay = min_delay
+        else:
+            self._reconnect_delay = min(self._reconnect_delay * 2, max_delay)
+        self._loop.call_later(self._reconnect_delay, self._reconnect)
+
+    def _reconnect(self):
+        """Внутреннее. Попытка подключения в пуле потоков цикла событий"""
+
+        if self._closing or self._disconnected.done() or self._connecting is not None:
+            return
+        self._connecting = self._loop.run_in_executor(None, self.client.reconnect)
+        self._connecting.add_done_callback(self._on_reconnect_done)
+
+    def _on_reconnect_done(self, future):
+        """Внутреннее. Результат попытки подключения"""
+
+        self._connecting = None
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            return
+        print("Unable to reconnect: %s" % (error))
+        self._schedule_reconnect()
+
+    async def wait_synced(self, patterns=None, timeout=10, quiet=None):
+        """Ожидание окончания начальной выдачи retained-сообщений, как WbMqtt.wait_synced
+
+        Returns:
+            dict: synced, topics, elapsed
+        """
+
+        deadline = self._loop.time() + timeout
+        synced = False
+
+        try:
+            if quiet:
+                last_seq = self.controls.last_seq
+                while True:
+                    await asyncio.sleep(quiet)
+                    if self.controls.last_seq == last_seq:
+                        break
+                    last_seq = self.controls.last_seq
+                    if self._loop.time() >= deadline:
+                        raise asyncio.TimeoutError
+            else:
+                await asyncio.wait_for(
+                    asyncio.shield(self._connected_future),
+                    max(0, deadline - self._loop.time()),
+                )
+                marker = self._loop.create_future()
+                topic = self._new_sync_marker()
+
+                def on_marker(client, userdata, msg):
+                    if not marker.done():
+                        marker.set_result(True)
+
+                self._add_route(topic, on_marker)
+                try:
+                    self.client.publish(topic, "1", qos=self.qos_pub)
+                    await asyncio.wait_for(marker, max(0, deadline - self._loop.time()))
+                finally:
+                    self._remove_route(topic)
+            synced = True
+        except asyncio.TimeoutError:
+            pass
+
+        return self._sync_result(patterns, synced)
+
+    def _in_loop(self, callback, *args):
+        """Внутреннее. Вызов в цикле событий: сразу, если он текущий, иначе из
+        потока подключения через call_soon_threadsafe
+        """
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    # Сокет передаётся номером дескриптора: при вызове из потока подключения
+    # paho закрывает сокет раньше, чем цикл событий выполнит вызов
+    def _on_socket_open(self, client, userdata, sock):
+        self._in_loop(self._socket_opened, sock.fileno())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._in_loop(self._socket_closed, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self._loop.add_writer, sock.fileno(), client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self._loop.remove_writer, sock.fileno())
+
+    def _socket_opened(self, fd):
+        self._loop.add_reader(fd, self.client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _socket_closed(self, fd):
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    async def _misc_loop(self):
+        """Внутреннее. Обслуживание keepalive и повторов отправки"""
+
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+    def _on_publish(self, client, userdata, mid):
+        waiter = self._publish_waiters.pop(mid, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(mid)
+
+    def _create_scheduler(self):
+        """Внутреннее. Отложенные вызовы выполняются циклом событий"""
+
+        return LoopScheduler(self._loop)
+
+    def _call_serialized(self, callback, *args):
+        """Внутреннее. Планировщик и сокет обслуживает один цикл событий,
+        поэтому вызов выполняется сразу.
+        """
+
+        callback(*args)
+
+    def _call(self, key, callback, args, coalesce_key=None):
+        """Внутреннее. Корутины запускаются задачами в цикле событий,
+        обычные функции вызываются сразу.
+        """
+
+        metrics = self._metrics
+        if asyncio.iscoroutinefunction(callback):
+            coroutine = callback(*args)
+            if metrics is not None:
+                coroutine = metrics.run_async(metrics.callback(callback), coroutine)
+            task = self._loop.create_task(coroutine)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif metrics is not None:
+            metrics.run(metrics.callback(callback), callback, args)
+        else:
+            callback(*args)
+
+    async def _wait_published(self, info):
+        """Внутреннее. Ожидание подтверждения публикации от брокера"""
+
+        if info is None:
+            # Значение поставлено в исходящую очередь
+            return
+        if info.rc != mqtt.MQTT_ERR_SUCCESS or info.is_published():
+            return
+        waiter = self._loop.create_future()
+        self._publish_waiters[info.mid] = waiter
+        await waiter
+
+    async def aget(self, control_path, timeout=None):
+        """Получение значения контрола. Если значение ещё не приходило от брокера — ждёт его.
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            timeout (float, optional): Время ожидания в секундах. По умолчанию ждёт без ограничения.
+
+        Returns:
+            float, int, str: Значение контрола
+
+        Raises:
+            asyncio.TimeoutError: Значение не пришло за timeout секунд
+        """
+
+        if control_path not in self.controls:
+            waiter = self._loop.create_future()
+            self._value_waiters.setdefault(control_path, []).append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            finally:
+                waiters = self._value_waiters.get(control_path)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+
+        return self.get(control_path)
+
+    async def aset(self, control_path, value):
+        """Запись значения в контрол с ожиданием подтверждения брокера
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            value (float, int, str): Новое значение контрола, которое будет опубликовано в MQTT
+        """
+
+        await self._wait_published(self._publish(control_path, value))
+
+    async def set_and_confirm(self, control_path, value, timeout=5, tolerance=0):
+        """Запись значения в контрол с ожиданием подтверждения устройством:
+            значение должно прийти в топик состояния контрола.
+            Одновременно может ожидать любое число команд.
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            value (float, int, str): Новое значение контрола
+            timeout (float, optional): Время ожидания подтверждения в секундах
+            tolerance (float, optional): Допустимое отклонение числового значения
+
+        Returns:
+            float, int, str: Подтверждённое значение
+
+        Raises:
+            asyncio.TimeoutError: Подтверждение не пришло за timeout секунд
+            CommandError: Устройство сообщило об ошибке записи в /meta/error
+        """
+
+        waiter = self._loop.create_future()
+
+        def notify():
+            if not waiter.done():
+                waiter.set_result(None)
+
+        command = self._start_command(control_path, value, tolerance, notify)
+        try:
+            await self._wait_published(self._publish(control_path, value))
+            remaining = command.sent + timeout - time.monotonic()
+            await asyncio.wait_for(waiter, max(0, remaining))
+        finally:
+            self._finish_command(command)
+        return self._command_result(command)
+
+    async def publish(self, mqtt_topic, value, retain=False):
+        """Публикация значения в mqtt-топик с ожиданием подтверждения брокера
+
+        Args:
+            mqtt_topic (string): Полный путь к mqtt-топику
+            value (float, int, str): Новое значение топика
+            retain (bool, optional): Retain-флаг. По умолчанию False.
+        """
+
+        await self._wait_published(self.publish_raw(mqtt_topic, value, retain))
+
+    async def _fetch_retained(self, topic_filter, quiet=0.3, timeout=5):
+        """Внутреннее. Чтение retained-сообщений по фильтру
+
+        Returns:
+            dict: {топик: значение типа str}
+        """
+
+        fetch = self._start_fetch(topic_filter)
+        deadline = self._loop.time() + timeout
+        try:
+            while True:
+                now = self._loop.time()
+                since_last = time.monotonic() - fetch.last
+                if since_last >= quiet or now >= deadline:
+                    break
+                await asyncio.sleep(min(quiet - since_last, deadline - now))
+        finally:
+            self._stop_fetch(fetch)
+        return fetch.messages
+
+    async def provision_virtual_device(
+        self, device_id, device_title, controls, diff=True, window=100, timeout=10
+    ):
+        """Создание виртуального устройства одной пачкой, как WbMqtt.provision_virtual_device
+
+        Returns:
+            int: Количество опубликованных сообщений
+        """
+
+        retained = {}
+        if diff:
+            retained = await self._fetch_retained(
+                "/devices/%s/#" % device_id, timeout=timeout
+            )
+
+        messages = self._provision_messages(device_id, device_title, controls, retained)
+
+        await self._publish_batch_async(messages, window, timeout)
+
+        return len(messages)
+
+    def _publish_batch(self, messages, window=100, timeout=10):
+        """Внутреннее. Синхронные методы не могут ждать подтверждений в цикле событий,
+        поэтому сообщения только ставятся в очередь paho. Для ожидания используйте close().
+        """
+
+        for topic, payload in messages:
+            self._publish_now(topic, payload, self.qos_pub, True)
+        return True
+
+    async def _publish_batch_async(self, messages, window=100, timeout=10):
+        """Внутреннее. Публикация пачки retained-сообщений с ожиданием всех подтверждений в конце
+
+        Returns:
+            bool: True, если все сообщения подтверждены
+        """
+
+        pending = set()
+        for topic, payload in messages:
+            if len(pending) >= window:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+            info = self._publish_now(topic, payload, self.qos_pub, True)
+            pending.add(self._loop.create_task(self._wait_published(info)))
+
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=timeout)
+            if pending:
+                print("%s messages were not acknowledged." % (len(pending)))
+                for task in pending:
+                    task.cancel()
+                return False
+        return True
+
+    async def watch(self, control_path, mode="value", maxsize=0):
+        """Асинхронный итератор по изменениям контролов
+
+        Args:
+            control_path (string, list): Путь к контролу в формате 'device/control',
+                можно использовать '+', или список путей
+            mode (string, optional): value — значения, on — командный топик, errors — ошибки
+            maxsize (int, optional): Ограничение очереди. При переполнении теряются самые старые значения.
+
+        Yields:
+            tuple: device_id, control_id, new_value
+        """
+
+        paths = control_path if type(control_path) == list else [control_path]
+        key = "watch-%s" % next(self._watch_keys)
+        queue = asyncio.Queue(maxsize)
+
+        def put(device_id, control_id, new_value):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((device_id, control_id, new_value))
+
+        for path in paths:
+            self._subscribe(path, put, mode=mode, key=key)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            for path in paths:
+                self._unsubscribe(path, mode=mode, key=key)
+
+    def write_value_in_dic(self, control_path, new_value):
+        entry = WbMqtt.write_value_in_dic(self, control_path, new_value)
+
+        waiters = self._value_waiters.pop(control_path, None)
+        if waiters:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+        return entry
+
+    async def loop_forever(self):
+        """Ожидание до отключения от брокера вызовом close().
+        При обрыве связи клиент переподключается сам.
+        """
+
+        await asyncio.shield(self._disconnected)
+
+    def loop_start(self):
+        """Сетевой поток не нужен: сокет обслуживается циклом событий"""
+
+    def loop_stop(self):
+        """Сетевой поток не нужен: сокет обслуживается циклом событий"""
+
+    async def close(self):
+        """Очистка виртуальных устройств, подписок и отключение от брокера"""
+
+        self._closing = True
+        await self._publish_batch_async(
+            self._unregister_virtual_devices(list(self.virtual_devices))
+        )
+        self.clear()
+        if not self._connected and not self._disconnected.done():
+            # Связи нет, on_disconnect уже не придёт
+            self._disconnected.set_result(0)
+        if self._disconnected.done():
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._disconnected), 5)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,334 @@
+import itertools
+import sys
+import time
+from collections.abc import Mapping
+
+# Типы контролов по конвенции Wiren Board, включая типы старого стиля
+SWITCH_TYPES = frozenset(("switch", "pushbutton"))
+TEXT_TYPES = frozenset(("text", "rgb", "alarm"))
+NUMERIC_TYPES = frozenset(
+    (
+        "value",
+        "range",
+        "temperature",
+        "rel_humidity",
+        "atmospheric_pressure",
+        "rainfall",
+        "wind_speed",
+        "power",
+        "power_consumption",
+        "voltage",
+        "water_flow",
+        "water_consumption",
+        "resistance",
+        "concentration",
+        "heat_power",
+        "heat_energy",
+        "current",
+        "lux",
+        "sound_level",
+        "pressure",
+    )
+)
+
+# Размер кэша разбора топиков. При переполнении кэш очищается целиком.
+TOPIC_CACHE_SIZE = 65536
+
+
+def parse_value(value):
+    """Преобразование строкового значения в число, если это возможно
+
+    Args:
+        value (string, bytes): Значение типа str или payload mqtt-сообщения
+
+    Returns:
+        float, int, str: Типизированное значение
+    """
+
+    if type(value) == bytes:
+        # int() и float() принимают bytes, строка создаётся только для текста
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value.decode().strip()
+
+    if type(value) != str:
+        return value
+
+    value = value.strip()
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def convert_value(control_type, value):
+    """Преобразование значения по типу контрола из /meta
+
+    Args:
+        control_type (string): Тип контрола или None, если он неизвестен
+        value (string, bytes): Значение типа str или payload mqtt-сообщения
+
+    Returns:
+        float, int, str: Типизированное значение
+    """
+
+    if control_type is None:
+        return parse_value(value)
+
+    try:
+        if control_type in NUMERIC_TYPES:
+            return float(value)
+        if control_type in SWITCH_TYPES:
+            return int(value)
+    except (TypeError, ValueError):
+        return parse_value(value)
+
+    if control_type in TEXT_TYPES:
+        if type(value) == bytes:
+            return value.decode()
+        return value if type(value) == str else str(value)
+    return parse_value(value)
+
+
+class ControlValue:
+    """Запись кэша контролов
+
+    Attributes:
+        value (float, int, str): Типизированное значение
+        timestamp (float): Время получения по time.time()
+        seq (int): Порядковый номер обновления в кэше
+        stale (bool): Значение загружено из снимка и ещё не подтверждено брокером
+    """
+
+    __slots__ = ("value", "timestamp", "seq", "stale")
+
+    def __init__(self, value, timestamp, seq, stale=False):
+        self.value = value
+        self.timestamp = timestamp
+        self.seq = seq
+        self.stale = stale
+
+    def __repr__(self):
+        return "ControlValue(%r, timestamp=%r, seq=%r, stale=%r)" % (
+            self.value,
+            self.timestamp,
+            self.seq,
+            self.stale,
+        )
+
+
+class ControlCache(Mapping):
+    """Кэш значений контролов в формате {'device/control': значение}.
+
+    Значение преобразуется один раз при получении, по типу контрола из /meta,
+    если он уже известен. Чтение возвращает готовое значение без повторного разбора.
+    Идентификаторы устройств и контролов интернируются, разбор топиков кэшируется,
+    записи обновляются на месте: в установившемся режиме сообщение не создаёт
+    новых строк и записей.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._types = {}
+        self._topics = {}
+        self._seq = itertools.count(1)
+        self.last_seq = 0
+
+    def resolve(self, topic, cache=True):
+        """Разбор топика контрола '/devices/<device>/controls/<control>[/...]'.
+            Результат кэшируется по топику.
+
+        Args:
+            topic (string): Полный путь к mqtt-топику
+            cache (bool, optional): Сохранять результат. Для редких топиков, например /meta,
+                кэш не нужен.
+
+        Returns:
+            tuple: (device_id, control_id, путь к контролу 'device/control', остаток топика
+                после контрола, например 'meta/type', или пустая строка)
+        """
+
+        item = self._topics.get(topic)
+        if item is None:
+            items = topic.split("/", 5)
+            device_id = sys.intern(items[2])
+            control_id = sys.intern(items[4])
+            item = (
+                device_id,
+                control_id,
+                sys.intern("%s/%s" % (device_id, control_id)),
+                items[5] if len(items) > 5 else "",
+            )
+            if cache:
+                if len(self._topics) >= TOPIC_CACHE_SIZE:
+                    self._topics.clear()
+                self._topics[topic] = item
+        return item
+
+    def __getitem__(self, control_path):
+        return self._entries[control_path].value
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, control_path):
+        return control_path in self._entries
+
+    def get(self, control_path, default=None):
+        entry = self._entries.get(control_path)
+        if entry is None:
+            return default
+        return entry.value
+
+    def entry(self, control_path):
+        """Запись кэша с временем получения и порядковым номером
+
+        Returns:
+            ControlValue: Запись или None
+        """
+
+        return self._entries.get(control_path)
+
+    def convert(self, control_path, raw_value):
+        """Преобразование значения по известному типу контрола без записи в кэш"""
+
+        return convert_value(self._types.get(control_path), raw_value)
+
+    def update(self, control_path, raw_value, timestamp=None):
+        """Запись нового значения, пришедшего из MQTT
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            raw_value (string, bytes): Значение типа str или payload mqtt-сообщения
+            timestamp (float, optional): Время получения. По умолчанию текущее.
+
+        Returns:
+            ControlValue: Обновлённая запись
+        """
+
+        return self.put(
+            control_path,
+            convert_value(self._types.get(control_path), raw_value),
+            timestamp,
+        )
+
+    def put(self, control_path, value, timestamp=None):
+        """Запись уже типизированного значения
+
+        Returns:
+            ControlValue: Обновлённая запись
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        seq = next(self._seq)
+        self.last_seq = seq
+
+        entry = self._entries.get(control_path)
+        if entry is None:
+            entry = ControlValue(value, timestamp, seq)
+            self._entries[sys.intern(control_path)] = entry
+        else:
+            entry.value = value
+            entry.timestamp = timestamp
+            entry.seq = seq
+            entry.stale = False
+        return entry
+
+    def pop(self, control_path, default=None):
+        """Удаление контрола из кэша
+
+        Returns:
+            float, int, str: Последнее значение контрола
+        """
+
+        self._types.pop(control_path, None)
+        entry = self._entries.pop(control_path, None)
+        if entry is None:
+            return default
+        return entry.value
+
+    def get_type(self, control_path):
+        """Тип контрола из /meta или None"""
+
+        return self._types.get(control_path)
+
+    def set_type(self, control_path, control_type):
+        """Запись типа контрола. Уже сохранённое значение преобразуется заново.
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            control_type (string): Тип контрола
+        """
+
+        if not control_type:
+            self._types.pop(control_path, None)
+            return
+        if self._types.get(control_path) == control_type:
+            return
+
+        self._types[control_path] = sys.intern(control_type)
+        entry = self._entries.get(control_path)
+        if entry is not None:
+            value = entry.value
+            if type(value) != str:
+                value = repr(value) if type(value) == float else str(value)
+            entry.value = convert_value(control_type, value)
+
+    def copy(self):
+        """Копия кэша в виде обычного словаря
+
+        Returns:
+            dict: Словарь {'device/control': значение}
+        """
+
+        return {
+            control_path: entry.value
+            for control_path, entry in list(self._entries.items())
+        }
+
+    def records(self):
+        """Записи кэша для снимка
+
+        Returns:
+            list: Кортежи (путь к контролу, тип контрола, значение, время получения)
+        """
+
+        types = self._types
+        return [
+            (control_path, types.get(control_path), entry.value, entry.timestamp)
+            for control_path, entry in list(self._entries.items())
+        ]
+
+    def load(self, records):
+        """Загрузка записей из снимка. Значения помечаются устаревшими до подтверждения брокером.
+            Уже полученные от брокера значения не перезаписываются.
+
+        Args:
+            records (list): Кортежи (путь к контролу, тип контрола, значение, время получения)
+
+        Returns:
+            int: Количество загруженных контролов
+        """
+
+        loaded = 0
+        for control_path, control_type, value, timestamp in records:
+            control_path = sys.intern(control_path)
+            if control_type and control_path not in self._types:
+                self._types[control_path] = sys.intern(control_type)
+            if control_path in self._entries:
+                continue
+            self._entries[control_path] = ControlValue(value, timestamp, 0, True)
+            loaded += 1
+        return loaded
@@ -0,0 +1,207 @@
+import threading
+import time
+
+from .metrics import Histogram
+
+
+class CommandError(Exception):
+    """Устройство сообщило об ошибке записи в /meta/error контрола
+
+    Attributes:
+        control_path (string): Путь к контролу в формате 'device/control'
+        error (string): Значение /meta/error, например "w" или "rw"
+    """
+
+    def __init__(self, control_path, error):
+        Exception.__init__(
+            self, "Write to %s failed, error: %s" % (control_path, error)
+        )
+        self.control_path = control_path
+        self.error = error
+
+
+class Command:
+    """Команда, ожидающая подтверждения значением в топике состояния контрола
+
+    Attributes:
+        control_path (string): Путь к контролу в формате 'device/control'
+        expected (float, int, str): Ожидаемое значение, преобразованное по типу контрола
+        sent (float): Время отправки по time.monotonic()
+        done (bool): Команда подтверждена или завершилась ошибкой
+        value (float, int, str): Подтверждённое значение
+        error (string): Значение /meta/error, если запись не удалась
+    """
+
+    __slots__ = (
+        "control_path",
+        "device_id",
+        "expected",
+        "tolerance",
+        "sent",
+        "done",
+        "value",
+        "error",
+        "notify",
+    )
+
+    def __init__(self, control_path, expected, tolerance, notify):
+        self.control_path = control_path
+        self.device_id = control_path.split("/")[0]
+        self.expected = expected
+        self.tolerance = tolerance
+        self.sent = time.monotonic()
+        self.done = False
+        self.value = None
+        self.error = None
+        self.notify = notify
+
+    def matches(self, value):
+        """Совпадение значения с ожидаемым, для чисел с допуском tolerance"""
+
+        expected = self.expected
+        if type(value) == str or type(expected) == str:
+            return value == expected
+        return abs(value - expected) <= self.tolerance
+
+
+class DeviceCommandStats:
+    """Счётчики команд устройства и гистограмма времени подтверждения"""
+
+    __slots__ = ("confirmed", "errors", "timeouts", "latency")
+
+    def __init__(self):
+        self.confirmed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latency = Histogram()
+
+
+class CommandTracker:
+    """Таблица команд, ожидающих подтверждения: {путь к контролу: [Command]}.
+
+    Команды не занимают потоков: подтверждение и ошибку разбирает сетевой поток
+    при получении значения, а ожидающий узнаёт о результате через notify().
+    Сетевой поток проверяет таблицу без блокировки, пока она пуста.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.devices = {}
+        self._lock = threading.Lock()
+
+    def add(self, command):
+        """Регистрация команды до её отправки
+
+        Returns:
+            bool: True, если это первая ожидающая команда контрола
+        """
+
+        with self._lock:
+            commands = self.pending.get(command.control_path)
+            if commands is None:
+                self.pending[command.control_path] = [command]
+                return True
+            commands.append(command)
+            return False
+
+    def confirm(self, control_path, value):
+        """Подтверждение команд контрола пришедшим значением.
+            Несовпадающие значения, например промежуточные, команды не завершают.
+
+        Returns:
+            bool: True, если у контрола не осталось ожидающих команд
+        """
+
+        now = time.monotonic()
+        confirmed = []
+        with self._lock:
+            commands = self.pending.get(control_path)
+            if not commands:
+                return False
+            for command in commands:
+                if command.matches(value):
+                    command.done = True
+                    command.value = value
+                    confirmed.append(command)
+            if not confirmed:
+                return False
+            commands[:] = [command for command in commands if not command.done]
+            for command in confirmed:
+                stats = self._device(command.device_id)
+                stats.confirmed += 1
+                stats.latency.observe(now - command.sent)
+            empty = not commands
+            if empty:
+                del self.pending[control_path]
+
+        for command in confirmed:
+            command.notify()
+        return empty
+
+    def fail(self, control_path, error):
+        """Завершение всех команд контрола ошибкой записи
+
+        Returns:
+            bool: True, если были ожидающие команды
+        """
+
+        with self._lock:
+            commands = self.pending.pop(control_path, None)
+            if not commands:
+                return False
+            for command in commands:
+                command.done = True
+                command.error = error
+                self._device(command.device_id).errors += 1
+
+        for command in commands:
+            command.notify()
+        return True
+
+    def discard(self, command):
+        """Снятие команды с ожидания по таймауту или отмене.
+            Уже завершённая команда не учитывается повторно.
+
+        Returns:
+            bool: True, если у контрола не осталось ожидающих команд
+        """
+
+        with self._lock:
+            if command.done:
+                return False
+            command.done = True
+            self._device(command.device_id).timeouts += 1
+            commands = self.pending.get(command.control_path)
+            if commands is None or command not in commands:
+                return False
+            commands.remove(command)
+            if commands:
+                return False
+            del self.pending[command.control_path]
+            return True
+
+    def _device(self, device_id):
+        stats = self.devices.get(device_id)
+        if stats is None:
+            stats = self.devices[device_id] = DeviceCommandStats()
+        return stats
+
+    def __len__(self):
+        return sum(len(commands) for commands in list(self.pending.values()))
+
+    def stats(self):
+        """Сводка по устройствам
+
+        Returns:
+            dict: {устройство: сводка времени подтверждения с confirmed, errors, timeouts}.
+                Времена в секундах.
+        """
+
+        result = {}
+        for device_id, stats in list(self.devices.items()):
+            summary = stats.latency.as_dict()
+            summary["confirmed"] = stats.confirmed
+            summary["errors"] = stats.errors
+            summary["timeouts"] = stats.timeouts
+            result[device_id] = summary
+        return result
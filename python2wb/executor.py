@@ -0,0 +1,152 @@
+import collections
+import threading
+import traceback
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_COALESCE = "coalesce"
+
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE)
+
+
+class _Worker:
+    """Поток-обработчик со своей ограниченной очередью"""
+
+    def __init__(self, executor, index):
+        self.executor = executor
+        self.queue = collections.deque()
+        # Задачи в очереди, которые ещё можно заменить более свежим значением
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.run, name="python2wb-worker-%s" % index, daemon=True
+        )
+        self.thread.start()
+
+    def run(self):
+        queue = self.queue
+        condition = self.condition
+
+        while True:
+            with condition:
+                while not queue and self.running:
+                    condition.wait()
+                if not queue:
+                    return
+                item = queue.popleft()
+                if item[0] is not None:
+                    self.pending.pop(item[0], None)
+                condition.notify_all()
+
+            try:
+                item[1](*item[2])
+            except Exception:
+                traceback.print_exc()
+
+
+class CallbackExecutor:
+    """Пул потоков для выполнения пользовательских обработчиков вне сетевого потока paho.
+
+    Задачи с одинаковым ключом (устройство или контрол) всегда попадают в один поток,
+    поэтому порядок их выполнения сохраняется. Очередь каждого потока ограничена,
+    поведение при переполнении задаётся политикой:
+        block — сетевой поток ждёт освобождения места;
+        drop_oldest — самая старая задача выбрасывается;
+        coalesce — задача заменяет ещё не выполненную задачу того же контрола,
+            если такой нет — выбрасывается самая старая.
+    """
+
+    def __init__(self, workers=4, queue_size=1000, overflow=OVERFLOW_BLOCK):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                "Unknown overflow policy %s, expected one of %s"
+                % (overflow, ", ".join(OVERFLOW_POLICIES))
+            )
+
+        self.queue_size = max(1, queue_size)
+        self.overflow = overflow
+        self.dropped = 0
+        self.coalesced = 0
+        self._workers = [_Worker(self, index) for index in range(max(1, workers))]
+
+    def submit(self, key, callback, args, coalesce_key=None):
+        """Постановка обработчика в очередь
+
+        Args:
+            key (string): Ключ упорядочивания, например идентификатор устройства
+            callback (function): Обработчик
+            args (tuple): Аргументы обработчика
+            coalesce_key (object, optional): Ключ, по которому задачи заменяют друг друга
+                в режиме coalesce
+        """
+
+        worker = self._workers[hash(key) % len(self._workers)]
+        coalesce = self.overflow == OVERFLOW_COALESCE and coalesce_key is not None
+
+        with worker.condition:
+            if coalesce:
+                item = worker.pending.get(coalesce_key)
+                if item is not None:
+                    item[2] = args
+                    self.coalesced += 1
+                    return
+
+            queue = worker.queue
+            if len(queue) >= self.queue_size:
+                if self.overflow == OVERFLOW_BLOCK:
+                    while len(queue) >= self.queue_size and worker.running:
+                        worker.condition.wait()
+                else:
+                    dropped = queue.popleft()
+                    if dropped[0] is not None:
+                        worker.pending.pop(dropped[0], None)
+                    self.dropped += 1
+
+            item = [coalesce_key if coalesce else None, callback, args]
+            queue.append(item)
+            if coalesce:
+                worker.pending[coalesce_key] = item
+            worker.condition.notify_all()
+
+    def qsize(self):
+        """Текущая глубина очереди
+
+        Returns:
+            int: Количество задач, ожидающих выполнения во всех потоках
+        """
+
+        return sum(len(worker.queue) for worker in self._workers)
+
+    def stats(self):
+        """Состояние пула
+
+        Returns:
+            dict: Глубина очереди по потокам, количество выброшенных и объединённых задач
+        """
+
+        return {
+            "workers": len(self._workers),
+            "queue_size": self.queue_size,
+            "queue_depth": [len(worker.queue) for worker in self._workers],
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def shutdown(self, wait=True):
+        """Останов пула. Задачи, уже стоящие в очереди, будут выполнены.
+
+        Args:
+            wait (bool, optional): Ждать завершения потоков. По умолчанию True.
+        """
+
+        for worker in self._workers:
+            with worker.condition:
+                worker.running = False
+                worker.condition.notify_all()
+
+        if wait:
+            current = threading.current_thread()
+            for worker in self._workers:
+                if worker.thread is not current:
+                    worker.thread.join()
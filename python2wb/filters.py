@@ -0,0 +1,112 @@
+import threading
+
+ACCEPT = 0
+REJECT = -1
+
+
+def parse_deadband(deadband):
+    """Разбор зоны нечувствительности
+
+    Args:
+        deadband (float, int, str): Абсолютное значение, например 0.5,
+            или относительное в процентах строкой, например '2%'
+
+    Returns:
+        tuple: (абсолютная зона, относительная зона в долях)
+    """
+
+    if deadband is None:
+        return 0, 0
+    if type(deadband) == str:
+        deadband = deadband.strip()
+        if deadband.endswith("%"):
+            return 0, float(deadband[:-1]) / 100
+        return float(deadband), 0
+    return float(deadband), 0
+
+
+def _is_number(value):
+    return type(value) in (int, float)
+
+
+class ChangeFilter:
+    """Фильтр доставки значений для одной подписки.
+
+    Сравнивает новое значение с последним доставленным значением контрола:
+    одинаковые значения и изменения в пределах зоны нечувствительности не доставляются.
+    При заданном min_interval значения чаще интервала откладываются, по истечении
+    интервала доставляется последнее из них.
+
+    Args:
+        on_change (bool): Доставлять только изменившиеся значения
+        deadband (float, int, str, optional): Зона нечувствительности для числовых контролов
+        min_interval (float, optional): Минимальный интервал между доставками в секундах
+    """
+
+    def __init__(self, on_change=False, deadband=None, min_interval=0):
+        self.absolute, self.relative = parse_deadband(deadband)
+        self.on_change = on_change or bool(self.absolute or self.relative)
+        self.min_interval = min_interval or 0
+        self._last = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _changed(self, last_value, value):
+        if not self.on_change:
+            return True
+        if value == last_value and type(value) == type(last_value):
+            return False
+        if _is_number(value) and _is_number(last_value):
+            delta = abs(value - last_value)
+            if delta < self.absolute:
+                return False
+            if delta < self.relative * abs(last_value):
+                return False
+        return True
+
+    def check(self, control_path, value, now):
+        """Проверка нового значения
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            value (float, int, str): Новое значение
+            now (float): Текущее время по time.monotonic()
+
+        Returns:
+            float: ACCEPT — доставить сейчас, REJECT — не доставлять,
+                положительное число — отложить на указанное число секунд
+        """
+
+        with self._lock:
+            last = self._last.get(control_path)
+            if last is None:
+                self._last[control_path] = (value, now)
+                return ACCEPT
+
+            if not self._changed(last[0], value):
+                self._pending.pop(control_path, None)
+                return REJECT
+
+            wait = last[1] + self.min_interval - now
+            if wait > 0:
+                scheduled = control_path in self._pending
+                self._pending[control_path] = value
+                return REJECT if scheduled else wait
+
+            self._pending.pop(control_path, None)
+            self._last[control_path] = (value, now)
+            return ACCEPT
+
+    def take_pending(self, control_path, now):
+        """Извлечение отложенного значения по истечении интервала
+
+        Returns:
+            tuple: (True, значение) если его нужно доставить, иначе (False, None)
+        """
+
+        with self._lock:
+            if control_path not in self._pending:
+                return False, None
+            value = self._pending.pop(control_path)
+            self._last[control_path] = (value, now)
+            return True, value
@@ -0,0 +1,304 @@
+import array
+import threading
+import time
+
+
+class History:
+    """История значений контрола в кольцевом буфере фиксированного размера.
+
+    Отметки времени и значения хранятся в массивах array('d'), рядом хранятся
+    накопленные суммы. Среднее и наклон по окну считаются за O(log n): двоичный
+    поиск начала окна и разность накопленных сумм. Минимум и максимум — один
+    проход по срезу memoryview без копирования буфера.
+
+    Накопленные суммы пересчитываются относительно самого старого значения
+    каждые capacity добавлений, поэтому точность не падает со временем работы,
+    а добавление в среднем O(1).
+
+    Память на контрол ограничена: 6 массивов по capacity значений, 48 * capacity байт.
+
+    Args:
+        capacity (int, optional): Максимальное число хранимых значений
+        window (float, optional): Окно по умолчанию для запросов в секундах.
+            По умолчанию запросы охватывают весь буфер.
+    """
+
+    def __init__(self, capacity=1024, window=None):
+        capacity = max(2, int(capacity))
+        self.capacity = capacity
+        self.window = window
+
+        zeros = array.array("d", [0.0]) * capacity
+        self._times = array.array("d", zeros)
+        self._values = array.array("d", zeros)
+        # Накопленные суммы v, t, t*t, t*v, где t отсчитывается от self._base
+        self._sum_v = array.array("d", zeros)
+        self._sum_t = array.array("d", zeros)
+        self._sum_tt = array.array("d", zeros)
+        self._sum_tv = array.array("d", zeros)
+        self._view = memoryview(self._values)
+
+        self._start = 0
+        self._count = 0
+        self._base = 0.0
+        self._before = (0.0, 0.0, 0.0, 0.0)
+        self._appended = 0
+        self._lock = threading.Lock()
+
+    def append(self, timestamp, value):
+        """Добавление значения. Нечисловые значения пропускаются.
+
+        Args:
+            timestamp (float): Время получения по time.time()
+            value (float, int): Значение
+
+        Returns:
+            bool: True, если значение добавлено
+        """
+
+        if type(value) != float and type(value) != int:
+            return False
+
+        with self._lock:
+            capacity = self.capacity
+            count = self._count
+
+            if count:
+                last = (self._start + count - 1) % capacity
+                # Время не должно идти назад, иначе двоичный поиск по окну сломается
+                if timestamp < self._times[last]:
+                    timestamp = self._times[last]
+                sum_v = self._sum_v[last]
+                sum_t = self._sum_t[last]
+                sum_tt = self._sum_tt[last]
+                sum_tv = self._sum_tv[last]
+            else:
+                self._base = timestamp
+                self._before = (0.0, 0.0, 0.0, 0.0)
+                sum_v = sum_t = sum_tt = sum_tv = 0.0
+
+            if count == capacity:
+                oldest = self._start
+                self._before = (
+                    self._sum_v[oldest],
+                    self._sum_t[oldest],
+                    self._sum_tt[oldest],
+                    self._sum_tv[oldest],
+                )
+                self._start = (oldest + 1) % capacity
+                count -= 1
+
+            index = (self._start + count) % capacity
+            t = timestamp - self._base
+            value = float(value)
+            self._times[index] = timestamp
+            self._values[index] = value
+            self._sum_v[index] = sum_v + value
+            self._sum_t[index] = sum_t + t
+            self._sum_tt[index] = sum_tt + t * t
+            self._sum_tv[index] = sum_tv + t * value
+            self._count = count + 1
+
+            self._appended += 1
+            if self._appended >= capacity:
+                self._rebase()
+
+        return True
+
+    def _rebase(self):
+        """Внутреннее. Пересчёт накопленных сумм от самого старого значения"""
+
+        capacity = self.capacity
+        times = self._times
+        values = self._values
+        base = times[self._start]
+        sum_v = sum_t = sum_tt = sum_tv = 0.0
+
+        for offset in range(self._count):
+            index = (self._start + offset) % capacity
+            t = times[index] - base
+            value = values[index]
+            sum_v += value
+            sum_t += t
+            sum_tt += t * t
+            sum_tv += t * value
+            self._sum_v[index] = sum_v
+            self._sum_t[index] = sum_t
+            self._sum_tt[index] = sum_tt
+            self._sum_tv[index] = sum_tv
+
+        self._base = base
+        self._before = (0.0, 0.0, 0.0, 0.0)
+        self._appended = 0
+
+    def _first(self, window, now):
+        """Внутреннее. Логический индекс первого значения, попадающего в окно"""
+
+        if window is None:
+            window = self.window
+        if window is None:
+            return 0
+
+        if now is None:
+            now = time.time()
+        cutoff = now - window
+
+        times = self._times
+        capacity = self.capacity
+        start = self._start
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            if times[(start + middle) % capacity] < cutoff:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _sums(self, offset):
+        """Внутреннее. Накопленные суммы по логическому индексу offset включительно"""
+
+        if offset < 0:
+            return self._before
+        index = (self._start + offset) % self.capacity
+        return (
+            self._sum_v[index],
+            self._sum_t[index],
+            self._sum_tt[index],
+            self._sum_tv[index],
+        )
+
+    def _window_sums(self, window, now):
+        """Внутреннее. Количество значений и суммы v, t, t*t, t*v в окне"""
+
+        first = self._first(window, now)
+        count = self._count - first
+        if count <= 0:
+            return 0, None
+        end = self._sums(self._count - 1)
+        begin = self._sums(first - 1)
+        return count, [e - b for e, b in zip(end, begin)]
+
+    def _segments(self, window, now):
+        """Внутреннее. Срезы memoryview значений окна: один или два при переходе через край"""
+
+        first = self._first(window, now)
+        count = self._count - first
+        if count <= 0:
+            return []
+        begin = (self._start + first) % self.capacity
+        end = begin + count
+        if end <= self.capacity:
+            return [self._view[begin:end]]
+        return [self._view[begin:], self._view[: end - self.capacity]]
+
+    def mean(self, window=None, now=None):
+        """Среднее значение за окно
+
+        Args:
+            window (float, optional): Окно в секундах до now. По умолчанию окно из track().
+            now (float, optional): Конец окна по time.time(). По умолчанию текущее время.
+
+        Returns:
+            float: Среднее или None, если в окне нет значений
+        """
+
+        with self._lock:
+            count, sums = self._window_sums(window, now)
+        if not count:
+            return None
+        return sums[0] / count
+
+    def min(self, window=None, now=None):
+        """Минимальное значение за окно или None, параметры как у mean()"""
+
+        with self._lock:
+            segments = self._segments(window, now)
+            if not segments:
+                return None
+            return min(min(segment) for segment in segments)
+
+    def max(self, window=None, now=None):
+        """Максимальное значение за окно или None, параметры как у mean()"""
+
+        with self._lock:
+            segments = self._segments(window, now)
+            if not segments:
+                return None
+            return max(max(segment) for segment in segments)
+
+    def slope(self, window=None, now=None):
+        """Скорость изменения за окно: наклон прямой по методу наименьших квадратов
+
+        Returns:
+            float: Изменение значения в секунду или None, если в окне меньше двух
+                значений с разным временем
+        """
+
+        with self._lock:
+            count, sums = self._window_sums(window, now)
+        if count < 2:
+            return None
+        sum_v, sum_t, sum_tt, sum_tv = sums
+        denominator = count * sum_tt - sum_t * sum_t
+        if denominator <= 0:
+            return None
+        return (count * sum_tv - sum_t * sum_v) / denominator
+
+    def count(self, window=None, now=None):
+        """Количество значений в окне, параметры как у mean()"""
+
+        with self._lock:
+            return self._count - self._first(window, now)
+
+    def last(self):
+        """Последнее значение
+
+        Returns:
+            tuple: (время получения, значение) или None, если истории ещё нет
+        """
+
+        with self._lock:
+            if not self._count:
+                return None
+            index = (self._start + self._count - 1) % self.capacity
+            return self._times[index], self._values[index]
+
+    def samples(self, window=None, now=None):
+        """Перебор значений окна от старых к новым без копирования буфера.
+            Значения, добавленные во время перебора, могут заменить самые старые.
+
+        Yields:
+            tuple: (время получения, значение)
+        """
+
+        with self._lock:
+            first = self._first(window, now)
+            start = self._start
+            count = self._count
+
+        capacity = self.capacity
+        times = self._times
+        values = self._values
+        for offset in range(first, count):
+            index = (start + offset) % capacity
+            yield times[index], values[index]
+
+    def clear(self):
+        """Очистка истории"""
+
+        with self._lock:
+            self._start = 0
+            self._count = 0
+            self._appended = 0
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return "History(%d/%d values, window=%r)" % (
+            self._count,
+            self.capacity,
+            self.window,
+        )
@@ -0,0 +1,295 @@
+import sys
+import threading
+
+# Поля, по которым можно искать контролы
+QUERY_FIELDS = ("device", "driver", "type", "units", "readonly")
+
+# Поля контрола, для которых ведётся обратный индекс {значение: множество путей}
+_CONTROL_FIELDS = ("type", "units", "readonly")
+
+
+class DeviceMeta:
+    """Описание устройства из /devices/<device>/meta"""
+
+    __slots__ = ("device_id", "driver", "title")
+
+    def __init__(self, device_id, driver=None, title=None):
+        self.device_id = device_id
+        self.driver = driver
+        self.title = title
+
+    def __repr__(self):
+        return "DeviceMeta(%r, driver=%r, title=%r)" % (
+            self.device_id,
+            self.driver,
+            self.title,
+        )
+
+
+class ControlMeta:
+    """Описание контрола из /devices/<device>/controls/<control>/meta"""
+
+    __slots__ = ("device_id", "control_id", "type", "units", "readonly", "order")
+
+    def __init__(self, device_id, control_id):
+        self.device_id = device_id
+        self.control_id = control_id
+        self.type = None
+        self.units = None
+        self.readonly = False
+        self.order = None
+
+    def __repr__(self):
+        return "ControlMeta(%r, type=%r, units=%r, readonly=%r, order=%r)" % (
+            "%s/%s" % (self.device_id, self.control_id),
+            self.type,
+            self.units,
+            self.readonly,
+            self.order,
+        )
+
+
+def _intern(value):
+    if type(value) == str:
+        return sys.intern(value)
+    return value
+
+
+def _accepts(condition, value):
+    """Совпадение значения с условием запроса: значение или список допустимых значений"""
+
+    if type(condition) in (list, tuple, set, frozenset):
+        return value in condition
+    return value == condition
+
+
+def _options(condition):
+    if type(condition) in (list, tuple, set, frozenset):
+        return condition
+    return (condition,)
+
+
+class MetaIndex:
+    """Индекс описаний устройств и контролов, обновляется при получении /meta.
+
+    Для типа, единиц измерения и readonly контролов ведутся обратные индексы,
+    для драйвера — индекс устройств, поэтому запрос — пересечение готовых
+    множеств без перебора всех контролов.
+
+    Args:
+        on_use (function, optional): Вызывается один раз при первом запросе к индексу,
+            например чтобы начать получать /meta устройств
+    """
+
+    def __init__(self, on_use=None):
+        self._on_use = on_use
+        self.devices = {}
+        self.controls = {}
+        self._device_controls = {}
+        self._drivers = {}
+        self._fields = {field: {} for field in _CONTROL_FIELDS}
+        self._lock = threading.Lock()
+
+    def update_device(self, device_id, meta):
+        """Обновление описания устройства
+
+        Args:
+            device_id (string): Устройство
+            meta (dict): Содержимое /meta устройства или None при удалении
+
+        Returns:
+            list: Пути контролов, у которых могло измениться совпадение с запросами
+        """
+
+        with self._lock:
+            device = self.devices.get(device_id)
+            if device is not None:
+                self._unlink(self._drivers, device.driver, device_id)
+            if meta is None:
+                self.devices.pop(device_id, None)
+            else:
+                if device is None:
+                    device = self.devices[device_id] = DeviceMeta(device_id)
+                device.driver = _intern(meta.get("driver"))
+                device.title = meta.get("title")
+                self._link(self._drivers, device.driver, device_id)
+            return list(self._device_controls.get(device_id, ()))
+
+    def update_control(self, device_id, control_id, control_path, meta):
+        """Обновление описания контрола
+
+        Args:
+            device_id (string): Устройство
+            control_id (string): Контрол
+            control_path (string): Путь к контролу в формате 'device/control'
+            meta (dict): Изменившиеся поля /meta контрола или None при удалении
+
+        Returns:
+            bool: True, если описание контрола изменилось
+        """
+
+        with self._lock:
+            control = self.controls.get(control_path)
+            if meta is None:
+                if control is None:
+                    return False
+                self._unindex(control_path, control)
+                del self.controls[control_path]
+                controls = self._device_controls[device_id]
+                controls.remove(control_path)
+                if not controls:
+                    del self._device_controls[device_id]
+                return True
+
+            if control is None:
+                control = self.controls[control_path] = ControlMeta(
+                    device_id, control_id
+                )
+                # Списки контролов устройств заметно компактнее множеств
+                self._device_controls.setdefault(device_id, []).append(control_path)
+                changed = True
+            else:
+                changed = False
+
+            for field, value in meta.items():
+                value = _intern(value)
+                if getattr(control, field) == value:
+                    continue
+                changed = True
+                if field in self._fields:
+                    self._unlink(
+                        self._fields[field], getattr(control, field), control_path
+                    )
+                    self._link(self._fields[field], value, control_path)
+                setattr(control, field, value)
+            return changed
+
+    def _use(self):
+        """Внутреннее. Вызов on_use при первом обращении к индексу"""
+
+        on_use = self._on_use
+        if on_use is not None:
+            self._on_use = None
+            on_use()
+
+    def _unindex(self, control_path, control):
+        for field, index in self._fields.items():
+            self._unlink(index, getattr(control, field), control_path)
+
+    def _link(self, index, value, item):
+        # readonly=False не индексируется: это почти все контролы
+        if value is None or value is False:
+            return
+        items = index.get(value)
+        if items is None:
+            items = index[value] = set()
+        items.add(item)
+
+    def _unlink(self, index, value, item):
+        items = index.get(value)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del index[value]
+
+    def query(self, criteria):
+        """Поиск контролов по описанию
+
+        Args:
+            criteria (dict): Условия по полям device, driver, type, units, readonly.
+                Значение условия — значение поля или список допустимых значений.
+
+        Returns:
+            set: Пути подходящих контролов
+
+        Raises:
+            ValueError: Неизвестное поле в условиях
+        """
+
+        check_criteria(criteria)
+        self._use()
+        with self._lock:
+            candidates = []
+            for field, condition in criteria.items():
+                matched = set()
+                for option in _options(condition):
+                    if field == "device":
+                        matched.update(self._device_controls.get(option, ()))
+                    elif field == "driver":
+                        for device_id in self._drivers.get(option, ()):
+                            matched.update(self._device_controls.get(device_id, ()))
+                    elif field == "readonly" and not option:
+                        readonly = self._fields["readonly"].get(True, ())
+                        matched.update(
+                            path for path in self.controls if path not in readonly
+                        )
+                    else:
+                        matched.update(self._fields[field].get(_intern(option), ()))
+                candidates.append(matched)
+
+            if not candidates:
+                return set(self.controls)
+            candidates.sort(key=len)
+            return candidates[0].intersection(*candidates[1:])
+
+    def matches(self, control_path, criteria):
+        """Проверка одного контрола на соответствие условиям query()"""
+
+        with self._lock:
+            control = self.controls.get(control_path)
+            if control is None:
+                return False
+            for field, condition in criteria.items():
+                if field == "device":
+                    value = control.device_id
+                elif field == "driver":
+                    device = self.devices.get(control.device_id)
+                    value = device.driver if device is not None else None
+                else:
+                    value = getattr(control, field)
+                if not _accepts(condition, value):
+                    return False
+            return True
+
+    def device(self, device_id):
+        """Описание устройства или None"""
+
+        self._use()
+        return self.devices.get(device_id)
+
+    def control(self, control_path):
+        """Описание контрола или None"""
+
+        self._use()
+        return self.controls.get(control_path)
+
+    def __len__(self):
+        return len(self.controls)
+
+
+def check_criteria(criteria):
+    """Проверка полей условий запроса
+
+    Raises:
+        ValueError: Неизвестное поле в условиях
+    """
+
+    for field in criteria:
+        if field not in QUERY_FIELDS:
+            raise ValueError(
+                "Unknown query field %r, expected one of %s"
+                % (field, ", ".join(QUERY_FIELDS))
+            )
+
+
+class QuerySubscription:
+    """Подписка по запросу к индексу: набор контролов обновляется при изменении /meta"""
+
+    __slots__ = ("key", "criteria", "callback", "change_filter", "controls")
+
+    def __init__(self, key, criteria, callback, change_filter):
+        self.key = key
+        self.criteria = criteria
+        self.callback = callback
+        self.change_filter = change_filter
+        self.controls = set()
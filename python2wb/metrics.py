@@ -0,0 +1,312 @@
+import math
+import time
+
+# Гистограмма времени выполнения: логарифмические корзины, по 4 на каждую степень двойки.
+# Покрывает от ~1 мкс до ~2 минут, точность перцентилей около 20%.
+_SUBBUCKETS = 4
+_MIN_EXPONENT = -20
+_MAX_EXPONENT = 7
+_BUCKETS = (_MAX_EXPONENT - _MIN_EXPONENT + 1) * _SUBBUCKETS
+
+# Время выполнения замеряется у каждого SAMPLE_EVERY-го вызова, счётчики вызовов точные
+SAMPLE_EVERY = 8
+_SAMPLE_MASK = SAMPLE_EVERY - 1
+
+# Контролы виртуального устройства с метриками: (имя, заголовок, единицы)
+METRICS_CONTROLS = (
+    ("messages_in", "Messages in", None),
+    ("messages_in_rate", "Messages in rate", "msg/s"),
+    ("watch_messages", "Cache updates", None),
+    ("callback_calls", "Callback calls", None),
+    ("callback_errors", "Callback errors", None),
+    ("callback_p99", "Callback time p99", "ms"),
+    ("messages_out", "Messages out", None),
+    ("outbound_backlog", "Outbound backlog", None),
+    ("callback_queue", "Callback queue", None),
+    ("reconnects", "Reconnects", None),
+    ("uptime", "Uptime", "s"),
+)
+
+
+def _bucket(seconds):
+    if seconds <= 0:
+        return 0
+    mantissa, exponent = math.frexp(seconds)
+    if exponent < _MIN_EXPONENT:
+        return 0
+    if exponent > _MAX_EXPONENT:
+        return _BUCKETS - 1
+    return (exponent - _MIN_EXPONENT) * _SUBBUCKETS + int(
+        (mantissa - 0.5) * 2 * _SUBBUCKETS
+    )
+
+
+def _bucket_bound(index):
+    exponent, sub = divmod(index, _SUBBUCKETS)
+    return math.ldexp(0.5 + (sub + 1) / (2.0 * _SUBBUCKETS), exponent + _MIN_EXPONENT)
+
+
+class Histogram:
+    """Гистограмма времени выполнения с логарифмическими корзинами.
+    Запись — одно сложение в списке, без блокировок.
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Учёт одного измерения в секундах"""
+
+        self.counts[_bucket(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """Добавление измерений другой гистограммы"""
+
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, share):
+        """Перцентиль по верхней границе корзины
+
+        Args:
+            share (float): Доля от 0 до 1, например 0.99
+
+        Returns:
+            float: Время в секундах или None, если измерений нет
+        """
+
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(share * self.count)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_bound(index), self.max)
+        return self.max
+
+    def as_dict(self):
+        """Сводка гистограммы. Времена в секундах."""
+
+        return {
+            "samples": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max if self.count else None,
+        }
+
+
+class RouteStats:
+    """Счётчики фильтра в дереве маршрутов"""
+
+    __slots__ = ("pattern", "kind", "calls", "time")
+
+    def __init__(self, pattern, kind):
+        self.pattern = pattern
+        self.kind = kind
+        self.calls = 0
+        self.time = Histogram()
+
+
+class CallbackStats:
+    """Счётчики пользовательского обработчика"""
+
+    __slots__ = ("name", "calls", "errors", "time")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.time = Histogram()
+
+
+def callback_name(callback):
+    """Имя обработчика для отчёта: модуль и полное имя функции"""
+
+    name = getattr(callback, "__qualname__", None) or repr(callback)
+    module = getattr(callback, "__module__", None)
+    if module:
+        return "%s.%s" % (module, name)
+    return name
+
+
+class Metrics:
+    """Счётчики и гистограммы времени выполнения по фильтрам подписок и обработчикам.
+
+    Счётчики обновляются без блокировок: при одновременном выполнении
+    одного обработчика в нескольких потоках возможны редкие потери отсчётов.
+    Счётчики обработчиков ведутся по имени, поэтому замыкания, создаваемые
+    на каждую подписку, не накапливаются.
+    """
+
+    # Размер кэша счётчиков по объекту обработчика, при переполнении кэш очищается
+    cache_limit = 1024
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.messages_in = 0
+        self.messages_out = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.routes = {}
+        # Счётчики по имени обработчика и кэш {обработчик: счётчики} для быстрого поиска
+        self.callbacks = {}
+        self.by_callback = {}
+
+    def bind_route(self, handler, pattern, key):
+        """Учёт обработчика, регистрируемого в дереве маршрутов
+
+        Args:
+            handler (function): Обработчик с параметрами client, userdata, msg
+            pattern (string): MQTT-фильтр
+            key (string): Ключ обработчика: watch, user, virtual и т. д.
+
+        Returns:
+            function: Обработчик с замером времени выполнения, его и нужно регистрировать
+        """
+
+        route = RouteStats(pattern, key)
+        self.routes[(pattern, key)] = route
+        observe = route.time.observe
+        clock = time.perf_counter
+
+        def timed(client, userdata, msg):
+            route.calls += 1
+            if route.calls & _SAMPLE_MASK:
+                return handler(client, userdata, msg)
+            started = clock()
+            try:
+                handler(client, userdata, msg)
+            finally:
+                observe(clock() - started)
+
+        return timed
+
+    def unbind_route(self, pattern, key):
+        """Удаление счётчиков обработчика, удалённого из дерева маршрутов"""
+
+        self.routes.pop((pattern, key), None)
+
+    def callback(self, callback):
+        """Счётчики обработчика, создаются при первом вызове.
+            Обработчики с одинаковым именем учитываются вместе.
+
+        Returns:
+            CallbackStats: Счётчики
+        """
+
+        stats = self.by_callback.get(callback)
+        if stats is not None:
+            return stats
+
+        name = callback_name(callback)
+        stats = self.callbacks.get(name)
+        if stats is None:
+            stats = self.callbacks[name] = CallbackStats(name)
+        if len(self.by_callback) >= self.cache_limit:
+            self.by_callback = {}
+        self.by_callback[callback] = stats
+        return stats
+
+    def reset_callbacks(self):
+        """Сброс счётчиков обработчиков, например перед воспроизведением журнала"""
+
+        self.callbacks = {}
+        self.by_callback = {}
+
+    def run(self, stats, callback, args):
+        """Вызов обработчика с выборочным замером времени выполнения"""
+
+        stats.calls += 1
+        sampled = not stats.calls & _SAMPLE_MASK
+        if sampled:
+            started = time.perf_counter()
+        try:
+            callback(*args)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            if sampled:
+                stats.time.observe(time.perf_counter() - started)
+
+    async def run_async(self, stats, coroutine):
+        """Выполнение корутины обработчика с замером времени до её завершения"""
+
+        stats.calls += 1
+        started = time.perf_counter()
+        try:
+            await coroutine
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.time.observe(time.perf_counter() - started)
+
+    def stats(self):
+        """Сводка по фильтрам и обработчикам
+
+        Returns:
+            dict: Общие счётчики, routes {фильтр: {ключ: сводка}}, callbacks {имя: сводка}
+        """
+
+        routes = {}
+        for route in list(self.routes.values()):
+            by_kind = routes.setdefault(route.pattern, {})
+            summary = by_kind.get(route.kind)
+            if summary is None:
+                summary = by_kind[route.kind] = [0, 0, Histogram()]
+            summary[0] += route.calls
+            summary[2].merge(route.time)
+
+        callbacks = {
+            stats.name: [stats.calls, stats.errors, stats.time]
+            for stats in list(self.callbacks.values())
+        }
+
+        total = [0, 0, Histogram()]
+        for calls, errors, histogram in callbacks.values():
+            total[0] += calls
+            total[1] += errors
+            total[2].merge(histogram)
+
+        return {
+            "uptime": time.monotonic() - self.started,
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "reconnects": max(0, self.connects - 1),
+            "callback_calls": total[0],
+            "callback_errors": total[1],
+            "callback_time": total[2].as_dict(),
+            "routes": {
+                pattern: {kind: _summary(*summary) for kind, summary in by_kind.items()}
+                for pattern, by_kind in routes.items()
+            },
+            "callbacks": {
+                name: _summary(*summary) for name, summary in callbacks.items()
+            },
+        }
+
+
+def _summary(calls, errors, histogram):
+    result = histogram.as_dict()
+    result["calls"] = calls
+    result["errors"] = errors
+    return result
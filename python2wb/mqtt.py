@@ -1,14 +1,40 @@
 import paho.mqtt.client as mqtt
 import json
 import atexit
+import collections
+import datetime
+import itertools
+import threading
+import time
+import traceback
+import uuid
+
+from .topics import TopicTrie, BrokerSubscriptions, topic_covers
+from .executor import CallbackExecutor
+from .processes import ProcessExecutor, RPC_SET, RPC_PUBLISH, RPC_GET
+from .publisher import OutboundQueue, OfflineQueue, PipelinedPublisher
+from .scheduler import Scheduler
+from .cache import ControlCache, parse_value
+from .filters import ChangeFilter, ACCEPT, REJECT
+from .registry import VirtualDeviceRegistry
+from .snapshot import load_snapshot, save_snapshot
+from .metrics import Metrics, METRICS_CONTROLS
+from .history import History
+from .commands import Command, CommandError, CommandTracker
+from .meta import MetaIndex, QuerySubscription, check_criteria
+from .rules import Rule, RuleEngine
+from .timers import CronSchedule, TimerHandle
+from .traffic import TrafficRecorder, replay
 
 WB_CONTROLS_PATH = "/devices/%s/controls/%s"
+SYNC_MARKER_PATH = "/python2wb/sync/%s/%s"
+WB_DEVICE_META_PATH = "/devices/+/meta"
+
+# Сколько секунд повторно читать retained /meta устройств при первом обращении к индексу
+META_FETCH_TIME = 5
 
 
 class WbMqtt:
-    controls = {}
-    client = None
-    virtual_devices = []
     qos_pub = 0
     driver_name = ""
 
@@ -23,32 +49,295 @@ class WbMqtt:
         base_subscribe_topic="#",
         client_id=None,
         driver_name="python2wb",
+        workers=0,
+        queue_size=1000,
+        overflow="block",
+        ordering="device",
+        coalesce=False,
+        publish_rate=None,
+        device_rate=None,
+        publish_burst=None,
+        flush_interval=0,
+        on_change=False,
+        deadband=None,
+        min_interval=0,
+        snapshot_path=None,
+        snapshot_interval=60,
+        metrics=False,
+        metrics_interval=0,
+        metrics_device="python2wb-metrics",
+        reconnect_min_delay=0.1,
+        reconnect_max_delay=30,
+        offline_queue=1000,
+        max_inflight=100,
+        rule_delay=0,
+        connect=True,
+        processes=0,
+        process_batch=64,
+        process_latency=0.005,
     ):
         self.qos_pub = qos_pub
+        self.qos_sub = qos_sub
         self.driver_name = driver_name
+        self.controls = ControlCache()
+        self.virtual_devices = VirtualDeviceRegistry()
+        # Описания устройств и контролов из /meta для поиска и подписки по запросу
+        # /meta устройств разбираются только после первого обращения к индексу
+        self.meta = MetaIndex(self._watch_meta)
+        self._meta_watched = False
+        self._meta_queries = {}
+        self._query_seq = itertools.count(1)
+        self._timer_seq = itertools.count(1)
+
+        # Снимок кэша на диске: get() отвечает сразу после запуска,
+        # значения помечены stale до подтверждения брокером
+        self._snapshot_path = snapshot_path
+        self._snapshot_interval = snapshot_interval
+        self._snapshot_seq = 0
+        if snapshot_path:
+            self.controls.load(load_snapshot(snapshot_path))
+
+        # Счётчики входящих сообщений по фильтрам и время выполнения обработчиков.
+        # Отключены по умолчанию, включаются metrics=True или metrics_interval > 0.
+        # При metrics_interval > 0 сводка публикуется виртуальным устройством metrics_device.
+        self._metrics = Metrics() if metrics or metrics_interval else None
+        self._metrics_interval = metrics_interval
+        self._metrics_device = metrics_device
+        self._metrics_last = None
+
+        # Значения по умолчанию для фильтрации доставки в subscribe()
+        self._change_defaults = (on_change, deadband, min_interval)
+
+        # История значений контролов, объявленных через track(): {путь к контролу: History}
+        self._histories = {}
+
+        # Журнал входящих сообщений record() для воспроизведения через replay()
+        self._recorder = None
+
+        # Команды set_and_confirm(), ожидающие значения в топике состояния контрола
+        self._commands = CommandTracker()
+
+        # Правила rule(): изменения входов за rule_delay секунд вычисляются одной пачкой
+        self._rule_delay = rule_delay
+        self._rules = RuleEngine(
+            self.controls.entry,
+            self._publish,
+            self.controls.convert,
+            self._schedule_rules,
+        )
+
+        # Все входящие сообщения маршрутизируются через одно дерево фильтров,
+        # а у брокера подписываемся только на нужные топики с подсчётом ссылок.
+        # base_subscribe_topic=None включает режим точечных подписок вместо "#":
+        # обработчики кэша есть в дереве, но у брокера запрашиваются только контролы
+        # из подписок, track(), правил и set_and_confirm() вместе с их /meta.
+        self._targeted = not base_subscribe_topic
+        self._routes = TopicTrie()
+        self._broker_subscriptions = BrokerSubscriptions()
+        self._connected = False
+        self._connected_event = threading.Event()
+        self._connect_started = time.monotonic()
+        self._synced_at = None
+        self._sync_id = uuid.uuid4().hex[:12]
+        self._sync_seq = itertools.count(1)
+        self._loop_running = False
+        self._network_thread = None
+        self._lock = threading.RLock()
+
+        # Временные подписки для чтения retained-сообщений: retained-сообщения
+        # под их фильтрами получают только они, а не обработчики из self._routes
+        self._fetch_routes = TopicTrie()
+        self._fetches = []
+
+        # Без пула обработчики сообщений и таймеров выполняются по одному: вызов,
+        # который застал блокировку занятой, ставится в очередь и выполняется
+        # её владельцем, так что ни сетевой поток, ни планировщик не ждут друг друга
+        self._soon = collections.deque()
+        self._dispatch_lock = threading.Lock()
+
+        if base_subscribe_topic:
+            self._broker_subscriptions.acquire(base_subscribe_topic)
+
+        # При workers > 0 пользовательские обработчики выполняются в пуле потоков,
+        # а сетевой поток только разбирает сообщение и ставит его в очередь.
+        # ordering: device — порядок сохраняется в пределах устройства, control — в пределах контрола.
+        self._ordering = ordering
+        # При processes > 0 обработчики выполняются в процессах, созданных через fork,
+        # с тем же распределением по ключу. Вызовы передаются пачками, set(),
+        # publish_raw() и get() из процессов выполняются через подключение родителя.
+        self._processes = processes
+        if processes:
+            self._executor = ProcessExecutor(
+                processes,
+                lambda delay, callback, *args: self._scheduler.call_later(
+                    delay, callback, *args
+                ),
+                {RPC_SET: self.set, RPC_PUBLISH: self.publish_raw, RPC_GET: self.get},
+                target=self,
+                batch_size=process_batch,
+                batch_latency=process_latency,
+            )
+        elif workers:
+            self._executor = CallbackExecutor(workers, queue_size, overflow)
+        else:
+            self._executor = None
+
+        # Исходящая очередь для set() и publish_raw(): последнее значение топика
+        # заменяет ещё не отправленное, частота ограничивается общим и
+        # поустройственным token bucket, значения собираются за flush_interval.
+        self._scheduler = self._create_scheduler()
+        self._flush_timer = None
+        if coalesce or publish_rate or device_rate or flush_interval:
+            self._outbound = OutboundQueue(
+                self._publish_online,
+                rate=publish_rate,
+                device_rate=device_rate,
+                burst=publish_burst,
+                flush_interval=flush_interval,
+            )
+        else:
+            self._outbound = None
+
+        # Пока нет подключения, set() и publish_raw() копятся в очереди с объединением
+        # по топику и отправляются при подключении. При переподключении подписки
+        # и retained-состояние виртуальных устройств восстанавливаются одной пачкой.
+        self._offline = OfflineQueue(offline_queue) if offline_queue else None
+        self._online = False
+        self._sessions = 0
+        self._reconnect_delays = (reconnect_min_delay, reconnect_max_delay)
+
+        if snapshot_path and snapshot_interval:
+            self._scheduler.call_later(snapshot_interval, self._snapshot_timer)
 
         def on_connect(client, userdata, flags, rc):
             """Событие, которое возникает после подключения к брокеру"""
 
             print("Connected with result code %s." % str(rc))
-            client.subscribe(base_subscribe_topic, qos=qos_sub)
-            client.message_callback_add(
-                WB_CONTROLS_PATH % ("+", "+"), self._watch_control
-            )
+            with self._lock:
+                self._connected = rc == 0
+                topics = self._broker_subscriptions.active()
+            if self._connected and topics:
+                client.subscribe([(topic, self.qos_sub) for topic in topics])
+            if self._connected:
+                self._on_connected()
 
         def on_disconnect(client, userdata, rc=0):
             """Событие, которое возникает после отключения от брокера"""
 
             print("Disconnected result code %s." % str(rc))
+            self._on_disconnected(rc)
 
         self.client = mqtt.Client(client_id=client_id)
         self.client.on_connect = on_connect
+        self.client.on_disconnect = on_disconnect
+        self.client.on_message = self._on_message
+        # Экспоненциальная задержка переподключения в сетевом цикле paho
+        self.client.reconnect_delay_set(reconnect_min_delay, reconnect_max_delay)
+        # Лимит неподтверждённых QoS 1/2 сообщений paho, он же ограничивает окно
+        # пакетной публикации в provision_virtual_device()
+        self.client.max_inflight_messages_set(max_inflight)
+        self._add_route(
+            WB_CONTROLS_PATH % ("+", "+"),
+            self._watch_control,
+            "watch",
+            subscribe=not self._targeted,
+        )
+        self._add_route(
+            WB_CONTROLS_PATH % ("+", "+") + "/meta",
+            self._watch_control_meta,
+            "watch",
+            subscribe=not self._targeted,
+        )
+        self._add_route(
+            WB_CONTROLS_PATH % ("+", "+") + "/meta/type",
+            self._watch_control_meta,
+            "watch",
+            subscribe=not self._targeted,
+        )
 
         if username != None and password != None:
             self.client.username_pw_set(username, password)
 
+        # connect=False — клиент без брокера, например для replay()
+        if connect:
+            self._connect(server_url, port)
+
+        if self._metrics is not None and metrics_interval:
+            self._scheduler.call_later(0, self._metrics_timer)
+
+    def _create_scheduler(self):
+        """Внутреннее. Планировщик отложенных вызовов"""
+
+        return Scheduler()
+
+    def _connect(self, server_url, port):
+        """Внутреннее. Подключение к брокеру
+
+        Args:
+            server_url (string): Адрес брокера
+            port (int): Порт брокера
+        """
+
+        self._connect_started = time.monotonic()
         self.client.connect(server_url, port, 60)
 
+    def _on_connected(self):
+        """Внутреннее. Вызывается после успешного подключения и отправки подписок.
+        При переподключении публикует retained-состояние виртуальных устройств,
+        затем значения, накопленные без подключения.
+        """
+
+        if self._metrics is not None:
+            self._metrics.connects += 1
+
+        if self._sessions:
+            messages = self._virtual_device_messages()
+            for topic, payload in messages:
+                self._publish_now(topic, payload, self.qos_pub, True)
+        self._sessions += 1
+
+        with self._lock:
+            if self._offline is not None:
+                for topic, payload, qos, retain in self._offline.take():
+                    self._publish_now(topic, payload, qos, retain)
+            self._online = True
+
+        self._connected_event.set()
+
+    def _on_disconnected(self, rc):
+        """Внутреннее. Вызывается после отключения от брокера"""
+
+        with self._lock:
+            self._connected = False
+            self._online = False
+        self._connected_event.clear()
+        if self._metrics is not None:
+            self._metrics.disconnects += 1
+
+    def _virtual_device_messages(self):
+        """Внутреннее. Retained-состояние всех виртуальных устройств для восстановления
+            после переподключения: описания устройств и контролов и последние значения
+
+        Returns:
+            list: Пары (топик, значение)
+        """
+
+        messages = []
+        for device in self.virtual_devices.devices():
+            device_id = device.device_id
+            messages.append(
+                ("/devices/%s/meta" % (device_id), self._device_meta(device.title))
+            )
+            values = device.values
+            for name, control in list(device.controls.items()):
+                meta, meta_type, value = self._control_messages(device_id, control)
+                # Последнее значение в исходном виде: типизированное из кэша
+                # опубликовалось бы иначе, например "7" как "7.0"
+                if values.get(name) is not None:
+                    value = (value[0], values[name])
+                messages.extend((meta, meta_type, value))
+        return messages
+
     def get(self, control_path):
         """Получение значения контрола.
 
@@ -57,10 +346,22 @@ class WbMqtt:
 
         Returns:
             float, int, str: Значение контрола, храняшее в словаре контролов self.controls.
-            # Преобразуется из строки в нужный тип.
+            # Преобразуется в нужный тип один раз при получении. None, если значения ещё нет.
+        """
+
+        return self.controls.get(control_path)
+
+    def get_entry(self, control_path):
+        """Получение записи кэша контрола
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+
+        Returns:
+            ControlValue: Значение, время получения и порядковый номер обновления или None
         """
 
-        return self.parse_value(self.controls.get(control_path))
+        return self.controls.entry(control_path)
 
     def set(self, control_path, value):
         """Запись значения в контрол.
@@ -76,14 +377,558 @@ class WbMqtt:
         except Exception as e:
             raise e
 
+    def set_and_confirm(self, control_path, value, timeout=5, tolerance=0):
+        """Запись значения в контрол с ожиданием подтверждения устройством:
+            значение должно прийти в топик состояния контрола.
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            value (float, int, str): Новое значение контрола
+            timeout (float, optional): Время ожидания подтверждения в секундах
+            tolerance (float, optional): Допустимое отклонение числового значения,
+                например для устройств, округляющих значение при записи
+
+        Returns:
+            float, int, str: Подтверждённое значение
+
+        Raises:
+            TimeoutError: Подтверждение не пришло за timeout секунд
+            CommandError: Устройство сообщило об ошибке записи в /meta/error
+            RuntimeError: Вызов из обработчика, выполняемого в сетевом потоке:
+                подтверждение разбирает этот же поток
+        """
+
+        if self._on_network_thread():
+            raise RuntimeError(
+                "Commands can not wait for confirmation on the network thread, "
+                "use workers or call it outside of callbacks"
+            )
+
+        event = threading.Event()
+        command = self._start_command(control_path, value, tolerance, event.set)
+        try:
+            self._publish(control_path, value)
+            if not self._wait_event(event, command.sent + timeout):
+                raise TimeoutError(
+                    "%s did not confirm %r in %s s" % (control_path, value, timeout)
+                )
+        finally:
+            self._finish_command(command)
+        return self._command_result(command)
+
+    def command_stats(self):
+        """Статистика команд set_and_confirm() по устройствам
+
+        Returns:
+            dict: {устройство: сводка времени подтверждения с confirmed, errors, timeouts}.
+                Времена в секундах.
+        """
+
+        return self._commands.stats()
+
+    def _start_command(self, control_path, value, tolerance, notify):
+        """Внутреннее. Регистрация команды до отправки значения,
+            чтобы не пропустить быстрый ответ устройства
+
+        Returns:
+            Command: Команда
+        """
+
+        expected = self.controls.convert(control_path, str(value))
+        command = Command(control_path, expected, tolerance, notify)
+        with self._lock:
+            if self._commands.add(command):
+                self._add_route(
+                    self._control_topic(control_path, "errors"),
+                    self._watch_command_error,
+                    "command",
+                )
+                # Подтверждение приходит в топик состояния контрола
+                self._watch(control_path)
+        return command
+
+    def _finish_command(self, command):
+        """Внутреннее. Снятие с ожидания неподтверждённой команды"""
+
+        if self._commands.discard(command):
+            self._release_command_route(command.control_path)
+
+    def _release_command_route(self, control_path):
+        """Внутреннее. Отписка от /meta/error контрола без ожидающих команд"""
+
+        with self._lock:
+            if control_path not in self._commands.pending:
+                if self._remove_route(
+                    self._control_topic(control_path, "errors"), "command"
+                ):
+                    self._unwatch(control_path)
+
+    def _command_result(self, command):
+        """Внутреннее. Результат завершённой команды
+
+        Raises:
+            CommandError: Устройство сообщило об ошибке записи
+        """
+
+        if command.error is not None:
+            raise CommandError(command.control_path, command.error)
+        return command.value
+
     # Получение списка всех контролов
     def get_all(self):
         """Получение списка всех контролов
 
         Returns:
-            dict: Содержимое словаря self.controls
+            dict: Копия словаря self.controls с типизированными значениями
+        """
+        return self.controls.copy()
+
+    def track(self, control_path, window=None, capacity=1024):
+        """Хранение истории значений контрола для агрегатов по окну времени:
+            mean, min, max, slope. История заполняется при получении значений.
+
+        Args:
+            control_path (string, list): Путь к контролу в формате 'device/control' или список путей
+            window (float, optional): Окно запросов по умолчанию в секундах.
+                По умолчанию запросы охватывают всю историю.
+            capacity (int, optional): Максимальное число хранимых значений контрола
+
+        Returns:
+            History, list: История контрола или список историй для списка путей
+        """
+
+        if type(control_path) == list:
+            return [self.track(control, window, capacity) for control in control_path]
+
+        with self._lock:
+            history = self._histories.get(control_path)
+            if history is not None:
+                history.window = window
+                return history
+
+            history = History(capacity, window)
+            entry = self.controls.entry(control_path)
+            if entry is not None and not entry.stale:
+                history.append(entry.timestamp, entry.value)
+            # Словарь заменяется целиком, чтобы сетевой поток читал его без блокировки
+            histories = dict(self._histories)
+            histories[control_path] = history
+            self._histories = histories
+            self._watch(control_path)
+        return history
+
+    def untrack(self, control_path):
+        """Отказ от хранения истории контрола
+
+        Args:
+            control_path (string, list): Путь к контролу в формате 'device/control' или список путей
+        """
+
+        if type(control_path) == list:
+            for control in control_path:
+                self.untrack(control)
+            return
+
+        with self._lock:
+            if control_path in self._histories:
+                histories = dict(self._histories)
+                del histories[control_path]
+                self._histories = histories
+                self._unwatch(control_path)
+
+    def history(self, control_path):
+        """История контрола, объявленного через track()
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+
+        Returns:
+            History: История или None, если контрол не отслеживается
+        """
+
+        return self._histories.get(control_path)
+
+    def rule(self, inputs, outputs=None, name=None):
+        """Декоратор правила: функция вызывается со значениями inputs по порядку,
+            когда хотя бы одно из них изменилось, а результат пишется в outputs.
+
+            Правило с одним выходом возвращает значение, с несколькими — кортеж
+            по порядку outputs или словарь {выход: значение}. None не меняет выход.
+            Выход публикуется, только если значение отличается от текущего.
+            Выходы правила сразу видны правилам, зависящим от них.
+
+        Args:
+            inputs (string, list): Пути входных контролов в формате 'device/control'
+            outputs (string, list, optional): Пути выходных контролов
+            name (string, optional): Имя правила. По умолчанию имя функции.
+
+        Returns:
+            function: Декоратор, возвращающий функцию без изменений
+
+        Raises:
+            ValueError: Правило замыкает цикл через выходы других правил
+                или в путях есть символы подстановки
+        """
+
+        if type(inputs) != list:
+            inputs = [inputs]
+        if outputs is None:
+            outputs = []
+        elif type(outputs) != list:
+            outputs = [outputs]
+        for path in inputs + outputs:
+            if "+" in path or "#" in path:
+                raise ValueError("Rule paths can not contain wildcards: %s" % (path))
+
+        def decorator(func):
+            rule = Rule(func, inputs, outputs, name)
+            with self._lock:
+                self._rules.add(rule)
+                for path in set(rule.inputs + rule.outputs):
+                    self._watch(path)
+            return func
+
+        return decorator
+
+    def remove_rule(self, func):
+        """Удаление правил, объявленных с функцией func
+
+        Returns:
+            int: Количество удалённых правил
+        """
+
+        with self._lock:
+            removed = [rule for rule in self._rules.rules() if rule.func is func]
+            self._rules.remove(func)
+            for rule in removed:
+                for path in set(rule.inputs + rule.outputs):
+                    self._unwatch(path)
+        return len(removed)
+
+    def call_later(self, delay, callback, *args):
+        """Однократный вызов функции через delay секунд.
+            Таймеры обслуживает один планировщик на куче, без потока на таймер.
+            Обработчики выполняются там же, где обработчики сообщений: в пуле
+            при workers > 0, в цикле событий AsyncWbMqtt, иначе по очереди
+            с обработчиками сообщений, не одновременно с ними.
+
+        Args:
+            delay (float): Задержка в секундах
+            callback (function): Функция
+            *args: Аргументы функции
+
+        Returns:
+            obj: Таймер с методом cancel()
+        """
+
+        self._register_callback(callback)
+        return self._scheduler.call_later(
+            delay, self._call_deferred, self._call, callback, callback, args
+        )
+
+    def every(self, interval, callback, *args):
+        """Периодический вызов функции каждые interval секунд без накопления сдвига.
+            Если вызов опоздал больше чем на интервал, пропущенные вызовы не догоняются.
+
+        Args:
+            interval (float): Период в секундах
+            callback (function): Функция
+            *args: Аргументы функции
+
+        Returns:
+            TimerHandle: Таймер с методом cancel()
         """
-        return self.controls
+
+        if interval <= 0:
+            raise ValueError("Interval must be positive: %s" % (interval))
+
+        scheduler = self._scheduler
+        handle = TimerHandle()
+        self._register_callback(callback)
+
+        def tick(due):
+            if handle.cancelled:
+                return
+            now = scheduler.time()
+            due += interval
+            if due <= now:
+                due += ((now - due) // interval + 1) * interval
+            handle.timer = scheduler.call_at(due, self._call_deferred, tick, due)
+            handle.calls += 1
+            self._call(callback, callback, args)
+
+        due = scheduler.time() + interval
+        handle.timer = scheduler.call_at(due, self._call_deferred, tick, due)
+        return handle
+
+    def cron(self, expression, callback, *args):
+        """Вызов функции по расписанию cron по местному времени
+
+        Args:
+            expression (string): Выражение из пяти полей, например '*/5 * * * *',
+                '30 7 * * 1-5', или псевдоним '@hourly', '@daily'
+            callback (function): Функция
+            *args: Аргументы функции
+
+        Returns:
+            TimerHandle: Таймер с методом cancel()
+
+        Raises:
+            ValueError: Выражение не разобрано
+        """
+
+        schedule = CronSchedule(expression)
+        handle = TimerHandle()
+        self._register_callback(callback)
+        last = [datetime.datetime.now()]
+
+        def arm():
+            now = datetime.datetime.now()
+            # Таймер может сработать чуть раньше: следующее время ищется после прошлого
+            moment = schedule.next_after(max(now, last[0]))
+            last[0] = moment
+            delay = (moment - now).total_seconds()
+            handle.timer = self._scheduler.call_later(delay, self._call_deferred, fire)
+
+        def fire():
+            if handle.cancelled:
+                return
+            arm()
+            handle.calls += 1
+            self._call(callback, callback, args)
+
+        arm()
+        return handle
+
+    def debounce(self, control_path, delay, callback):
+        """Вызов обработчика, когда значение контрола не меняется delay секунд,
+            например для дребезга кнопок или «выключить через 10 минут без движения».
+            Повторы того же значения при опросе таймер не сбрасывают.
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control', можно с '+'
+            delay (float): Время без изменений в секундах
+            callback (function): Обработчик события, параметры device_id, control_id, new_value
+
+        Returns:
+            TimerHandle: Таймер с методом cancel(), отменяет и подписку
+        """
+
+        scheduler = self._scheduler
+        topic = self._control_topic(control_path)
+        key = "debounce:%d" % next(self._timer_seq)
+        # Состояние контролов: [значение, срок, таймер запланирован]
+        states = {}
+        lock = threading.Lock()
+
+        def on_value(client, userdata, msg):
+            device_id, control_id, path, _ = self.controls.resolve(msg.topic)
+            entry = self.controls.entry(path)
+            value = entry.value if entry is not None else None
+            with lock:
+                state = states.get(path)
+                if state is not None and state[0] == value:
+                    return
+                if state is None:
+                    state = states[path] = [value, 0.0, False]
+                state[0] = value
+                state[1] = scheduler.time() + delay
+                if state[2]:
+                    # Таймер уже запланирован и перенесёт себя на новый срок
+                    return
+                state[2] = True
+            scheduler.call_at(
+                state[1], self._call_deferred, expire, device_id, control_id, path
+            )
+
+        def expire(device_id, control_id, path):
+            if handle.cancelled:
+                return
+            with lock:
+                state = states[path]
+                if scheduler.time() < state[1]:
+                    deadline = state[1]
+                else:
+                    state[2] = False
+                    deadline = None
+                    value = state[0]
+            if deadline is not None:
+                scheduler.call_at(
+                    deadline, self._call_deferred, expire, device_id, control_id, path
+                )
+                return
+            handle.calls += 1
+            self._call(
+                device_id if self._ordering == "device" else path,
+                callback,
+                (device_id, control_id, value),
+                path,
+            )
+
+        handle = TimerHandle(lambda: self._remove_route(topic, key))
+        self._register_callback(callback)
+        self._add_route(topic, on_value, key)
+        return handle
+
+    def throttle(self, control_path, interval, callback):
+        """Вызов обработчика не чаще раза в interval секунд: первое значение
+            доставляется сразу, по истечении интервала — последнее пришедшее
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control', можно с '+'
+            interval (float): Минимальный интервал между вызовами в секундах
+            callback (function): Обработчик события, параметры device_id, control_id, new_value
+
+        Returns:
+            TimerHandle: Таймер с методом cancel(), отменяет и подписку
+        """
+
+        topic = self._control_topic(control_path)
+        key = "throttle:%d" % next(self._timer_seq)
+        self._subscribe(
+            control_path,
+            callback,
+            key=key,
+            change_filter=ChangeFilter(False, None, interval),
+        )
+        return TimerHandle(lambda: self._remove_route(topic, key))
+
+    def subscribe_batch(
+        self, control_path, callback, max_items=1000, max_latency=0.1, columnar=False
+    ):
+        """Доставка значений пачками для обработчиков с большим потоком сообщений,
+            например экспорта в базу данных. Значение берётся из кэша, где оно уже
+            разобрано, и добавляется в пачку без вызова обработчика на каждое
+            сообщение. Пачка передаётся, когда в ней max_items значений или
+            через max_latency секунд после первого значения.
+
+        Args:
+            control_path (string, list): Путь к контролу в формате 'device/control',
+                можно с '+', или список путей
+            callback (function): Обработчик пачки. Параметр — список кортежей
+                (device_id, control_id, new_value, timestamp), при columnar=True —
+                словарь списков с ключами device_id, control_id, value, timestamp
+            max_items (int, optional): Максимальный размер пачки
+            max_latency (float, optional): Максимальная задержка значения в пачке в секундах
+            columnar (bool, optional): Передавать пачку по столбцам
+
+        Returns:
+            TimerHandle: Объект с методом cancel(), отменяет подписку и доставляет
+                накопленную пачку. В calls — количество доставленных пачек.
+        """
+
+        paths = control_path if type(control_path) == list else [control_path]
+        topics = [self._control_topic(path) for path in paths]
+        key = "batch:%d" % next(self._timer_seq)
+        scheduler = self._scheduler
+        resolve = self.controls.resolve
+        entry_of = self.controls.entry
+        max_items = max(1, max_items)
+        lock = threading.Lock()
+        # Накапливаемая пачка и таймер max_latency её первого значения
+        pending = [[], None]
+
+        def on_value(client, userdata, msg):
+            # Значение уже записано в кэш в _watch_control
+            device_id, control_id, path, _ = resolve(msg.topic)
+            entry = entry_of(path)
+            if entry is None:
+                return
+            with lock:
+                batch = pending[0]
+                batch.append((device_id, control_id, entry.value, entry.timestamp))
+                if len(batch) < max_items:
+                    if len(batch) == 1:
+                        pending[1] = scheduler.call_later(
+                            max_latency, self._call_deferred, expire, batch
+                        )
+                    return
+                pending[0] = []
+                timer = pending[1]
+                pending[1] = None
+                # Передача под блокировкой: пачки встают в очередь в порядке сборки
+                deliver(batch)
+            if timer is not None:
+                timer.cancel()
+
+        def expire(batch):
+            with lock:
+                if pending[0] is not batch:
+                    return
+                pending[0] = []
+                pending[1] = None
+                deliver(batch)
+
+        def deliver(batch):
+            if not batch:
+                return
+            handle.calls += 1
+            if columnar:
+                device_ids, control_ids, values, timestamps = zip(*batch)
+                batch = {
+                    "device_id": list(device_ids),
+                    "control_id": list(control_ids),
+                    "value": list(values),
+                    "timestamp": list(timestamps),
+                }
+            self._call(key, callback, (batch,))
+
+        def cancel():
+            for topic in topics:
+                self._remove_route(topic, key)
+            self._call_deferred(expire, pending[0])
+
+        handle = TimerHandle(cancel)
+        self._register_callback(callback)
+        for topic in topics:
+            self._add_route(topic, on_value, key)
+        return handle
+
+    def record(self, path):
+        """Запись всех входящих сообщений в двоичный журнал для воспроизведения
+            через replay(). Запись дописывается в конец файла.
+
+        Args:
+            path (string): Путь к файлу журнала
+
+        Returns:
+            TrafficRecorder: Журнал, количество записанных сообщений в messages
+        """
+
+        recorder = TrafficRecorder(path)
+        previous = self._recorder
+        self._recorder = recorder
+        if previous is not None:
+            previous.close()
+        return recorder
+
+    def stop_recording(self):
+        """Завершение записи журнала"""
+
+        recorder = self._recorder
+        self._recorder = None
+        if recorder is not None:
+            recorder.close()
+
+    def replay(self, path, speed=1.0):
+        """Воспроизведение журнала record() без брокера тем же путём, что и
+            входящие сообщения: кэш, подписки, правила и таймеры
+
+        Args:
+            path (string): Путь к файлу журнала
+            speed (float, optional): 1 — реальное время, 10 — в 10 раз быстрее,
+                0 или None — максимально быстро
+
+        Returns:
+            dict: Пропускная способность, время разбора сообщений и обработчиков
+        """
+
+        return replay(self, path, speed)
+
+    def _schedule_rules(self, callback):
+        """Внутреннее. Планирование вычисления пачки правил"""
+
+        self._scheduler.call_later(self._rule_delay, callback)
 
     def _publish(self, control_path, value):
         """Внутреннее. Команда отправки значения в MQTT.
@@ -92,6 +937,9 @@ class WbMqtt:
             control_path (string): Путь к контролу в формате 'device/control'
             value (float, int, str): Новое значение контрола, которое будет опубликовано в MQTT
 
+        Returns:
+            obj: MQTTMessageInfo опубликованного сообщения или None, если значение поставлено в очередь
+
         Raises:
             e: Сообщение об ошибке
         """
@@ -103,32 +951,104 @@ class WbMqtt:
         try:
             if device_id in self.virtual_devices:
                 topic = WB_CONTROLS_PATH % (device_id, control_id)
-                self.client.publish(topic, payload=value, qos=self.qos_pub, retain=True)
+                self.virtual_devices.set_value(device_id, control_id, value)
+                return self._send(topic, value, True, device_id)
             else:
                 topic = WB_CONTROLS_PATH % (device_id, control_id) + "/on"
-                self.client.publish(
-                    topic, payload=value, qos=self.qos_pub, retain=False
-                )
+                return self._send(topic, value, False, device_id)
         except Exception as e:
             raise e
 
-    def _subscribe(self, control_path, callback, mode="value"):
+    def _send(self, topic, payload, retain, device_id=None):
+        """Внутреннее. Отправка сразу или через исходящую очередь
+
+        Args:
+            topic (string): Полный путь к mqtt-топику
+            payload (float, int, str): Значение
+            retain (bool): Retain-флаг
+            device_id (string, optional): Устройство для ограничения частоты
+
+        Returns:
+            obj: MQTTMessageInfo или None, если значение поставлено в очередь
+        """
+
+        if self._outbound is None:
+            return self._publish_online(topic, payload, self.qos_pub, retain)
+
+        self._outbound.offer(topic, payload, self.qos_pub, retain, device_id)
+        self._schedule_flush(self._outbound.flush_interval)
+
+    def _publish_online(self, topic, payload, qos, retain):
+        """Внутреннее. Публикация, если есть подключение, иначе постановка в очередь
+            до подключения
+
+        Returns:
+            obj: MQTTMessageInfo или None, если значение поставлено в очередь
+        """
+
+        if self._offline is not None and not self._online:
+            with self._lock:
+                if not self._online:
+                    self._offline.offer(topic, payload, qos, retain)
+                    return None
+        return self._publish_now(topic, payload, qos, retain)
+
+    def _publish_now(self, topic, payload, qos, retain):
+        """Внутреннее. Публикация в обход исходящей очереди"""
+
+        if self._metrics is not None:
+            self._metrics.messages_out += 1
+        return self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+
+    def _schedule_flush(self, delay):
+        """Внутреннее. Планирование отправки исходящей очереди, если она ещё не запланирована"""
+
+        with self._lock:
+            if self._flush_timer is None:
+                self._flush_timer = self._scheduler.call_later(
+                    delay, self._flush_outbound
+                )
+
+    def _flush_outbound(self):
+        """Внутреннее. Отправка исходящей очереди по таймеру"""
+
+        with self._lock:
+            self._flush_timer = None
+
+        delay = self._outbound.flush()
+        if delay is not None:
+            self._schedule_flush(max(delay, self._outbound.flush_interval))
+
+    def pending_publishes(self):
+        """Количество значений, ожидающих отправки в исходящей очереди
+            и в очереди до подключения
+
+        Returns:
+            int: Размер очередей. 0, если очереди не используются.
+        """
+
+        pending = 0
+        if self._outbound is not None:
+            pending += len(self._outbound)
+        if self._offline is not None:
+            pending += len(self._offline)
+        return pending
+
+    def _subscribe(
+        self, control_path, callback, mode="value", key="user", change_filter=None
+    ):
         """Подписка на контролы
 
         Args:
             ontrol_path (string): Путь к контролу в формате 'device/control'
             callback (function): Обработчик события, параметры device_id, control_id, new_value
             mode (string): Переключатель режимов. value — подписываемся на значения, errors — на ошибки
+            key (string): Ключ обработчика в дереве маршрутов
+            change_filter (ChangeFilter, optional): Фильтр повторяющихся значений
         """
 
-        items = control_path.split("/")
-
-        if mode == "errors":
-            topic = WB_CONTROLS_PATH % (items[0], items[1]) + "/meta/error"
-        elif mode == "on":
-            topic = WB_CONTROLS_PATH % (items[0], items[1]) + "/on"
-        else:
-            topic = WB_CONTROLS_PATH % (items[0], items[1])
+        topic = self._control_topic(control_path, mode)
+        self._register_callback(callback)
 
         # Декоратор, который преобразует полученные из MQTT данные в понятные
         # абстракции: device_id, control_id, new_value
@@ -141,25 +1061,137 @@ class WbMqtt:
                 userdata (obj): Пользовательские данные
                 msg (obj): Сообщение, содержит топик и значение
             """
-            topic_path_arr = msg.topic.split("/")
-            device_id = topic_path_arr[2]
-            control_id = topic_path_arr[4]
-            control_path = "%s/%s" % (device_id, control_id)
-            new_value = msg.payload.decode()
-            self.write_value_in_dic(control_path, new_value)
+            device_id, control_id, control_path, _ = self.controls.resolve(msg.topic)
+
+            if mode == "value":
+                # Значение уже записано в кэш в _watch_control: его фильтр
+                # '/devices/+/controls/+' в дереве маршрутов всегда срабатывает первым
+                entry = self.controls.entry(control_path)
+                if entry is None:
+                    entry = self.write_value_in_dic(control_path, msg.payload)
+                new_value = entry.value
+            elif mode == "on":
+                new_value = self.controls.convert(control_path, msg.payload)
+            else:
+                new_value = self.parse_value(msg.payload.decode())
+
+            if change_filter is not None:
+                verdict = change_filter.check(control_path, new_value, time.monotonic())
+                if verdict == REJECT:
+                    return
+                if verdict != ACCEPT:
+                    self._scheduler.call_later(
+                        verdict,
+                        self._call_deferred,
+                        deliver_pending,
+                        device_id,
+                        control_id,
+                        control_path,
+                    )
+                    return
+
+            self._call(
+                device_id if self._ordering == "device" else control_path,
+                callback,
+                (device_id, control_id, new_value),
+                control_path,
+            )
 
-            callback(device_id, control_id, self.parse_value(new_value))
+        def deliver_pending(device_id, control_id, control_path):
+            """Доставка значения, отложенного из-за min_interval"""
 
-        self.client.message_callback_add(topic, decorator)
+            ready, new_value = change_filter.take_pending(
+                control_path, time.monotonic()
+            )
+            if ready:
+                self._call(
+                    device_id if self._ordering == "device" else control_path,
+                    callback,
+                    (device_id, control_id, new_value),
+                    control_path,
+                )
 
-    def subscribe(self, control_path, callback):
-        """Обёртка для _subscribe, подписывается на значение"""
+        self._add_route(topic, decorator, key)
 
-        if type(control_path) == list:
+    def subscribe(
+        self, control_path, callback, on_change=None, deadband=None, min_interval=None
+    ):
+        """Обёртка для _subscribe, подписывается на значение
+
+        Args:
+            control_path (string, list, dict): Путь к контролу в формате 'device/control',
+                список путей или запрос к индексу self.meta, например {"type": "temperature"}.
+                Подписка по запросу дополняется контролами, появившимися позже.
+            callback (function): Обработчик события, параметры device_id, control_id, new_value
+            on_change (bool, optional): Вызывать обработчик только при изменении значения
+            deadband (float, int, str, optional): Зона нечувствительности для числовых контролов:
+                абсолютная 0.5 или относительная '2%'. Включает on_change.
+            min_interval (float, optional): Минимальный интервал между вызовами в секундах.
+                По истечении интервала доставляется последнее значение.
+            По умолчанию используются значения, заданные при создании объекта.
+        """
+
+        default_on_change, default_deadband, default_interval = self._change_defaults
+        if on_change is None:
+            on_change = default_on_change
+        if deadband is None:
+            deadband = default_deadband
+        if min_interval is None:
+            min_interval = default_interval
+
+        change_filter = None
+        if on_change or deadband or min_interval:
+            change_filter = ChangeFilter(on_change, deadband, min_interval)
+
+        if type(control_path) == dict:
+            self._subscribe_query(control_path, callback, change_filter)
+        elif type(control_path) == list:
             for control in control_path:
-                self._subscribe(control, callback, mode="value")
+                self._subscribe(
+                    control, callback, mode="value", change_filter=change_filter
+                )
         else:
-            self._subscribe(control_path, callback, mode="value")
+            self._subscribe(
+                control_path, callback, mode="value", change_filter=change_filter
+            )
+
+    def _subscribe_query(self, criteria, callback, change_filter=None):
+        """Внутреннее. Подписка на все контролы, подходящие под запрос к индексу self.meta
+
+        Args:
+            criteria (dict): Условия по полям device, driver, type, units, readonly
+            callback (function): Обработчик события, параметры device_id, control_id, new_value
+            change_filter (ChangeFilter, optional): Фильтр повторяющихся значений
+
+        Raises:
+            ValueError: Неизвестное поле в условиях
+        """
+
+        check_criteria(criteria)
+        self._watch_meta()
+        subscription = QuerySubscription(
+            "query:%d" % next(self._query_seq), dict(criteria), callback, change_filter
+        )
+        with self._lock:
+            queries = dict(self._meta_queries)
+            queries[subscription.key] = subscription
+            self._meta_queries = queries
+            for control_path in self.meta.query(criteria):
+                self._query_add(subscription, control_path)
+
+    def _unsubscribe_query(self, criteria):
+        """Внутреннее. Отписка от всех подписок с такими же условиями запроса"""
+
+        with self._lock:
+            queries = dict(self._meta_queries)
+            for key, subscription in list(queries.items()):
+                if subscription.criteria != criteria:
+                    continue
+                del queries[key]
+                for control_path in subscription.controls:
+                    self._unsubscribe(control_path, key=key)
+                subscription.controls.clear()
+            self._meta_queries = queries
 
     def subscribe_on(self, control_path, callback):
         """Обёртка для _subscribe, подписывается на командный топик /on"""
@@ -179,26 +1211,25 @@ class WbMqtt:
         else:
             self._subscribe(control_path, callback, mode="errors")
 
-    def _unsubscribe(self, control_path, mode="value"):
+    def _unsubscribe(self, control_path, mode="value", key="user"):
         """Отписка от контролов
 
         Args:
             control_path (string): Путь к контролу в формате 'device/control'
             mode (string): Переключатель режимов. value — отписываемся от значений, errors — от ошибок
+            key (string): Ключ обработчика в дереве маршрутов
         """
 
-        items = control_path.split("/")
-        if mode == "errors":
-            topic = WB_CONTROLS_PATH % (items[0], items[1]) + "/meta/error"
-        else:
-            topic = WB_CONTROLS_PATH % (items[0], items[1])
-
-        self.client.message_callback_remove(topic)
+        self._remove_route(self._control_topic(control_path, mode), key)
 
     def unsubscribe(self, control_path):
-        """Обёртка для _unsubscribe, отписывает от значений"""
+        """Обёртка для _unsubscribe, отписывает от значений.
+        Для запроса к индексу self.meta отписывает от всех его контролов.
+        """
 
-        if type(control_path) == list:
+        if type(control_path) == dict:
+            self._unsubscribe_query(control_path)
+        elif type(control_path) == list:
             for control in control_path:
                 self._unsubscribe(control, mode="value")
         else:
@@ -234,9 +1265,12 @@ class WbMqtt:
             msg_topic = msg.topic
             new_value = msg.payload.decode()
 
-            callback(msg_topic, self.parse_value((new_value)))
+            self._call(
+                msg_topic, callback, (msg_topic, self.parse_value(new_value)), msg_topic
+            )
 
-        self.client.message_callback_add(mqtt_topic, decorator)
+        self._register_callback(callback)
+        self._add_route(mqtt_topic, decorator)
 
     def unsubscribe_raw(self, mqtt_topic):
         """Отписка от топика
@@ -245,7 +1279,7 @@ class WbMqtt:
             mqtt_topic (string): Полный путь к mqtt-топику
         """
 
-        self.client.message_callback_remove(mqtt_topic)
+        self._remove_route(mqtt_topic)
 
     def publish_raw(self, mqtt_topic, value, retain=False):
         """Публикация значений в mqtt-топик
@@ -256,30 +1290,644 @@ class WbMqtt:
             retain (bool, optional): Retain-флаг. По умолчанию False.
         """
 
-        self.client.publish(mqtt_topic, payload=value, qos=self.qos_pub, retain=retain)
+        device_id = None
+        if mqtt_topic.startswith("/devices/"):
+            device_id = mqtt_topic.split("/")[2]
+
+        return self._send(mqtt_topic, value, retain, device_id)
 
     def loop_forever(self):
         """Вечный цикл"""
 
-        self.client.loop_forever()
+        self.start_processes()
+        self._loop_running = True
+        self._network_thread = threading.get_ident()
+        try:
+            self.client.loop_forever()
+        finally:
+            self._loop_running = False
 
     def loop_start(self):
         """Запуск"""
 
+        # Процессы создаются до сетевого потока, а не из него при первом сообщении
+        self.start_processes()
+        self._loop_running = True
         self.client.loop_start()
+        # Поток сетевого цикла paho: ожидание сообщений в нём невозможно
+        thread = getattr(self.client, "_thread", None)
+        self._network_thread = thread.ident if thread is not None else None
 
     def loop_stop(self):
         """Останов"""
 
         self.client.loop_stop()
+        self._loop_running = False
 
-    def clear(self):
-        """Очистка виртуальных устройств, подписок и отключение клиента от брокера"""
+    def _pump(self, timeout):
+        """Внутреннее. Ожидание сетевых событий. Если сетевой цикл не запущен,
+            сообщения обрабатываются в текущем потоке.
+
+        Args:
+            timeout (float): Время ожидания в секундах
+        """
+
+        if self._loop_running:
+            time.sleep(timeout)
+        else:
+            self.client.loop(timeout)
+
+    def _on_network_thread(self):
+        """Внутреннее. Вызов из сетевого потока: ждать в нём сообщений нельзя,
+            их разбирает этот же поток
+
+        Returns:
+            bool: True, если сетевой цикл запущен и вызов сделан из его потока
+        """
+
+        return self._loop_running and self._network_thread == threading.get_ident()
+
+    def _start_fetch(self, topic_filter, handler=None):
+        """Внутреннее. Временная подписка для чтения retained-сообщений.
+            Брокер присылает retained-сообщения только в ответ на подписку, поэтому
+            она отправляется, даже если фильтр покрыт другой подпиской. Пока подписка
+            действует, retained-сообщения под её фильтром передаются только ей:
+            обработчики и кэш их уже получили или не подписывались на них.
+
+        Args:
+            topic_filter (string): MQTT-фильтр
+            handler (function, optional): Обработчик каждого полученного сообщения
+
+        Returns:
+            RetainedFetch: Накопитель полученных сообщений
+        """
+
+        fetch = RetainedFetch(topic_filter, handler)
+        with self._lock:
+            self._fetch_routes.add(topic_filter, fetch.on_message, fetch)
+            self._fetches = self._fetches + [fetch]
+        self.client.subscribe(topic_filter, qos=self.qos_sub)
+        return fetch
+
+    def _stop_fetch(self, fetch):
+        """Внутреннее. Отмена временной подписки для чтения retained-сообщений"""
+
+        with self._lock:
+            self._fetch_routes.remove(fetch.topic_filter, fetch)
+            self._fetches = [item for item in self._fetches if item is not fetch]
+            if fetch.topic_filter in self._broker_subscriptions.active():
+                return
+            for other in self._fetches:
+                if other.topic_filter == fetch.topic_filter:
+                    # Фильтр ещё читает другая временная подписка
+                    return
+            self.client.unsubscribe(fetch.topic_filter)
+
+    def _fetch_retained(self, topic_filter, quiet=0.3, timeout=5):
+        """Внутреннее. Чтение retained-сообщений по фильтру
+
+        Args:
+            topic_filter (string): MQTT-фильтр
+            quiet (float): Сколько секунд без новых сообщений считать концом выдачи
+            timeout (float): Максимальное время ожидания в секундах
+
+        Returns:
+            dict: {топик: значение типа str}
+
+        Raises:
+            RuntimeError: Вызов из обработчика, выполняемого в сетевом потоке
+        """
+
+        if self._on_network_thread():
+            raise RuntimeError(
+                "Retained messages can not be read from the network thread, "
+                "use workers or call it outside of callbacks"
+            )
+
+        fetch = self._start_fetch(topic_filter)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                now = time.monotonic()
+                if now - fetch.last >= quiet or now >= deadline:
+                    break
+                self._pump(min(quiet, deadline - now) / 4)
+        finally:
+            self._stop_fetch(fetch)
+        return fetch.messages
+
+    def save_snapshot(self):
+        """Запись снимка кэша контролов на диск, если он изменился с прошлой записи
+
+        Returns:
+            int: Количество записанных контролов или 0, если запись не понадобилась
+        """
+
+        if not self._snapshot_path:
+            return 0
+
+        seq = self.controls.last_seq
+        if seq == self._snapshot_seq:
+            return 0
+        count = save_snapshot(self._snapshot_path, self.controls.records())
+        self._snapshot_seq = seq
+        return count
+
+    def _snapshot_timer(self):
+        """Внутреннее. Периодическая запись снимка"""
+
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            print("Unable to save snapshot %s: %s" % (self._snapshot_path, e))
+        self._scheduler.call_later(self._snapshot_interval, self._snapshot_timer)
+
+    def stats(self):
+        """Метрики работы: входящие и исходящие сообщения, время обработки
+            по фильтрам подписок и обработчикам, очереди и переподключения
+
+        Returns:
+            dict: Сводка. Времена в секундах. None, если метрики отключены.
+        """
+
+        if self._metrics is None:
+            return None
+
+        result = self._metrics.stats()
+        result["outbound_backlog"] = self.pending_publishes()
+        result["callback_queue"] = self.queue_depth()
+        result["pending_commands"] = len(self._commands)
+        result["rules"] = self._rules.stats()
+        result["commands"] = self._commands.stats()
+        if self._outbound is not None:
+            result["outbound_coalesced"] = self._outbound.coalesced
+        if self._offline is not None:
+            result["offline_coalesced"] = self._offline.coalesced
+            result["offline_dropped"] = self._offline.dropped
+        if self._executor is not None:
+            result["executor"] = self._executor.stats()
+        return result
+
+    def _metrics_timer(self):
+        """Внутреннее. Периодическая публикация метрик виртуальным устройством"""
+
+        try:
+            self._publish_metrics()
+        except Exception as e:
+            print("Unable to publish metrics: %s" % (e))
+        self._scheduler.call_later(self._metrics_interval, self._metrics_timer)
+
+    def _publish_metrics(self):
+        """Внутреннее. Публикация сводки stats() в контролы устройства metrics_device.
+        Устройство создаётся при первой публикации.
+        """
+
+        device_id = self._metrics_device
+        if device_id not in self.virtual_devices:
+            controls = []
+            for order, (name, title, units) in enumerate(METRICS_CONTROLS, 1):
+                control = {
+                    "name": name,
+                    "title": title,
+                    "type": "value",
+                    "default": 0,
+                    "order": order,
+                }
+                if units:
+                    control["units"] = units
+                controls.append(control)
+            self.create_virtual_device(
+                device_id,
+                {"ru": "Метрики python2wb", "en": "python2wb metrics"},
+                controls,
+            )
+
+        stats = self.stats()
+        now = time.monotonic()
+        rate = 0
+        if self._metrics_last is not None:
+            last_time, last_messages = self._metrics_last
+            if now > last_time:
+                rate = (stats["messages_in"] - last_messages) / (now - last_time)
+        self._metrics_last = (now, stats["messages_in"])
+
+        watch = stats["routes"].get(WB_CONTROLS_PATH % ("+", "+"), {}).get("watch")
+        p99 = stats["callback_time"]["p99"]
+        values = {
+            "messages_in": stats["messages_in"],
+            "messages_in_rate": round(rate, 1),
+            "watch_messages": watch["calls"] if watch else 0,
+            "callback_calls": stats["callback_calls"],
+            "callback_errors": stats["callback_errors"],
+            "callback_p99": round(p99 * 1000, 3) if p99 is not None else 0,
+            "messages_out": stats["messages_out"],
+            "outbound_backlog": stats["outbound_backlog"],
+            "callback_queue": stats["callback_queue"],
+            "reconnects": stats["reconnects"],
+            "uptime": int(stats["uptime"]),
+        }
+        for name, value in values.items():
+            self._publish("%s/%s" % (device_id, name), value)
+
+    def _wait_event(self, event, deadline):
+        """Внутреннее. Ожидание события с обработкой сети в текущем потоке,
+            если сетевой цикл не запущен
+
+        Args:
+            event (threading.Event): Событие
+            deadline (float): Крайний срок по time.monotonic()
+
+        Returns:
+            bool: True, если событие наступило
+        """
+
+        while not event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self._loop_running:
+                event.wait(remaining)
+            else:
+                self.client.loop(min(remaining, 0.1))
+        return True
+
+    def _new_sync_marker(self):
+        """Внутреннее. Топик-маркер для проверки, что брокер прислал всё, что было до него"""
+
+        return SYNC_MARKER_PATH % (self._sync_id, next(self._sync_seq))
+
+    def wait_synced(self, patterns=None, timeout=10, quiet=None):
+        """Ожидание окончания начальной выдачи retained-сообщений после подключения.
+            По умолчанию публикуется сообщение в топик-маркер: брокер обрабатывает пакеты
+            по порядку, поэтому когда маркер вернулся, retained-сообщения всех подписок,
+            отправленных до него, уже получены. При заданном quiet вместо маркера ждём,
+            пока quiet секунд не будет новых значений контролов.
+
+        Args:
+            patterns (string, list, optional): Пути 'device/control', можно с '+', по которым
+                считаются загруженные контролы. По умолчанию все контролы.
+            timeout (float, optional): Максимальное время ожидания в секундах
+            quiet (float, optional): Период тишины в секундах вместо топика-маркера
+
+        Returns:
+            dict: synced — дождались ли синхронизации, topics — количество загруженных
+                контролов, elapsed — время от начала подключения до синхронизации в секундах
+        """
+
+        deadline = time.monotonic() + timeout
+
+        if quiet:
+            synced = self._wait_quiet(quiet, deadline)
+        else:
+            synced = self._wait_event(self._connected_event, deadline)
+            if synced:
+                marker = threading.Event()
+                topic = self._new_sync_marker()
+                self._add_route(topic, lambda client, userdata, msg: marker.set())
+                try:
+                    self.client.publish(topic, "1", qos=self.qos_pub)
+                    synced = self._wait_event(marker, deadline)
+                finally:
+                    self._remove_route(topic)
+
+        return self._sync_result(patterns, synced)
+
+    def _wait_quiet(self, quiet, deadline):
+        """Внутреннее. Ожидание периода без новых значений контролов
+
+        Returns:
+            bool: True, если период тишины наступил до крайнего срока
+        """
+
+        last_seq = self.controls.last_seq
+        last_change = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - last_change >= quiet:
+                return True
+            if now >= deadline:
+                return False
+            self._pump(min(quiet / 4, deadline - now))
+            if self.controls.last_seq != last_seq:
+                last_seq = self.controls.last_seq
+                last_change = time.monotonic()
+
+    def _sync_result(self, patterns, synced):
+        """Внутреннее. Результат ожидания синхронизации
+
+        Returns:
+            dict: synced, topics, elapsed
+        """
+
+        if synced and self._synced_at is None:
+            self._synced_at = time.monotonic()
+
+        if patterns is None:
+            topics = len(self.controls)
+        else:
+            if type(patterns) != list:
+                patterns = [patterns]
+            topics = sum(
+                1
+                for control_path in self.controls
+                if any(topic_covers(pattern, control_path) for pattern in patterns)
+            )
+
+        elapsed = (self._synced_at or time.monotonic()) - self._connect_started
+        return {"synced": synced, "topics": topics, "elapsed": elapsed}
+
+    def clear(self):
+        """Очистка виртуальных устройств, подписок и отключение клиента от брокера"""
+
+        if self._outbound is not None:
+            self._outbound.drain()
+        self._scheduler.stop()
+
+        if self._snapshot_path:
+            try:
+                self.save_snapshot()
+            except OSError as e:
+                print("Unable to save snapshot %s: %s" % (self._snapshot_path, e))
 
         self.remove_all_virtual_devices()
+        self.stop_recording()
         self.client.disconnect()
         self.client.loop_stop()
 
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _control_topic(self, control_path, mode="value"):
+        """Внутреннее. Топик контрола для режима подписки
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+            mode (string): value — значение, on — командный топик, errors — ошибки
+
+        Returns:
+            string: Полный путь к mqtt-топику
+        """
+
+        items = control_path.split("/")
+        topic = WB_CONTROLS_PATH % (items[0], items[1])
+
+        if mode == "errors":
+            return topic + "/meta/error"
+        elif mode == "on":
+            return topic + "/on"
+        return topic
+
+    def _add_route(self, topic_filter, handler, key="user", subscribe=True):
+        """Внутреннее. Регистрация обработчика в дереве маршрутов и подписка у брокера,
+            если фильтр ещё не покрыт другой подпиской
+
+        Args:
+            topic_filter (string): MQTT-фильтр
+            handler (function): Обработчик с параметрами client, userdata, msg
+            key (string): Ключ обработчика, повторная регистрация с тем же ключом заменяет обработчик
+            subscribe (bool, optional): Подписываться у брокера. False — обработчик
+                получает только сообщения, пришедшие по другим подпискам.
+        """
+
+        with self._lock:
+            if self._metrics is not None:
+                handler = self._metrics.bind_route(handler, topic_filter, key)
+            if self._routes.add(topic_filter, handler, key) and subscribe:
+                self._acquire(topic_filter)
+
+    def _remove_route(self, topic_filter, key="user", subscribe=True):
+        """Внутреннее. Удаление обработчика и отписка у брокера от неиспользуемых фильтров
+
+        Args:
+            topic_filter (string): MQTT-фильтр
+            key (string): Ключ обработчика
+            subscribe (bool, optional): Фильтр был добавлен с подпиской у брокера
+
+        Returns:
+            bool: True, если обработчик был найден и удалён
+        """
+
+        with self._lock:
+            if self._metrics is not None:
+                self._metrics.unbind_route(topic_filter, key)
+            if not self._routes.remove(topic_filter, key):
+                return False
+            if subscribe:
+                self._release(topic_filter)
+            return True
+
+    def _watch(self, control_path):
+        """Внутреннее. В режиме точечных подписок — подписка у брокера на значение
+            контрола, которое нужно кэшу без пользовательской подписки:
+            track(), правила, set_and_confirm(). Подписки считаются по ссылкам.
+
+        Args:
+            control_path (string): Путь к контролу в формате 'device/control'
+        """
+
+        if self._targeted:
+            with self._lock:
+                self._acquire(self._control_topic(control_path))
+
+    def _unwatch(self, control_path):
+        """Внутреннее. Отказ от подписки, взятой в _watch()"""
+
+        if self._targeted:
+            with self._lock:
+                self._release(self._control_topic(control_path))
+
+    def _broker_topics(self, topic_filter):
+        """Внутреннее. Фильтры у брокера для фильтра маршрута. В режиме точечных
+            подписок к значениям контролов добавляются их /meta и /meta/type,
+            чтобы значения преобразовывались по типу контрола.
+
+        Returns:
+            tuple: MQTT-фильтры, описания раньше значений
+        """
+
+        if self._targeted:
+            levels = topic_filter.split("/")
+            if (
+                len(levels) == 5
+                and levels[1] == "devices"
+                and levels[3] == "controls"
+                and "#" not in topic_filter
+            ):
+                return (
+                    topic_filter + "/meta",
+                    topic_filter + "/meta/type",
+                    topic_filter,
+                )
+        return (topic_filter,)
+
+    def _acquire(self, topic_filter):
+        """Внутреннее. Учёт ссылки на фильтр и подписка у брокера. Вызывается под self._lock"""
+
+        for topic in self._broker_topics(topic_filter):
+            self._update_broker(*self._broker_subscriptions.acquire(topic))
+
+    def _release(self, topic_filter):
+        """Внутреннее. Снятие ссылки на фильтр и отписка у брокера. Вызывается под self._lock"""
+
+        for topic in self._broker_topics(topic_filter):
+            self._update_broker(*self._broker_subscriptions.release(topic))
+
+    def _update_broker(self, subscribe, unsubscribe):
+        """Внутреннее. Применение изменений набора подписок у брокера.
+        Без подключения изменения будут применены в on_connect.
+        """
+
+        if not self._connected:
+            return
+        if subscribe:
+            self.client.subscribe([(topic, self.qos_sub) for topic in subscribe])
+        if unsubscribe:
+            self.client.unsubscribe(unsubscribe)
+
+    def _register_callback(self, callback):
+        """Внутреннее. Объявление обработчика пулу процессов, чтобы процессы
+        унаследовали его при создании через fork
+        """
+
+        if self._processes:
+            self._executor.register(callback)
+
+    def _call(self, key, callback, args, coalesce_key=None):
+        """Внутреннее. Вызов пользовательского обработчика: сразу или через пул потоков
+
+        Args:
+            key (string): Ключ упорядочивания в пуле
+            callback (function): Обработчик
+            args (tuple): Аргументы обработчика
+            coalesce_key (string, optional): Путь к контролу или топик для объединения значений
+        """
+
+        metrics = self._metrics
+        if metrics is not None:
+            stats = metrics.by_callback.get(callback) or metrics.callback(callback)
+            if self._executor is None:
+                self._call_serialized(metrics.run, stats, callback, args)
+            elif self._processes:
+                # Время выполнения в процессах не замеряется, ошибки считает пул
+                stats.calls += 1
+                self._executor.submit(key, callback, args, (callback, coalesce_key))
+            else:
+                self._executor.submit(
+                    key, metrics.run, (stats, callback, args), (callback, coalesce_key)
+                )
+        elif self._executor is None:
+            self._call_serialized(callback, *args)
+        else:
+            self._executor.submit(key, callback, args, (callback, coalesce_key))
+
+    def _call_deferred(self, callback, *args):
+        """Внутреннее. Вызов из потока планировщика функции, которая доставляет
+            значения через _call(). Пул обработчиков принимает задачи из любого потока,
+            без пула функция выполняется по очереди с обработчиками сообщений.
+
+        Args:
+            callback (function): Функция
+            *args: Аргументы функции
+        """
+
+        if self._executor is not None:
+            callback(*args)
+        else:
+            self._call_serialized(callback, *args)
+
+    def _call_serialized(self, callback, *args):
+        """Внутреннее. Вызов без пула: обработчики из сетевого потока и потока
+            планировщика не выполняются одновременно. Если блокировка занята,
+            вызов ставится в очередь и его выполняет поток, который её держит,
+            в порядке постановки.
+
+        Args:
+            callback (function): Функция
+            *args: Аргументы функции
+        """
+
+        soon = self._soon
+        lock = self._dispatch_lock
+        if soon or not lock.acquire(False):
+            soon.append((callback, args))
+            self._run_soon()
+            return
+        try:
+            callback(*args)
+        finally:
+            lock.release()
+            if soon:
+                self._run_soon()
+
+    def _run_soon(self):
+        """Внутреннее. Выполнение вызовов, поставленных в очередь, пока блокировка
+        была занята. Очередь проверяется и после освобождения блокировки, чтобы не
+        потерять вызов, добавленный в этот момент другим потоком.
+        """
+
+        soon = self._soon
+        lock = self._dispatch_lock
+        while soon and lock.acquire(False):
+            try:
+                while soon:
+                    callback, args = soon.popleft()
+                    try:
+                        callback(*args)
+                    except Exception:
+                        traceback.print_exc()
+            finally:
+                lock.release()
+
+    def start_processes(self):
+        """Создание процессов-обработчиков при processes > 0. Вызывается также
+        в loop_start() и loop_forever() до запуска сетевого потока: fork из потока,
+        пока другие потоки держат блокировки, может оставить процесс с захваченной
+        блокировкой. Обработчики, подписанные до создания процессов, наследуются
+        через fork, подписанные позже передаются через pickle, а если это невозможно
+        (лямбда, замыкание) — выполняются в основном процессе.
+
+        В процессе-обработчике из унаследованного объекта можно вызывать только
+        set(), publish_raw() и get(): они передаются родителю. Остальные методы,
+        клиент paho, планировщик и блокировки в процессе не работают.
+        """
+
+        if self._processes:
+            self._executor.start()
+
+    def queue_depth(self):
+        """Глубина очереди пула обработчиков
+
+        Returns:
+            int: Количество сообщений, ожидающих обработки. 0, если пул не используется.
+        """
+
+        if self._executor is None:
+            return 0
+        return self._executor.qsize()
+
+    def _on_message(self, client, userdata, msg):
+        """Внутреннее. Единая точка разбора входящих сообщений.
+            Вызывает все обработчики, фильтры которых подходят под топик.
+
+        Args:
+            client (obj): Объект mqtt-клиента
+            userdata (obj): Пользовательские данные
+            msg (obj): Сообщение, содержит топик и значение
+        """
+
+        if self._fetches and msg.retain:
+            handlers = self._fetch_routes.match(msg.topic)
+            if handlers:
+                for handler in handlers:
+                    handler(client, userdata, msg)
+                return
+        if self._metrics is not None:
+            self._metrics.messages_in += 1
+        if self._recorder is not None:
+            self._recorder.on_message(client, userdata, msg)
+        for handler in self._routes.match(msg.topic):
+            handler(client, userdata, msg)
+
     def _watch_control(self, client, userdata, msg):
         """Внутреннее. Слежение за контролами всех устройств, кроме создаваемых из этого модуля.
             Если пришло сообщение на нашу подрписку, то добавляем или обновляем в
@@ -291,11 +1939,168 @@ class WbMqtt:
             msg (obj): Сообщение, содержит топик и значение
         """
 
-        items = msg.topic.split("/")
-        control_path = "%s/%s" % (items[2], items[4])
-        new_value = msg.payload.decode()
+        # Разбор топика кэшируется, payload преобразуется по типу без промежуточной строки
+        control_path = self.controls.resolve(msg.topic)[2]
+        entry = self.write_value_in_dic(control_path, msg.payload)
+
+        if self._histories:
+            history = self._histories.get(control_path)
+            if history is not None:
+                history.append(entry.timestamp, entry.value)
+
+        if self._rules.inputs:
+            self._rules.changed(control_path, entry.value)
+
+        if self._commands.pending:
+            if self._commands.confirm(control_path, entry.value):
+                self._release_command_route(control_path)
+
+    def _watch_control_meta(self, client, userdata, msg):
+        """Внутреннее. Слежение за /meta и /meta/type контролов, чтобы знать их тип
+            и преобразовывать значения один раз при получении
+
+        Args:
+            client (obj): Объект mqtt-клиента
+            userdata (obj): Пользовательские данные
+            msg (obj): Сообщение, содержит топик и значение
+        """
+
+        device_id, control_id, control_path, suffix = self.controls.resolve(
+            msg.topic, False
+        )
+        payload = msg.payload.decode()
+
+        if suffix == "meta":
+            try:
+                meta = json.loads(payload) if payload else {}
+            except ValueError:
+                return
+            if type(meta) != dict:
+                return
+            if payload:
+                fields = {
+                    "units": meta.get("units"),
+                    "readonly": bool(meta.get("readonly", False)),
+                    "order": meta.get("order"),
+                }
+                # Тип может приходить отдельно в /meta/type
+                if "type" in meta:
+                    fields["type"] = meta["type"]
+            else:
+                fields = None
+            self._update_control_meta(device_id, control_id, control_path, fields)
+            if payload and "type" not in meta:
+                return
+            control_type = meta.get("type")
+        else:
+            control_type = payload
+            if payload:
+                self._update_control_meta(
+                    device_id, control_id, control_path, {"type": payload}
+                )
+
+        self.controls.set_type(control_path, control_type)
+
+    def _watch_meta(self):
+        """Внутреннее. Начало слежения за /meta устройств при первом обращении
+        к индексу self.meta. В целевом режиме также подписывается на /meta
+        всех контролов, иначе они приходят только для контролов с подпиской.
+        При подписке на base_subscribe_topic retained /meta устройств уже пришли
+        при подключении, поэтому они читаются повторно временной подпиской.
+        """
 
-        self.write_value_in_dic(control_path, new_value)
+        with self._lock:
+            if self._meta_watched:
+                return
+            self._meta_watched = True
+            self._add_route(WB_DEVICE_META_PATH, self._watch_device_meta, "watch")
+            if self._targeted:
+                for suffix in ("/meta", "/meta/type"):
+                    self._acquire(WB_CONTROLS_PATH % ("+", "+") + suffix)
+                return
+            if not self._connected:
+                return
+
+        fetch = self._start_fetch(WB_DEVICE_META_PATH, self._watch_device_meta)
+        self._scheduler.call_later(META_FETCH_TIME, self._stop_fetch, fetch)
+
+    def _watch_device_meta(self, client, userdata, msg):
+        """Внутреннее. Слежение за /meta устройств: драйвер и заголовок для индекса self.meta
+
+        Args:
+            client (obj): Объект mqtt-клиента
+            userdata (obj): Пользовательские данные
+            msg (obj): Сообщение, содержит топик и значение
+        """
+
+        device_id = msg.topic.split("/")[2]
+        payload = msg.payload.decode()
+        try:
+            meta = json.loads(payload) if payload else None
+        except ValueError:
+            return
+        if meta is not None and type(meta) != dict:
+            return
+
+        changed = self.meta.update_device(device_id, meta)
+        if changed and self._meta_queries:
+            self._refresh_queries(changed)
+
+    def _update_control_meta(self, device_id, control_id, control_path, fields):
+        """Внутреннее. Обновление индекса self.meta и подписок по запросу"""
+
+        if self.meta.update_control(device_id, control_id, control_path, fields):
+            if self._meta_queries:
+                self._refresh_queries((control_path,))
+
+    def _refresh_queries(self, control_paths):
+        """Внутреннее. Подписка на контролы, ставшие подходящими под запросы,
+            и отписка от переставших подходить
+
+        Args:
+            control_paths (list): Пути контролов с изменившимся описанием
+        """
+
+        with self._lock:
+            for subscription in list(self._meta_queries.values()):
+                for control_path in control_paths:
+                    matched = self.meta.matches(control_path, subscription.criteria)
+                    if matched and control_path not in subscription.controls:
+                        self._query_add(subscription, control_path)
+                    elif not matched and control_path in subscription.controls:
+                        subscription.controls.discard(control_path)
+                        self._unsubscribe(control_path, key=subscription.key)
+
+    def _query_add(self, subscription, control_path):
+        """Внутреннее. Подписка на контрол, подходящий под запрос"""
+
+        subscription.controls.add(control_path)
+        self._subscribe(
+            control_path,
+            subscription.callback,
+            key=subscription.key,
+            change_filter=subscription.change_filter,
+        )
+
+    def _watch_command_error(self, client, userdata, msg):
+        """Внутреннее. Слежение за /meta/error контролов с ожидающими командами.
+            Retained-ошибка, пришедшая при подписке, относится к прошлым командам и пропускается.
+
+        Args:
+            client (obj): Объект mqtt-клиента
+            userdata (obj): Пользовательские данные
+            msg (obj): Сообщение, содержит топик и значение
+        """
+
+        if msg.retain:
+            return
+        error = msg.payload.decode()
+        if "w" not in error:
+            return
+
+        control_path = self.controls.resolve(msg.topic, False)[2]
+        if self._commands.fail(control_path, error):
+            self._release_command_route(control_path)
 
     def _watch_virtual_control(self, client, userdata, msg):
         """Внутреннее. Слежение за контролами виртуальных устройств, созданных этим скриптом.
@@ -308,20 +2113,26 @@ class WbMqtt:
             msg (obj): Сообщение, содержит топик и значение
         """
 
-        items = msg.topic.split("/")
-        topic = WB_CONTROLS_PATH % (items[2], items[4])
-        self.client.publish(
-            topic, payload=msg.payload.decode(), qos=self.qos_pub, retain=True
-        )
+        device_id, control_id, _, _ = self.controls.resolve(msg.topic)
+        if not self.virtual_devices.has_control(device_id, control_id):
+            return
+
+        topic = WB_CONTROLS_PATH % (device_id, control_id)
+        payload = msg.payload.decode()
+        self.virtual_devices.set_value(device_id, control_id, payload)
+        self._publish_now(topic, payload, self.qos_pub, True)
 
     def write_value_in_dic(self, control_path, new_value):
         """Запись изменившегося значения в словарь контролов
 
         Args:
             control_path (string): Путь к контролу в формате 'device/control'
-            new_value (string): Новое значение типа str
+            new_value (string, bytes): Новое значение типа str или payload mqtt-сообщения
+
+        Returns:
+            ControlValue: Запись кэша с типизированным значением
         """
-        self.controls.update({control_path: new_value})
+        return self.controls.update(control_path, new_value)
 
     def create_virtual_device(self, device_id, device_title, controls):
         """Создание виртуального устройства
@@ -339,17 +2150,10 @@ class WbMqtt:
         if device_id not in self.virtual_devices:
             topic = "/devices/%s/meta" % (device_id)
 
-            if type(device_title) == dict:
-                title = device_title
-            else:
-                title = {"en": device_title}
-
-            value = {"driver": self.driver_name, "title": title}
-
-            self.client.publish(
-                topic, payload=json.dumps(value), qos=self.qos_pub, retain=True
+            self._publish_now(
+                topic, self._device_meta(device_title), self.qos_pub, True
             )
-            self.virtual_devices.append(device_id)
+            self._register_virtual_device(device_id, device_title)
 
             for control in controls:
                 self._add_control(device_id, control)
@@ -359,52 +2163,169 @@ class WbMqtt:
             print("Virtual device %s already exists." % (device_id))
             return None
 
-    def _add_control(self, device_id, control):
-        """Внутреннее. Добавление контрола
+    def provision_virtual_device(
+        self, device_id, device_title, controls, diff=True, window=100, timeout=10
+    ):
+        """Создание виртуального устройства одной пачкой.
+            Сообщения отправляются без ожидания подтверждения каждого, но не больше window
+            неподтверждённых одновременно, подтверждения всех ждём в конце.
+            При diff=True сначала читаются retained-сообщения устройства и публикуются
+            только изменившиеся описания контролов, контролы, которых больше нет в описании,
+            удаляются. Текущие значения контролов сохраняются, default публикуется
+            только для контролов без значения.
 
         Args:
-            device_id (string): Идентификатор топика в MQTT
-            control (dic): Описание контрола. {"name": "control2", "title": "Control 2 Title", "type": "switch", "default": 1, "order": 2}
-                title можно задавать для разных языков "title": {"ru": "Переключатель", "en": "Switch"}
+            device_id (string): Идентификатор устройства
+            device_title (string, dict): Заголовок устройства, как в create_virtual_device
+            controls (array of dict): Массив контролов, как в create_virtual_device
+            diff (bool, optional): Сравнивать с retained-состоянием брокера. По умолчанию True.
+            window (int, optional): Максимальное число неподтверждённых сообщений
+            timeout (float, optional): Время ожидания retained-сообщений и подтверждений в секундах
 
         Returns:
-            string: Путь к созданному контролу в формате 'device/control'
+            int: Количество опубликованных сообщений
+
+        Raises:
+            RuntimeError: Вызов с diff=True из обработчика, выполняемого в сетевом потоке
         """
 
-        if device_id in self.virtual_devices:
-            topic = WB_CONTROLS_PATH % (device_id, control.get("name"))
+        retained = {}
+        if diff:
+            retained = self._fetch_retained(
+                "/devices/%s/#" % device_id, timeout=timeout
+            )
 
-            title = control.get("title")
+        messages = self._provision_messages(device_id, device_title, controls, retained)
 
-            if type(title) != dict:
-                control["title"] = {"en": title}
+        self._publish_batch(messages, window, timeout)
 
-            self.client.publish(
-                "%s/meta" % (topic),
-                payload=json.dumps(control),
-                qos=self.qos_pub,
-                retain=True,
-            )
+        return len(messages)
+
+    def _provision_messages(self, device_id, device_title, controls, retained):
+        """Внутреннее. Регистрация виртуального устройства и список сообщений для публикации
+
+        Args:
+            device_id (string): Идентификатор устройства
+            device_title (string, dict): Заголовок устройства
+            controls (array of dict): Массив контролов
+            retained (dict): Retained-сообщения устройства {топик: значение}
+
+        Returns:
+            list: Пары (топик, значение)
+        """
+
+        messages = []
+        topic = "/devices/%s/meta" % (device_id)
+        payload = self._device_meta(device_title)
+        if not _same_json(retained.get(topic), payload):
+            messages.append((topic, payload))
+
+        self._register_virtual_device(device_id, device_title)
+
+        names = set()
+        for control in controls:
+            names.add(control.get("name"))
+            meta, meta_type, value = self._control_messages(device_id, control)
+            changed = not _same_json(retained.get(meta[0]), meta[1])
+
+            if changed:
+                messages.append(meta)
+            if retained.get(meta_type[0]) != meta_type[1]:
+                messages.append(meta_type)
+
+            current = retained.get(value[0])
+            if current is None:
+                messages.append(value)
+                current = value[1]
+
+            self._register_control(device_id, control, current)
+
+        # Контролы, которые остались у брокера от прошлого запуска, но больше не описаны
+        prefix = WB_CONTROLS_PATH % (device_id, "")
+        for topic in retained:
+            if not topic.startswith(prefix) or not topic.endswith("/meta"):
+                continue
+            name = topic[len(prefix) : -len("/meta")]
+            if "/" in name or name in names:
+                continue
+            control_topic = WB_CONTROLS_PATH % (device_id, name)
+            for suffix in ("/meta", "/meta/type", ""):
+                messages.append((control_topic + suffix, ""))
+            self.controls.pop("%s/%s" % (device_id, name))
+
+        return messages
+
+    def _device_meta(self, device_title):
+        """Внутреннее. Описание /meta виртуального устройства
+
+        Returns:
+            string: JSON с драйвером и заголовком
+        """
 
+        if type(device_title) == dict:
+            title = device_title
+        else:
+            title = {"en": device_title}
+
+        return json.dumps({"driver": self.driver_name, "title": title})
+
+    def _control_messages(self, device_id, control):
+        """Внутреннее. Сообщения для публикации контрола виртуального устройства
+
+        Returns:
+            list: Пары (топик, значение) для /meta, /meta/type и значения
+        """
+
+        topic = WB_CONTROLS_PATH % (device_id, control.get("name"))
+
+        title = control.get("title")
+
+        if type(title) != dict:
+            control["title"] = {"en": title}
+
+        return [
+            ("%s/meta" % (topic), json.dumps(control)),
             # Обходим багу с wb-rules, когда события не прилетают в контролы без type по старому стилю
-            self.client.publish(
-                "%s/meta/type" % (topic),
-                payload=control.get("type"),
-                qos=self.qos_pub,
-                retain=True,
-            )
-            self.client.publish(
-                topic, payload=control.get("default"), qos=self.qos_pub, retain=True
-            )
+            ("%s/meta/type" % (topic), control.get("type")),
+            (topic, control.get("default")),
+        ]
+
+    def _register_virtual_device(self, device_id, device_title=None):
+        """Внутреннее. Учёт виртуального устройства и подписка на командные топики его контролов"""
+
+        self.virtual_devices.add(device_id, device_title)
+        self._add_route(
+            WB_CONTROLS_PATH % (device_id, "+") + "/on",
+            self._watch_virtual_control,
+            "virtual",
+        )
 
-            self.client.message_callback_add(
-                "%s/on" % topic, self._watch_virtual_control
-            )
+    def _register_control(self, device_id, control, value):
+        """Внутреннее. Учёт контрола виртуального устройства, запись его типа и значения в кэш"""
+
+        control_path = self.virtual_devices.add_control(device_id, control)
+        self.virtual_devices.set_value(device_id, control.get("name"), value)
+        self.controls.set_type(control_path, control.get("type"))
+        self.controls.update(control_path, value)
+        return control_path
+
+    def _add_control(self, device_id, control):
+        """Внутреннее. Добавление контрола
+
+        Args:
+            device_id (string): Идентификатор топика в MQTT
+            control (dic): Описание контрола. {"name": "control2", "title": "Control 2 Title", "type": "switch", "default": 1, "order": 2}
+                title можно задавать для разных языков "title": {"ru": "Переключатель", "en": "Switch"}
+
+        Returns:
+            string: Путь к созданному контролу в формате 'device/control'
+        """
 
-            control_path = "%s/%s" % (device_id, control.get("name"))
-            self.controls.update({control_path: control.get("default")})
+        if device_id in self.virtual_devices:
+            for topic, payload in self._control_messages(device_id, control):
+                self._publish_now(topic, payload, self.qos_pub, True)
 
-            return "%s/%s" % (device_id, control.get("name"))
+            return self._register_control(device_id, control, control.get("default"))
         else:
             print(
                 "Virtual device %s does not exist. First you need to create a device, then add controls to it."
@@ -412,32 +2333,61 @@ class WbMqtt:
             )
             return None
 
-    def _delete_control(self, control_path):
-        """Внутреннее. Удаление контрола виртуального устройства
+    def _unregister_virtual_devices(self, device_ids):
+        """Внутреннее. Удаление виртуальных устройств из реестра, кэша и дерева маршрутов
 
         Args:
-            control_path (string): Путь к контролу в формате 'device/control'
+            device_ids (list): Идентификаторы устройств
+
+        Returns:
+            list: Пары (топик, пустое значение) для очистки retained-топиков у брокера
         """
 
-        items = control_path.split("/")
-        topic = WB_CONTROLS_PATH % (items[0], items[1])
-        self.client.publish("%s/on" % (topic), "", qos=self.qos_pub)
-        self.client.publish("%s/meta/type" % (topic), "", qos=self.qos_pub)
-        self.client.publish("%s/meta" % (topic), "", qos=self.qos_pub)
-        self.client.publish("%s" % (topic), "", qos=self.qos_pub)
-        self.controls.pop(control_path)
+        messages = []
+        for device_id in device_ids:
+            device = self.virtual_devices.remove(device_id)
+            if device is None:
+                print("Virtual device %s does not exist." % (device_id))
+                continue
+
+            for control_path in device.control_paths():
+                self.controls.pop(control_path)
+            self._remove_route(WB_CONTROLS_PATH % (device_id, "+") + "/on", "virtual")
 
-    def _delete_virtual_device(self, device_id):
-        """Внутреннее. Удаление виртуального устройства
+            messages.extend((topic, "") for topic in device.topics())
+
+        return messages
+
+    def _publish_batch(self, messages, window=100, timeout=10):
+        """Внутреннее. Публикация пачки retained-сообщений с ожиданием всех подтверждений в конце.
+            В сетевом потоке подтверждения ждать нельзя, их разбирает этот же поток:
+            сообщения только ставятся в очередь paho.
 
         Args:
-            device_id (string): Идентификатор устройства в MQTT
+            messages (list): Пары (топик, значение)
+            window (int, optional): Максимальное число неподтверждённых сообщений
+            timeout (float, optional): Время ожидания подтверждений в секундах
+
+        Returns:
+            bool: True, если все сообщения подтверждены
         """
 
-        self.client.publish("/devices/%s/meta" % (device_id), "", qos=self.qos_pub)
-        self.client.publish("/devices/%s" % (device_id), "", qos=self.qos_pub)
-        index = self.virtual_devices.index(device_id)
-        self.virtual_devices.pop(index)
+        if not messages:
+            return True
+
+        if self._on_network_thread():
+            for topic, payload in messages:
+                self._publish_now(topic, payload, self.qos_pub, True)
+            return True
+
+        publisher = PipelinedPublisher(self._publish_now, self._pump, window)
+        for topic, payload in messages:
+            publisher.publish(topic, payload, self.qos_pub, True)
+
+        if not publisher.wait(timeout):
+            print("%s messages were not acknowledged." % (publisher.pending()))
+            return False
+        return True
 
     def add_control(self, device_id, control):
         """Обёртка для _add_control"""
@@ -451,22 +2401,14 @@ class WbMqtt:
             device_id (string): Идентификатор устройства в MQTT
         """
 
-        virtual_controls = []
-        for item in self.virtual_devices:
-            self._delete_virtual_device(item)
-
-            for key in self.controls:
-                if item in key:
-                    virtual_controls.append(key)
-
-        for item in virtual_controls:
-            self._delete_control(item)
+        self._publish_batch(self._unregister_virtual_devices([device_id]))
 
     def remove_all_virtual_devices(self):
-        """Удалить все виртуальные устройства"""
+        """Удалить все виртуальные устройства одной пачкой"""
 
-        for key in self.virtual_devices:
-            self.remove_virtual_device(key)
+        self._publish_batch(
+            self._unregister_virtual_devices(list(self.virtual_devices))
+        )
 
     def parse_value(self, value):
         """В MQTT все значения текстовые, но чтобы было удобно работать
@@ -478,16 +2420,48 @@ class WbMqtt:
         Returns:
             float, int, str: Типизированное значение
         """
-        value = value.strip()
-        try:
-            float(value)
-            try:
-                int(value)
-                return int(value)
-            except ValueError:
-                return float(value)
-        except:
-            return value
+        return parse_value(value)
+
+
+def _same_json(retained, payload):
+    """Сравнение retained JSON-описания с новым
+
+    Args:
+        retained (string): Retained-значение или None
+        payload (string): Новое значение
+
+    Returns:
+        bool: True, если описания совпадают
+    """
+
+    if retained is None:
+        return False
+    try:
+        return json.loads(retained) == json.loads(payload)
+    except ValueError:
+        return retained == payload
+
+
+class RetainedFetch:
+    """Накопитель retained-сообщений временной подписки
+
+    Args:
+        topic_filter (string): MQTT-фильтр
+        handler (function, optional): Обработчик каждого полученного сообщения
+    """
+
+    def __init__(self, topic_filter, handler=None):
+        self.topic_filter = topic_filter
+        self.handler = handler
+        self.messages = {}
+        self.last = time.monotonic()
+
+    def on_message(self, client, userdata, msg):
+        if msg.retain:
+            self.messages[msg.topic] = msg.payload.decode()
+            self.last = time.monotonic()
+            if self.handler is not None:
+                self.handler(client, userdata, msg)
 
 
 @atexit.register
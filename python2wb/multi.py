@@ -0,0 +1,625 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from .executor import CallbackExecutor
+from .mqtt import WbMqtt
+from .scheduler import Scheduler
+
+# Разделитель имени брокера и пути: 'ctrl3:wb-gpio/A1_OUT'
+NAMESPACE_SEPARATOR = ":"
+
+# Путь без имени брокера или с '*' относится ко всем брокерам
+ALL_BROKERS = "*"
+
+# Не реже, чем раз в MISC_INTERVAL секунд, вызывается loop_misc(): keepalive и повторы
+MISC_INTERVAL = 1.0
+
+
+def _has_data(sock):
+    """Внутреннее. В сокете есть непрочитанные данные или он закрыт удалённой стороной"""
+
+    try:
+        sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return False
+    except (ValueError, OSError):
+        # TLS-сокет не поддерживает MSG_PEEK: читаем по одному пакету за проход
+        return False
+    return True
+
+
+def _namespaced(name, callback):
+    """Внутреннее. Обработчик, которому device_id или топик передаётся с именем брокера"""
+
+    prefix = name + NAMESPACE_SEPARATOR
+
+    def wrapper(device_or_topic, *args):
+        callback(prefix + device_or_topic, *args)
+
+    wrapper.__qualname__ = getattr(callback, "__qualname__", repr(callback))
+    wrapper.__name__ = getattr(callback, "__name__", wrapper.__qualname__)
+    return wrapper
+
+
+class _SharedScheduler:
+    """Внутреннее. Общий планировщик брокеров: clear() брокера его не останавливает"""
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self.time = scheduler.time
+        self.call_later = scheduler.call_later
+        self.call_at = scheduler.call_at
+
+    def __len__(self):
+        return len(self._scheduler)
+
+    def stop(self):
+        pass
+
+
+class _BrokerExecutor:
+    """Внутреннее. Доля брокера в общем пуле обработчиков: считает его задачи,
+    чтобы сетевой цикл перестал читать сокет перегруженного брокера.
+    """
+
+    def __init__(self, executor, max_pending, on_drain):
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._on_drain = on_drain
+        self.max_pending = max_pending
+        self.pending = 0
+        self.paused = False
+        self.pauses = 0
+
+    def submit(self, key, callback, args, coalesce_key=None):
+        with self._lock:
+            self.pending += 1
+        self._executor.submit(key, self._run, (callback, args))
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+                resume = self.paused and self.pending <= self.max_pending // 2
+            if resume:
+                self._on_drain()
+
+    def overloaded(self):
+        """Брокер исчерпал свою долю пула. Чтение возобновляется, когда очередь
+        опустеет наполовину.
+        """
+
+        with self._lock:
+            if self.paused:
+                self.paused = self.pending > self.max_pending // 2
+            elif self.pending >= self.max_pending:
+                self.paused = True
+                self.pauses += 1
+            return self.paused
+
+    def qsize(self):
+        return self.pending
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "paused": self.paused,
+            "pauses": self.pauses,
+        }
+
+    def shutdown(self, wait=True):
+        # Общий пул останавливает MultiWbMqtt
+        pass
+
+
+class BrokerWbMqtt(WbMqtt):
+    """Клиент одного брокера в MultiWbMqtt. Сокет обслуживает общий сетевой цикл,
+    отложенные вызовы — общий планировщик, обработчики — общий пул.
+
+    Args:
+        multi (MultiWbMqtt): Владелец
+        name (string): Имя брокера
+        server_url (string): Адрес брокера
+        port (int): Порт брокера
+        **kwargs: Параметры WbMqtt
+    """
+
+    def __init__(self, multi, name, server_url, port, **kwargs):
+        self._multi = multi
+        self.name = name
+        self._server = (server_url, port)
+        self._reconnect_delay = None
+        self._closing = False
+        self.connect_attempts = 0
+        kwargs["connect"] = False
+        super().__init__(server_url, port, **kwargs)
+        # Без пула обработчики всех брокеров выполняются по одному
+        self._soon = multi._soon
+        self._dispatch_lock = multi._dispatch_lock
+        # Сетевой цикл paho не запускается, ожидание в wait_synced() и get_retained()
+        # идёт, пока сокет обслуживает общий цикл
+        self._loop_running = True
+
+        client = self.client
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_close = self._on_socket_close
+        client.connect_async(server_url, port, 60)
+
+    def _create_scheduler(self):
+        """Внутреннее. Общий планировщик MultiWbMqtt"""
+
+        return self._multi._shared_scheduler
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._multi._wake()
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._multi._wake()
+
+    def _on_connected(self):
+        self._reconnect_delay = None
+        WbMqtt._on_connected(self)
+
+    def _on_disconnected(self, rc):
+        """Внутреннее. После обрыва связи переподключаемся с экспоненциальной задержкой.
+        rc=0 — отключение по disconnect(), после него переподключения нет.
+        """
+
+        WbMqtt._on_disconnected(self, rc)
+        if rc != 0:
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        """Внутреннее. Планирование следующей попытки подключения"""
+
+        if self._closing:
+            return
+        min_delay, max_delay = self._reconnect_delays
+        if self._reconnect_delay is None:
+            self._reconnect_delay = min_delay
+        else:
+            self._reconnect_delay = min(self._reconnect_delay * 2, max_delay)
+        self._multi._connector.call_later(self._reconnect_delay, self._reconnect)
+
+    def _reconnect(self):
+        """Внутреннее. Попытка подключения в потоке подключений: connect() блокирует
+        до установки TCP-соединения и не должен задерживать сетевой цикл.
+        """
+
+        if self._closing:
+            return
+        self.connect_attempts += 1
+        self._connect_started = time.monotonic()
+        with self._multi._io_lock:
+            self._multi._connecting.add(self)
+        try:
+            self.client.reconnect()
+        except OSError as e:
+            print(
+                "Unable to connect to %s (%s:%s): %s"
+                % (self.name, self._server[0], self._server[1], e)
+            )
+            self._schedule_reconnect()
+        finally:
+            with self._multi._io_lock:
+                self._multi._connecting.discard(self)
+            self._multi._wake()
+
+    def clear(self):
+        self._closing = True
+        WbMqtt.clear(self)
+
+
+class MultiWbMqtt:
+    """Клиент нескольких контроллеров в одном процессе.
+
+    У каждого брокера свой BrokerWbMqtt со своим кэшем, виртуальными устройствами
+    и подписками. Сокеты всех брокеров обслуживает один сетевой поток через selectors,
+    отложенные вызовы — один планировщик, обработчики — один пул на workers потоков,
+    подключения — один поток. Количество потоков не зависит от числа брокеров.
+
+    Пути контролов начинаются с имени брокера: 'ctrl3:wb-gpio/A1_OUT'. Путь без
+    имени или с '*' в подписках относится ко всем брокерам. Обработчикам
+    device_id передаётся с именем брокера, поэтому его можно сразу передать в set().
+
+    Пока у брокера в пуле больше max_pending необработанных сообщений, его сокет
+    не читается: перегруженный брокер упирается в TCP-окно, остальные обслуживаются.
+
+    Args:
+        brokers (dict): {имя: параметры}, параметры — (server_url, port) или словарь
+            с server_url, port и параметрами WbMqtt конкретного брокера
+        workers (int, optional): Потоков в общем пуле обработчиков, 0 — обработчики
+            выполняются в сетевом потоке
+        max_pending (int, optional): Необработанных сообщений брокера в пуле, после
+            которых чтение его сокета приостанавливается
+        read_batch (int, optional): Пакетов, читаемых из сокета брокера за один проход
+        **kwargs: Общие параметры WbMqtt для всех брокеров
+
+    Raises:
+        ValueError: Недопустимое имя брокера
+    """
+
+    def __init__(self, brokers, workers=0, max_pending=1000, read_batch=64, **kwargs):
+        self._shared_scheduler = _SharedScheduler(Scheduler())
+        self._connector = Scheduler(name="python2wb-connect")
+        self._executor = None
+        if workers:
+            # Переполнение ограничивается долей каждого брокера, а не очередью пула
+            self._executor = CallbackExecutor(workers, max_pending * len(brokers))
+        self._read_batch = max(1, read_batch)
+        self._soon = collections.deque()
+        self._dispatch_lock = threading.Lock()
+
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._io_lock = threading.Lock()
+        self._connecting = set()
+        # Сокеты в селекторе: {брокер: (сокет, события)}
+        self._registered = {}
+        self._thread = None
+        self._running = False
+
+        self._brokers = {}
+        for name, params in brokers.items():
+            if NAMESPACE_SEPARATOR in name or "/" in name or name == ALL_BROKERS:
+                raise ValueError("Invalid broker name: %s" % (name))
+            options = dict(kwargs)
+            if type(params) == dict:
+                options.update(params)
+            else:
+                options["server_url"], options["port"] = params
+            broker = BrokerWbMqtt(self, name, **options)
+            if self._executor is not None:
+                broker._executor = _BrokerExecutor(
+                    self._executor, max_pending, self._wake
+                )
+            self._brokers[name] = broker
+
+        for broker in self._brokers.values():
+            self._connector.call_later(0, broker._reconnect)
+
+    def __getitem__(self, name):
+        return self._brokers[name]
+
+    def broker(self, name):
+        """Клиент брокера
+
+        Args:
+            name (string): Имя брокера
+
+        Returns:
+            BrokerWbMqtt: Клиент, через него доступны остальные методы WbMqtt
+        """
+
+        return self._brokers[name]
+
+    def names(self):
+        """Имена брокеров"""
+
+        return list(self._brokers)
+
+    def _split(self, path, every=False):
+        """Внутреннее. Разбор пути с именем брокера
+
+        Args:
+            path (string): Путь 'ctrl3:device/control' или топик 'ctrl3:/devices/...'
+            every (bool): Путь без имени или с '*' относится ко всем брокерам
+
+        Returns:
+            list: Пары (имя брокера, клиент), и путь без имени брокера
+
+        Raises:
+            ValueError: Нет имени брокера или брокер неизвестен
+        """
+
+        name, separator, local = path.partition(NAMESPACE_SEPARATOR)
+        if not separator:
+            name, local = ALL_BROKERS, path
+        if name == ALL_BROKERS:
+            if not every:
+                raise ValueError(
+                    "Path must start with a broker name, e.g. 'ctrl1:%s'" % (local)
+                )
+            return list(self._brokers.items()), local
+
+        broker = self._brokers.get(name)
+        if broker is None:
+            raise ValueError("Unknown broker %s in %s" % (name, path))
+        return [(name, broker)], local
+
+    def _one(self, path):
+        """Внутреннее. Клиент брокера и путь без его имени"""
+
+        brokers, local = self._split(path)
+        return brokers[0][1], local
+
+    def get(self, control_path):
+        """Значение контрола из кэша брокера, например get('ctrl3:wb-gpio/A1_OUT')"""
+
+        broker, local = self._one(control_path)
+        return broker.get(local)
+
+    def get_entry(self, control_path):
+        """Значение контрола с меткой времени, см. WbMqtt.get_entry"""
+
+        broker, local = self._one(control_path)
+        return broker.get_entry(local)
+
+    def set(self, control_path, value):
+        """Запись значения в контрол, например set('ctrl3:wb-gpio/A1_OUT', 1)"""
+
+        broker, local = self._one(control_path)
+        return broker.set(local, value)
+
+    def set_and_confirm(self, control_path, value, timeout=5, tolerance=0):
+        """Запись с подтверждением, см. WbMqtt.set_and_confirm"""
+
+        broker, local = self._one(control_path)
+        return broker.set_and_confirm(local, value, timeout, tolerance)
+
+    def publish_raw(self, mqtt_topic, value, retain=False):
+        """Публикация в топик брокера, например publish_raw('ctrl3:/wbrules/log', 'text')"""
+
+        broker, local = self._one(mqtt_topic)
+        return broker.publish_raw(local, value, retain)
+
+    def _paths(self, control_path):
+        """Внутреннее. Пути по брокерам: {имя: [пути без имени брокера]}"""
+
+        if type(control_path) != list:
+            control_path = [control_path]
+        result = {}
+        for path in control_path:
+            brokers, local = self._split(path, every=True)
+            for name, broker in brokers:
+                result.setdefault(name, []).append(local)
+        return result
+
+    def subscribe(self, control_path, callback, **kwargs):
+        """Подписка на значения контролов одного или всех брокеров. Параметры
+            фильтрации как у WbMqtt.subscribe.
+
+        Args:
+            control_path (string, list): 'ctrl3:wb-gpio/+', '*:wb-gpio/A1_OUT'
+                или 'wb-gpio/A1_OUT' для всех брокеров, или список путей
+            callback (function): Обработчик события, параметры device_id с именем
+                брокера ('ctrl3:wb-gpio'), control_id, new_value
+        """
+
+        for name, paths in self._paths(control_path).items():
+            self._brokers[name].subscribe(paths, _namespaced(name, callback), **kwargs)
+
+    def unsubscribe(self, control_path):
+        """Отписка от контролов, пути как в subscribe()"""
+
+        for name, paths in self._paths(control_path).items():
+            self._brokers[name].unsubscribe(paths)
+
+    def subscribe_on(self, control_path, callback):
+        """Подписка на командные топики /on, пути как в subscribe()"""
+
+        for name, paths in self._paths(control_path).items():
+            self._brokers[name].subscribe_on(paths, _namespaced(name, callback))
+
+    def subscribe_errors(self, control_path, callback):
+        """Подписка на ошибки контролов, пути как в subscribe()"""
+
+        for name, paths in self._paths(control_path).items():
+            self._brokers[name].subscribe_errors(paths, _namespaced(name, callback))
+
+    def unsubscribe_errors(self, control_path):
+        """Отписка от ошибок контролов, пути как в subscribe()"""
+
+        for name, paths in self._paths(control_path).items():
+            self._brokers[name].unsubscribe_errors(paths)
+
+    def subscribe_raw(self, mqtt_topic, callback):
+        """Подписка на mqtt-топик: 'ctrl3:/wbrules/#' или '/wbrules/#' для всех брокеров
+
+        Args:
+            mqtt_topic (string): Топик с именем брокера
+            callback (function): Обработчик события, параметры mqtt_topic с именем брокера, new_value
+        """
+
+        for name, topics in self._paths(mqtt_topic).items():
+            for topic in topics:
+                self._brokers[name].subscribe_raw(topic, _namespaced(name, callback))
+
+    def unsubscribe_raw(self, mqtt_topic):
+        """Отписка от топика, топики как в subscribe_raw()"""
+
+        for name, topics in self._paths(mqtt_topic).items():
+            for topic in topics:
+                self._brokers[name].unsubscribe_raw(topic)
+
+    def _wake(self):
+        """Внутреннее. Прерывание ожидания сетевого цикла: есть данные на отправку,
+        открыт или закрыт сокет, освободилась очередь брокера
+        """
+
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _update_registrations(self):
+        """Внутреннее. Приведение селектора в соответствие с сокетами брокеров:
+        чтение, если брокер не перегружен, запись, если paho есть что отправить
+        """
+
+        selector = self._selector
+        registered = self._registered
+        with self._io_lock:
+            connecting = set(self._connecting)
+
+        for broker in self._brokers.values():
+            if broker in connecting:
+                continue
+            client = broker.client
+            sock = client.socket()
+            current = registered.get(broker)
+            if current is not None and current[0] is not sock:
+                selector.unregister(current[0])
+                del registered[broker]
+                current = None
+            if sock is None:
+                continue
+
+            events = 0
+            executor = broker._executor
+            if executor is None or not executor.overloaded():
+                events |= selectors.EVENT_READ
+            if client.want_write():
+                events |= selectors.EVENT_WRITE
+
+            if current is None:
+                if events:
+                    selector.register(sock, events, broker)
+                    registered[broker] = (sock, events)
+            elif not events:
+                selector.unregister(sock)
+                del registered[broker]
+            elif events != current[1]:
+                selector.modify(sock, events, broker)
+                registered[broker] = (sock, events)
+
+    def _run(self):
+        """Внутреннее. Сетевой цикл всех брокеров"""
+
+        selector = self._selector
+        read_batch = self._read_batch
+        next_misc = time.monotonic()
+        for broker in self._brokers.values():
+            broker._network_thread = threading.get_ident()
+
+        while self._running:
+            self._update_registrations()
+            timeout = max(0, next_misc - time.monotonic())
+            for key, events in selector.select(timeout):
+                broker = key.data
+                if broker is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+
+                client = broker.client
+                if events & selectors.EVENT_WRITE:
+                    client.loop_write()
+                if events & selectors.EVENT_READ:
+                    executor = broker._executor
+                    sock = key.fileobj
+                    for _ in range(read_batch):
+                        if client.loop_read() != mqtt.MQTT_ERR_SUCCESS:
+                            break
+                        if executor is not None and executor.overloaded():
+                            break
+                        if client.socket() is not sock or not _has_data(sock):
+                            break
+
+            now = time.monotonic()
+            if now >= next_misc:
+                next_misc = now + MISC_INTERVAL
+                with self._io_lock:
+                    connecting = set(self._connecting)
+                for broker in self._brokers.values():
+                    if broker not in connecting and broker.client.socket() is not None:
+                        broker.client.loop_misc()
+
+    def loop_start(self):
+        """Запуск сетевого цикла в отдельном потоке"""
+
+        if self._thread is not None:
+            return
+        self._start_processes()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="python2wb-io", daemon=True
+        )
+        self._thread.start()
+
+    def loop_forever(self):
+        """Сетевой цикл в текущем потоке"""
+
+        self._start_processes()
+        self._running = True
+        self._run()
+
+    def _start_processes(self):
+        """Внутреннее. Создание процессов-обработчиков брокеров до запуска сетевого цикла"""
+
+        if self._executor is not None:
+            # Обработчики брокеров выполняет общий пул потоков
+            return
+        for broker in self._brokers.values():
+            broker.start_processes()
+
+    def loop_stop(self):
+        """Останов сетевого цикла"""
+
+        self._running = False
+        self._wake()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+
+    def stats(self):
+        """Метрики по брокерам и общего сетевого цикла
+
+        Returns:
+            dict: brokers — stats() каждого брокера с состоянием подключения,
+                executor — общий пул. В stats() брокера executor — его доля в пуле:
+                pending, paused и pauses — сколько раз чтение приостанавливалось.
+        """
+
+        brokers = {}
+        for name, broker in self._brokers.items():
+            stats = broker.stats() or {}
+            stats["connected"] = broker._connected
+            stats["connect_attempts"] = broker.connect_attempts
+            brokers[name] = stats
+        result = {"brokers": brokers}
+        if self._executor is not None:
+            result["executor"] = self._executor.stats()
+        return result
+
+    def clear(self, timeout=1.0):
+        """Очистка виртуальных устройств, подписок и отключение от всех брокеров
+
+        Args:
+            timeout (float, optional): Ожидание отправки отключения в секундах
+        """
+
+        for broker in self._brokers.values():
+            broker.clear()
+        self._connector.stop()
+
+        if self._thread is not None:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and any(
+                broker.client.socket() is not None for broker in self._brokers.values()
+            ):
+                self._wake()
+                time.sleep(0.01)
+        self.loop_stop()
+
+        self._shared_scheduler._scheduler.stop()
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
@@ -0,0 +1,359 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import signal
+import threading
+import traceback
+
+# Сообщения в процесс-обработчик: пачка вызовов, регистрация обработчика, останов
+_BATCH = 0
+_REGISTER = 1
+
+# Запросы процесса-обработчика к родителю
+RPC_SET = "set"
+RPC_PUBLISH = "publish"
+RPC_GET = "get"
+RPC_ERRORS = "errors"
+
+
+def _worker_main(index, tasks, rpc, callbacks, target):
+    """Внутреннее. Цикл процесса-обработчика.
+
+    Процесс создан через fork и унаследовал обработчики, известные к этому
+    моменту. set(), publish_raw() и get() объекта target заменяются запросами
+    к родителю: MQTT-подключение есть только у него.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def set_value(control_path, value):
+        rpc.send((RPC_SET, control_path, value))
+
+    def publish_raw(mqtt_topic, value, retain=False):
+        rpc.send((RPC_PUBLISH, mqtt_topic, value, retain))
+
+    def get(control_path):
+        rpc.send((RPC_GET, control_path))
+        return rpc.recv()
+
+    if target is not None:
+        target.set = set_value
+        target.publish_raw = publish_raw
+        target.get = get
+
+    errors = 0
+    while True:
+        try:
+            message = tasks.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        kind, payload = message
+        if kind == _REGISTER:
+            callback_id, data = payload
+            try:
+                callbacks[callback_id] = pickle.loads(data)
+            except Exception:
+                traceback.print_exc()
+            continue
+
+        reported = errors
+        for callback_id, args in payload:
+            callback = callbacks.get(callback_id)
+            if callback is None:
+                continue
+            try:
+                callback(*args)
+            except Exception:
+                errors += 1
+                traceback.print_exc()
+        if errors != reported:
+            rpc.send((RPC_ERRORS, errors - reported))
+
+    tasks.close()
+    rpc.close()
+    os._exit(0)
+
+
+class _Shard:
+    """Процесс-обработчик в родителе: буфер пачки и каналы связи"""
+
+    def __init__(self, index):
+        self.index = index
+        self.batch = []
+        self.timer = None
+        self.lock = threading.Lock()
+        self.tasks = None
+        self.rpc = None
+        self.process = None
+        self.known = set()
+
+
+class ProcessExecutor:
+    """Пул процессов для обработчиков с тяжёлыми вычислениями, которым не хватает
+    одного ядра из-за GIL. Интерфейс как у CallbackExecutor.
+
+    Задачи с одинаковым ключом (устройство или контрол) попадают в один процесс,
+    поэтому порядок их выполнения сохраняется. Вызовы передаются пачками по
+    batch_size или через batch_latency секунд после первого вызова в пачке:
+    одна сериализация pickle на пачку. Процессы создаются через fork в start(),
+    который нужно вызывать до запуска сетевого потока; если он не был вызван,
+    то при первом вызове. Обработчики, объявленные позже, передаются через pickle.
+    Обработчик, который нельзя сериализовать (лямбда, замыкание), выполняется в родителе.
+
+    Процесс наследует копию памяти родителя вместе с блокировками, захваченными
+    другими потоками в момент fork, а сами потоки в процесс не переходят. Поэтому
+    в процессах объект target используется только через заменённые set,
+    publish_raw и get, а MQTT-клиент и другие объекты родителя трогать нельзя.
+
+    Args:
+        processes (int): Количество процессов
+        schedule (function): Отложенный вызов функции: schedule(delay, callback)
+        handlers (dict): Обработчики запросов процессов {RPC_SET: set, RPC_PUBLISH: ..., RPC_GET: ...}
+        target (obj, optional): Объект, у которого в процессах заменяются set, publish_raw и get
+        batch_size (int, optional): Максимальный размер пачки
+        batch_latency (float, optional): Максимальная задержка пачки в секундах
+    """
+
+    def __init__(
+        self,
+        processes,
+        schedule,
+        handlers,
+        target=None,
+        batch_size=64,
+        batch_latency=0.005,
+    ):
+        self._context = multiprocessing.get_context("fork")
+        self._schedule = schedule
+        self._handlers = handlers
+        self._target = target
+        self.batch_size = max(1, batch_size)
+        self.batch_latency = batch_latency
+        self._shards = [_Shard(index) for index in range(max(1, processes))]
+        self._callbacks = {}
+        self._ids = {}
+        self._local = set()
+        self._lock = threading.Lock()
+        self._started = False
+        self._running = True
+        self._rpc_thread = None
+        self.batches = 0
+        self.calls = 0
+        self.local_calls = 0
+        self.errors = 0
+
+    def start(self):
+        """Создание процессов. Обработчики, объявленные до вызова, наследуются без pickle."""
+
+        with self._lock:
+            if self._started or not self._running:
+                return
+            callbacks = dict(self._callbacks)
+            for shard in self._shards:
+                # Pipe(duplex=False) возвращает конец для чтения и конец для записи
+                reader, shard.tasks = self._context.Pipe(duplex=False)
+                shard.rpc, child_rpc = self._context.Pipe()
+                shard.process = self._context.Process(
+                    target=_worker_main,
+                    args=(shard.index, reader, child_rpc, callbacks, self._target),
+                    name="python2wb-process-%d" % shard.index,
+                    daemon=True,
+                )
+                shard.process.start()
+                reader.close()
+                child_rpc.close()
+                shard.known = set(callbacks)
+            self._started = True
+
+            self._rpc_thread = threading.Thread(
+                target=self._serve_rpc, name="python2wb-process-rpc", daemon=True
+            )
+            self._rpc_thread.start()
+
+    def register(self, callback):
+        """Объявление обработчика при подписке. Обработчики, объявленные до создания
+        процессов, наследуются через fork, в том числе лямбды и замыкания.
+        """
+
+        self._callback_id(callback)
+
+    def _callback_id(self, callback):
+        """Внутреннее. Номер обработчика, общий для родителя и процессов"""
+
+        callback_id = self._ids.get(callback)
+        if callback_id is None:
+            with self._lock:
+                callback_id = self._ids.get(callback)
+                if callback_id is None:
+                    callback_id = len(self._ids)
+                    self._callbacks[callback_id] = callback
+                    self._ids[callback] = callback_id
+        return callback_id
+
+    def _register(self, shard, callback_id):
+        """Внутреннее. Передача обработчика, объявленного после создания процессов
+
+        Returns:
+            bool: False, если обработчик нельзя сериализовать
+        """
+
+        if callback_id in self._local:
+            return False
+        callback = self._callbacks[callback_id]
+        try:
+            data = pickle.dumps(callback)
+        except Exception as e:
+            self._local.add(callback_id)
+            print(
+                "Callback %r can not be sent to worker processes (%s), "
+                "it will run in the main process" % (callback, e)
+            )
+            return False
+        shard.tasks.send((_REGISTER, (callback_id, data)))
+        shard.known.add(callback_id)
+        return True
+
+    def submit(self, key, callback, args, coalesce_key=None):
+        """Постановка обработчика в пачку процесса
+
+        Args:
+            key (string): Ключ упорядочивания, например идентификатор устройства
+            callback (function): Обработчик
+            args (tuple): Аргументы обработчика, должны сериализоваться pickle
+            coalesce_key (object, optional): Не используется, для совместимости с CallbackExecutor
+        """
+
+        if not self._started:
+            self.start()
+
+        callback_id = self._callback_id(callback)
+        if callback_id in self._local:
+            self.local_calls += 1
+            callback(*args)
+            return
+
+        shard = self._shards[hash(key) % len(self._shards)]
+        with shard.lock:
+            local = callback_id not in shard.known and not self._register(
+                shard, callback_id
+            )
+            if not local:
+                shard.batch.append((callback_id, args))
+                if len(shard.batch) >= self.batch_size:
+                    self._send(shard)
+                elif shard.timer is None:
+                    shard.timer = self._schedule(
+                        self.batch_latency, self._flush_shard, shard
+                    )
+        if local:
+            self.local_calls += 1
+            callback(*args)
+
+    def _flush_shard(self, shard):
+        """Внутреннее. Отправка пачки по истечении batch_latency"""
+
+        with shard.lock:
+            shard.timer = None
+            self._send(shard)
+
+    def _send(self, shard):
+        """Внутреннее. Отправка пачки процессу, вызывается под shard.lock"""
+
+        batch = shard.batch
+        if not batch or not self._running:
+            return
+        shard.batch = []
+        try:
+            shard.tasks.send((_BATCH, batch))
+        except (OSError, ValueError):
+            print("Worker process %d is not available" % (shard.index))
+            return
+        self.batches += 1
+        self.calls += len(batch)
+
+    def flush(self):
+        """Отправка всех неполных пачек"""
+
+        for shard in self._shards:
+            with shard.lock:
+                if shard.timer is not None:
+                    shard.timer.cancel()
+                    shard.timer = None
+                self._send(shard)
+
+    def _serve_rpc(self):
+        """Внутреннее. Выполнение запросов процессов через MQTT-подключение родителя"""
+
+        connections = [shard.rpc for shard in self._shards]
+        while connections:
+            for connection in multiprocessing.connection.wait(connections):
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    connections.remove(connection)
+                    continue
+                try:
+                    self._handle_rpc(connection, request)
+                except Exception:
+                    traceback.print_exc()
+
+    def _handle_rpc(self, connection, request):
+        kind = request[0]
+        if kind == RPC_ERRORS:
+            self.errors += request[1]
+        elif kind == RPC_GET:
+            connection.send(self._handlers[RPC_GET](request[1]))
+        else:
+            self._handlers[kind](*request[1:])
+
+    def qsize(self):
+        """Количество вызовов в неотправленных пачках"""
+
+        return sum(len(shard.batch) for shard in self._shards)
+
+    def stats(self):
+        """Состояние пула
+
+        Returns:
+            dict: Количество процессов, отправленные пачки и вызовы, вызовы в родителе, ошибки
+        """
+
+        return {
+            "processes": len(self._shards),
+            "started": self._started,
+            "batches": self.batches,
+            "calls": self.calls,
+            "local_calls": self.local_calls,
+            "errors": self.errors,
+            "queue_depth": [len(shard.batch) for shard in self._shards],
+        }
+
+    def shutdown(self, wait=True):
+        """Останов процессов. Вызовы, уже переданные процессам, будут выполнены.
+
+        Args:
+            wait (bool, optional): Ждать завершения процессов. По умолчанию True.
+        """
+
+        self.flush()
+        with self._lock:
+            self._running = False
+            started = self._started
+        if not started:
+            return
+
+        for shard in self._shards:
+            try:
+                shard.tasks.send(None)
+            except (OSError, ValueError):
+                pass
+        if wait:
+            for shard in self._shards:
+                shard.process.join()
+                shard.tasks.close()
+            if self._rpc_thread is not threading.current_thread():
+                self._rpc_thread.join(1)
@@ -0,0 +1,277 @@
+import collections
+import threading
+import time
+
+
+class TokenBucket:
+    """Ограничитель частоты по алгоритму token bucket
+
+    Args:
+        rate (float): Количество сообщений в секунду
+        burst (int, optional): Размер корзины. По умолчанию равен rate, но не меньше 1.
+        now (float, optional): Время создания по time.monotonic(). По умолчанию текущее.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst else max(1, rate))
+        self.tokens = self.capacity
+        self.stamp = time.monotonic() if now is None else now
+
+    def delay(self, now):
+        """Время до появления свободного токена
+
+        Returns:
+            float: 0, если токен есть, иначе задержка в секундах
+        """
+
+        tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.tokens = tokens
+        self.stamp = now
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / self.rate
+
+    def take(self):
+        """Забрать токен. Перед вызовом нужно проверить delay()"""
+
+        self.tokens -= 1
+
+
+class OutboundQueue:
+    """Исходящая очередь с объединением значений по топику и ограничением частоты.
+
+    Пока значение ждёт отправки, новое значение того же топика заменяет его,
+    место в очереди при этом сохраняется. Отправляется только последнее значение.
+
+    Args:
+        publish (function): Функция отправки с параметрами topic, payload, qos, retain
+        rate (float, optional): Общее ограничение сообщений в секунду
+        device_rate (float, optional): Ограничение сообщений в секунду для каждого устройства
+        burst (int, optional): Размер корзины ограничителей
+        flush_interval (float, optional): Интервал, за который собираются значения перед отправкой
+    """
+
+    def __init__(
+        self, publish, rate=None, device_rate=None, burst=None, flush_interval=0
+    ):
+        self._publish = publish
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._rate = TokenBucket(rate, burst) if rate else None
+        self._device_rate = device_rate
+        self._burst = burst
+        self._device_buckets = {}
+        self.flush_interval = flush_interval
+        self.coalesced = 0
+        self.sent = 0
+
+    def offer(self, topic, payload, qos, retain, device_id=None):
+        """Постановка значения в очередь
+
+        Args:
+            topic (string): Полный путь к mqtt-топику
+            payload (float, int, str): Значение
+            qos (int): QoS публикации
+            retain (bool): Retain-флаг
+            device_id (string, optional): Устройство, к которому применяется ограничение частоты
+        """
+
+        with self._lock:
+            if topic in self._pending:
+                self.coalesced += 1
+            self._pending[topic] = (device_id, payload, qos, retain)
+
+    def flush(self, now=None):
+        """Отправка значений, для которых хватает токенов
+
+        Args:
+            now (float, optional): Текущее время по time.monotonic()
+
+        Returns:
+            float: Задержка до следующей попытки или None, если очередь пуста
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        ready = []
+        wait = None
+
+        with self._lock:
+            blocked = set()
+            for topic, item in list(self._pending.items()):
+                device_id = item[0]
+                if device_id in blocked:
+                    continue
+
+                if self._rate is not None:
+                    delay = self._rate.delay(now)
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+                        break
+
+                bucket = None
+                if self._device_rate and device_id is not None:
+                    bucket = self._device_buckets.get(device_id)
+                    if bucket is None:
+                        # Время корзины — то же now, иначе первый delay() получит
+                        # отрицательный интервал и заберёт часть токенов
+                        bucket = TokenBucket(self._device_rate, self._burst, now)
+                        self._device_buckets[device_id] = bucket
+                    delay = bucket.delay(now)
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+                        blocked.add(device_id)
+                        continue
+                    bucket.take()
+
+                if self._rate is not None:
+                    self._rate.take()
+
+                del self._pending[topic]
+                ready.append((topic, item))
+
+            if self._pending and wait is None:
+                wait = 0
+
+        for topic, item in ready:
+            self._publish(topic, item[1], item[2], item[3])
+        self.sent += len(ready)
+
+        return wait
+
+    def drain(self):
+        """Отправка всех ожидающих значений без учёта ограничений"""
+
+        with self._lock:
+            items = list(self._pending.items())
+            self._pending.clear()
+
+        for topic, item in items:
+            self._publish(topic, item[1], item[2], item[3])
+        self.sent += len(items)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class OfflineQueue:
+    """Очередь публикаций на время отсутствия подключения к брокеру.
+
+    Хранится только последнее значение каждого топика, порядок топиков — по времени
+    последней записи. При переполнении вытесняются самые старые топики.
+
+    Args:
+        limit (int): Максимальное число топиков в очереди
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self._pending = collections.OrderedDict()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def offer(self, topic, payload, qos, retain):
+        """Постановка значения в очередь
+
+        Args:
+            topic (string): Полный путь к mqtt-топику
+            payload (float, int, str): Значение
+            qos (int): QoS публикации
+            retain (bool): Retain-флаг
+        """
+
+        pending = self._pending
+        if topic in pending:
+            self.coalesced += 1
+            del pending[topic]
+        elif len(pending) >= self.limit:
+            pending.popitem(last=False)
+            self.dropped += 1
+        pending[topic] = (payload, qos, retain)
+
+    def take(self):
+        """Извлечение всех значений в порядке постановки
+
+        Returns:
+            list: Кортежи (topic, payload, qos, retain)
+        """
+
+        items = [(topic,) + item for topic, item in self._pending.items()]
+        self._pending.clear()
+        return items
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class PipelinedPublisher:
+    """Публикация пачки сообщений без ожидания подтверждения каждого.
+
+    Одновременно в полёте не больше window неподтверждённых сообщений,
+    подтверждения всех ждём в конце методом wait().
+
+    Args:
+        publish (function): Функция отправки с параметрами topic, payload, qos, retain,
+            возвращает MQTTMessageInfo
+        pump (function): Функция ожидания сетевых событий с параметром timeout
+        window (int, optional): Максимальное число неподтверждённых сообщений
+    """
+
+    def __init__(self, publish, pump, window=100):
+        self._publish = publish
+        self._pump = pump
+        self._window = max(1, window)
+        self._inflight = collections.deque()
+        self.sent = 0
+
+    def _reap(self):
+        inflight = self._inflight
+        while inflight and inflight[0].is_published():
+            inflight.popleft()
+        if len(inflight) >= self._window:
+            self._inflight = collections.deque(
+                info for info in inflight if not info.is_published()
+            )
+
+    def publish(self, topic, payload, qos, retain):
+        """Отправка сообщения. Блокируется, пока окно заполнено."""
+
+        self._reap()
+        while len(self._inflight) >= self._window:
+            self._pump(0.01)
+            self._reap()
+
+        info = self._publish(topic, payload, qos, retain)
+        self.sent += 1
+        # Без подключения paho сам поставит сообщение в очередь, ждать его не нужно
+        if qos and info.rc == 0 and not info.is_published():
+            self._inflight.append(info)
+
+    def pending(self):
+        """Количество неподтверждённых сообщений"""
+
+        self._inflight = collections.deque(
+            info for info in self._inflight if not info.is_published()
+        )
+        return len(self._inflight)
+
+    def wait(self, timeout=None):
+        """Ожидание подтверждения всех отправленных сообщений
+
+        Args:
+            timeout (float, optional): Время ожидания в секундах. По умолчанию без ограничения.
+
+        Returns:
+            bool: True, если все сообщения подтверждены
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            self._pump(0.01)
+        return True
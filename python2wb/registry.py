@@ -0,0 +1,153 @@
+WB_DEVICE_PATH = "/devices/%s"
+WB_CONTROLS_PATH = "/devices/%s/controls/%s"
+
+# Топики контрола виртуального устройства, которые нужно очистить при удалении
+CONTROL_TOPIC_SUFFIXES = ("/on", "/meta/type", "/meta", "")
+
+
+class VirtualDevice:
+    """Виртуальное устройство, созданное этим объектом
+
+    Attributes:
+        device_id (string): Идентификатор устройства
+        title (string, dict): Заголовок устройства
+        controls (dict): Описания контролов {имя: описание}
+        values (dict): Последние опубликованные значения контролов {имя: значение}
+            в том виде, в котором они ушли брокеру
+    """
+
+    __slots__ = ("device_id", "title", "controls", "values")
+
+    def __init__(self, device_id, title=None):
+        self.device_id = device_id
+        self.title = title
+        self.controls = {}
+        self.values = {}
+
+    def control_paths(self):
+        """Пути к контролам в формате 'device/control'"""
+
+        return ["%s/%s" % (self.device_id, name) for name in self.controls]
+
+    def topics(self):
+        """Все retained-топики устройства: сначала контролы, затем само устройство
+
+        Returns:
+            list: Полные пути к mqtt-топикам
+        """
+
+        topics = []
+        for name in self.controls:
+            control_topic = WB_CONTROLS_PATH % (self.device_id, name)
+            for suffix in CONTROL_TOPIC_SUFFIXES:
+                topics.append(control_topic + suffix)
+
+        device_topic = WB_DEVICE_PATH % self.device_id
+        topics.append(device_topic + "/meta")
+        topics.append(device_topic)
+        return topics
+
+
+class VirtualDeviceRegistry:
+    """Реестр виртуальных устройств одного объекта WbMqtt: устройство → контролы → топики.
+
+    Поддерживает проверку 'device_id in registry' и перебор идентификаторов устройств,
+    как прежний список virtual_devices.
+    """
+
+    def __init__(self):
+        self._devices = {}
+
+    def add(self, device_id, title=None):
+        """Добавление устройства. Если оно уже есть — обновляется заголовок.
+
+        Returns:
+            VirtualDevice: Устройство
+        """
+
+        device = self._devices.get(device_id)
+        if device is None:
+            device = VirtualDevice(device_id, title)
+            self._devices[device_id] = device
+        elif title is not None:
+            device.title = title
+        return device
+
+    def add_control(self, device_id, control):
+        """Добавление описания контрола к устройству
+
+        Returns:
+            string: Путь к контролу в формате 'device/control' или None, если устройства нет
+        """
+
+        device = self._devices.get(device_id)
+        if device is None:
+            return None
+        name = control.get("name")
+        device.controls[name] = control
+        return "%s/%s" % (device_id, name)
+
+    def remove_control(self, device_id, name):
+        """Удаление описания контрола
+
+        Returns:
+            dict: Описание удалённого контрола или None
+        """
+
+        device = self._devices.get(device_id)
+        if device is None:
+            return None
+        device.values.pop(name, None)
+        return device.controls.pop(name, None)
+
+    def set_value(self, device_id, name, payload):
+        """Запоминание последнего опубликованного значения контрола для повторной
+            публикации после переподключения. Значение хранится без преобразования
+            по типу, чтобы брокер получил те же байты: "7" не должно стать "7.0".
+
+        Returns:
+            bool: True, если контрол принадлежит устройству из реестра
+        """
+
+        device = self._devices.get(device_id)
+        if device is None or name not in device.controls:
+            return False
+        device.values[name] = payload
+        return True
+
+    def remove(self, device_id):
+        """Удаление устройства из реестра
+
+        Returns:
+            VirtualDevice: Удалённое устройство или None
+        """
+
+        return self._devices.pop(device_id, None)
+
+    def get(self, device_id):
+        """Устройство по идентификатору или None"""
+
+        return self._devices.get(device_id)
+
+    def has_control(self, device_id, name):
+        """Проверка, что контрол принадлежит виртуальному устройству этого объекта"""
+
+        device = self._devices.get(device_id)
+        return device is not None and name in device.controls
+
+    def devices(self):
+        """Список устройств"""
+
+        return list(self._devices.values())
+
+    def __contains__(self, device_id):
+        return device_id in self._devices
+
+    def __iter__(self):
+        return iter(list(self._devices))
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __repr__(self):
+        return "VirtualDeviceRegistry(%r)" % list(self._devices)
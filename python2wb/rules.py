@@ -0,0 +1,317 @@
+import heapq
+import itertools
+import threading
+import traceback
+
+from .metrics import callback_name
+
+
+class Rule:
+    """Правило: функция от значений входных контролов, результат пишется в выходные
+
+    Attributes:
+        func (function): Функция правила, аргументы — значения inputs по порядку
+        inputs (tuple): Пути входных контролов в формате 'device/control'
+        outputs (tuple): Пути выходных контролов
+        name (string): Имя для сообщений об ошибках и циклах
+        rank (int): Уровень в графе зависимостей: правило вычисляется после
+            всех правил, от выходов которых зависит
+    """
+
+    __slots__ = ("func", "inputs", "outputs", "name", "rank", "calls", "errors")
+
+    def __init__(self, func, inputs, outputs, name=None):
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.name = name or callback_name(func)
+        self.rank = 0
+        self.calls = 0
+        self.errors = 0
+
+    def results(self, result):
+        """Значения выходов из результата функции: одно значение при одном выходе,
+            кортеж или список по порядку outputs, словарь {выход: значение}.
+            None означает, что выход не меняется.
+
+        Returns:
+            list: Пары (путь к контролу, значение)
+        """
+
+        outputs = self.outputs
+        if not outputs or result is None:
+            return []
+        if type(result) == dict:
+            unknown = [path for path in result if path not in outputs]
+            if unknown:
+                raise ValueError(
+                    "Rule %s returned undeclared outputs: %s"
+                    % (self.name, ", ".join(unknown))
+                )
+            pairs = result.items()
+        elif len(outputs) == 1:
+            pairs = ((outputs[0], result),)
+        else:
+            if len(result) != len(outputs):
+                raise ValueError(
+                    "Rule %s returned %d values for %d outputs"
+                    % (self.name, len(result), len(outputs))
+                )
+            pairs = zip(outputs, result)
+        return [(path, value) for path, value in pairs if value is not None]
+
+    def __repr__(self):
+        return "Rule(%s, inputs=%r, outputs=%r)" % (
+            self.name,
+            list(self.inputs),
+            list(self.outputs),
+        )
+
+
+class RuleEngine:
+    """Граф зависимостей между контролами и правилами с инкрементальным вычислением.
+
+    Входящие значения только помечают зависящие от них правила. Помеченные правила
+    вычисляются одной пачкой через планировщик в порядке уровней графа: выходы
+    правила сразу видны правилам следующих уровней, поэтому цепочка правил
+    вычисляется за один проход. Каждый изменившийся выход публикуется один раз
+    с последним значением, неизменившиеся выходы не публикуются.
+
+    Args:
+        entry (function): Запись кэша контрола по пути
+        write (function): Публикация значения выхода
+        convert (function): Преобразование значения по типу контрола для сравнения
+        schedule (function): Отложенный вызов функции без аргументов
+    """
+
+    def __init__(self, entry, write, convert, schedule):
+        self._entry = entry
+        self._write = write
+        self._convert = convert
+        self._schedule = schedule
+        self._rules = []
+        # Словарь заменяется целиком, чтобы сетевой поток читал его без блокировки
+        self.inputs = {}
+        self._seen = {}
+        # Опубликованные выходы до получения эха: {путь: (значение, seq записи кэша)}
+        self._written = {}
+        self._dirty = set()
+        self._scheduled = False
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        self._evaluating = threading.Lock()
+        self.batches = 0
+        self.evaluations = 0
+        self.publishes = 0
+
+    def add(self, rule):
+        """Добавление правила. Правило будет вычислено, когда у всех входов появятся значения.
+
+        Raises:
+            ValueError: Правило замыкает цикл в графе зависимостей
+        """
+
+        with self._lock:
+            rules = self._rules + [rule]
+            self._rank(rules)
+            self._rules = rules
+            self._index()
+            self._dirty.add(rule)
+            self._request()
+
+    def remove(self, func):
+        """Удаление правил с функцией func
+
+        Returns:
+            int: Количество удалённых правил
+        """
+
+        with self._lock:
+            rules = [rule for rule in self._rules if rule.func is not func]
+            removed = len(self._rules) - len(rules)
+            if removed:
+                self._rank(rules)
+                self._rules = rules
+                self._index()
+                self._dirty = {rule for rule in self._dirty if rule.func is not func}
+            return removed
+
+    def rules(self):
+        """Список правил в порядке вычисления"""
+
+        return sorted(self._rules, key=lambda rule: rule.rank)
+
+    def _index(self):
+        inputs = {}
+        for rule in self._rules:
+            for path in rule.inputs:
+                inputs.setdefault(path, []).append(rule)
+        self.inputs = inputs
+
+    def _rank(self, rules):
+        """Внутреннее. Проверка графа на циклы и расчёт уровней правил
+
+        Raises:
+            ValueError: В графе есть цикл
+        """
+
+        producers = {}
+        for rule in rules:
+            for path in rule.outputs:
+                producers.setdefault(path, []).append(rule)
+
+        ranks = {}
+        visiting = []
+
+        def visit(rule):
+            if rule in ranks:
+                return ranks[rule]
+            if rule in visiting:
+                cycle = visiting[visiting.index(rule) :] + [rule]
+                raise ValueError(
+                    "Rule cycle: %s" % " -> ".join(item.name for item in cycle)
+                )
+            visiting.append(rule)
+            rank = 0
+            for path in rule.inputs:
+                for producer in producers.get(path, ()):
+                    rank = max(rank, visit(producer) + 1)
+            visiting.pop()
+            ranks[rule] = rank
+            return rank
+
+        for rule in rules:
+            visit(rule)
+        for rule, rank in ranks.items():
+            rule.rank = rank
+
+    def changed(self, control_path, value):
+        """Пришло значение входного контрола. Повторное значение правила не помечает.
+
+        Returns:
+            bool: True, если помечены правила
+        """
+
+        rules = self.inputs.get(control_path)
+        if not rules:
+            return False
+        with self._lock:
+            if self._seen.get(control_path, self) == value:
+                return False
+            self._seen[control_path] = value
+            self._dirty.update(rules)
+            self._request()
+        return True
+
+    def _request(self):
+        """Внутреннее. Планирование вычисления пачки, если оно ещё не запланировано"""
+
+        if not self._scheduled:
+            self._scheduled = True
+            self._schedule(self.flush)
+
+    def flush(self):
+        """Вычисление помеченных правил и публикация изменившихся выходов
+
+        Returns:
+            int: Количество опубликованных значений
+        """
+
+        with self._lock:
+            self._scheduled = False
+            dirty = self._dirty
+            self._dirty = set()
+        if not dirty:
+            return 0
+
+        # Сетевой поток не ждёт вычисления правил: он только помечает их под self._lock
+        with self._evaluating:
+            writes = self._evaluate(dirty)
+            for path, value in writes.items():
+                self._write(path, value)
+            self.batches += 1
+            self.publishes += len(writes)
+        return len(writes)
+
+    def _evaluate(self, dirty):
+        """Внутреннее. Вычисление правил в порядке уровней графа
+
+        Returns:
+            dict: Изменившиеся выходы {путь: значение для публикации}
+        """
+
+        queue = [(rule.rank, next(self._counter), rule) for rule in dirty]
+        heapq.heapify(queue)
+        queued = set(dirty)
+        values = {}
+        writes = {}
+
+        while queue:
+            rule = heapq.heappop(queue)[2]
+            queued.discard(rule)
+
+            arguments = []
+            for path in rule.inputs:
+                value = values[path] if path in values else self._current(path)
+                if value is None:
+                    break
+                arguments.append(value)
+            else:
+                self.evaluations += 1
+                rule.calls += 1
+                try:
+                    pairs = rule.results(rule.func(*arguments))
+                except Exception:
+                    rule.errors += 1
+                    traceback.print_exc()
+                    continue
+
+                for path, value in pairs:
+                    converted = self._convert(path, str(value))
+                    current = values[path] if path in values else self._current(path)
+                    if converted == current:
+                        continue
+                    values[path] = converted
+                    writes[path] = value
+                    entry = self._entry(path)
+                    self._written[path] = (
+                        converted,
+                        entry.seq if entry is not None else None,
+                    )
+                    with self._lock:
+                        # Эхо собственной публикации не должно вызывать повторное вычисление
+                        self._seen[path] = converted
+                    for dependent in self.inputs.get(path, ()):
+                        if dependent not in queued:
+                            queued.add(dependent)
+                            heapq.heappush(
+                                queue, (dependent.rank, next(self._counter), dependent)
+                            )
+        return writes
+
+    def _current(self, control_path):
+        """Внутреннее. Значение контрола с учётом опубликованного, но ещё не
+        вернувшегося от брокера значения выхода
+        """
+
+        entry = self._entry(control_path)
+        written = self._written.get(control_path)
+        if written is not None:
+            if entry is None or entry.seq == written[1]:
+                return written[0]
+            del self._written[control_path]
+        return entry.value if entry is not None else None
+
+    def stats(self):
+        """Счётчики: пачки, вычисления правил, публикации, вызовы и ошибки по правилам"""
+
+        return {
+            "rules": len(self._rules),
+            "batches": self.batches,
+            "evaluations": self.evaluations,
+            "publishes": self.publishes,
+            "by_rule": {
+                rule.name: {"calls": rule.calls, "errors": rule.errors}
+                for rule in self._rules
+            },
+        }
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class Timer:
+    """Отложенный вызов, созданный планировщиком"""
+
+    __slots__ = ("when", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, when, callback, args, scheduler=None):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        """Отмена вызова"""
+
+        if not self.cancelled:
+            self.cancelled = True
+            if self.scheduler is not None:
+                self.scheduler._cancelled(self)
+
+
+class Scheduler:
+    """Планировщик отложенных вызовов на куче с одним потоком.
+
+    Поток запускается при первой постановке вызова. Отменённые вызовы
+    не удаляются из кучи сразу, а пропускаются при извлечении. Когда отменённых
+    становится больше половины кучи, она перестраивается, поэтому частая отмена
+    и перепланирование не раздувают память.
+    """
+
+    def __init__(self, name="python2wb-scheduler"):
+        self._name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = True
+        self._cancelled_count = 0
+
+    def time(self):
+        """Текущее время планировщика"""
+
+        return time.monotonic()
+
+    def call_later(self, delay, callback, *args):
+        """Вызов функции через delay секунд
+
+        Args:
+            delay (float): Задержка в секундах
+            callback (function): Функция
+            *args: Аргументы функции
+
+        Returns:
+            Timer: Объект с методом cancel()
+        """
+
+        return self.call_at(time.monotonic() + max(0, delay), callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """Вызов функции в момент when по часам time.monotonic()
+
+        Returns:
+            Timer: Объект с методом cancel()
+        """
+
+        timer = Timer(when, callback, args, self)
+        with self._condition:
+            if not self._running:
+                return timer
+            heapq.heappush(self._heap, (when, next(self._counter), timer))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=self._name, daemon=True
+                )
+                self._thread.start()
+            elif self._heap[0][2] is timer:
+                self._condition.notify()
+        return timer
+
+    def _run(self):
+        heap = self._heap
+        condition = self._condition
+
+        while True:
+            with condition:
+                while self._running:
+                    if heap:
+                        delay = heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        condition.wait(delay)
+                    else:
+                        condition.wait()
+                if not self._running:
+                    return
+                timer = heapq.heappop(heap)[2]
+
+            if timer.cancelled:
+                with condition:
+                    self._cancelled_count = max(0, self._cancelled_count - 1)
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                traceback.print_exc()
+
+    def _cancelled(self, timer):
+        """Внутреннее. Учёт отменённого вызова и перестроение кучи"""
+
+        with self._condition:
+            self._cancelled_count += 1
+            heap = self._heap
+            if self._cancelled_count > 64 and self._cancelled_count * 2 > len(heap):
+                heap[:] = [item for item in heap if not item[2].cancelled]
+                heapq.heapify(heap)
+                self._cancelled_count = 0
+                self._condition.notify()
+
+    def __len__(self):
+        return max(0, len(self._heap) - self._cancelled_count)
+
+    def stop(self):
+        """Останов планировщика. Вызовы, которые ещё не наступили, отбрасываются."""
+
+        with self._condition:
+            self._running = False
+            self._heap.clear()
+            self._cancelled_count = 0
+            self._condition.notify()
+
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
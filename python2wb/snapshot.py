@@ -0,0 +1,126 @@
+import os
+import struct
+
+# Формат файла:
+#   заголовок: MAGIC, версия (B), количество записей (I)
+#   запись: длина пути (H), путь, длина типа (B), тип, тег значения (B),
+#           значение, время получения (d)
+#   значение: int — q, float — d, str — длина (I) и байты в utf-8, None — пусто
+MAGIC = b"P2WBSNAP"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sBI")
+_PATH = struct.Struct("<H")
+_BYTE = struct.Struct("<B")
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_LENGTH = struct.Struct("<I")
+
+TAG_NONE = 0
+TAG_INT = 1
+TAG_FLOAT = 2
+TAG_STR = 3
+
+
+def _encode_value(value):
+    if value is None:
+        return _BYTE.pack(TAG_NONE)
+    if type(value) == int and -(2**63) <= value < 2**63:
+        return _BYTE.pack(TAG_INT) + _INT.pack(value)
+    if type(value) == float:
+        return _BYTE.pack(TAG_FLOAT) + _FLOAT.pack(value)
+    data = str(value).encode()
+    return _BYTE.pack(TAG_STR) + _LENGTH.pack(len(data)) + data
+
+
+def save_snapshot(path, records):
+    """Запись снимка кэша контролов. Файл заменяется атомарно.
+
+    Args:
+        path (string): Путь к файлу снимка
+        records (list): Записи (путь к контролу, тип контрола или None, значение, время получения)
+
+    Returns:
+        int: Количество записанных контролов
+    """
+
+    chunks = []
+    for control_path, control_type, value, timestamp in records:
+        path_data = control_path.encode()
+        type_data = (control_type or "").encode()[:255]
+        chunks.append(_PATH.pack(len(path_data)))
+        chunks.append(path_data)
+        chunks.append(_BYTE.pack(len(type_data)))
+        chunks.append(type_data)
+        chunks.append(_encode_value(value))
+        chunks.append(_FLOAT.pack(timestamp))
+
+    temp_path = "%s.tmp" % path
+    with open(temp_path, "wb") as file:
+        file.write(_HEADER.pack(MAGIC, VERSION, len(records)))
+        file.write(b"".join(chunks))
+    os.replace(temp_path, path)
+
+    return len(records)
+
+
+def load_snapshot(path):
+    """Чтение снимка кэша контролов
+
+    Args:
+        path (string): Путь к файлу снимка
+
+    Returns:
+        list: Записи (путь к контролу, тип контрола или None, значение, время получения).
+            Пустой список, если файла нет или он повреждён.
+    """
+
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except OSError:
+        return []
+
+    try:
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            return []
+
+        records = []
+        offset = _HEADER.size
+        for _ in range(count):
+            (length,) = _PATH.unpack_from(data, offset)
+            offset += _PATH.size
+            control_path = data[offset : offset + length].decode()
+            offset += length
+
+            (length,) = _BYTE.unpack_from(data, offset)
+            offset += _BYTE.size
+            control_type = data[offset : offset + length].decode() or None
+            offset += length
+
+            (tag,) = _BYTE.unpack_from(data, offset)
+            offset += _BYTE.size
+            if tag == TAG_INT:
+                (value,) = _INT.unpack_from(data, offset)
+                offset += _INT.size
+            elif tag == TAG_FLOAT:
+                (value,) = _FLOAT.unpack_from(data, offset)
+                offset += _FLOAT.size
+            elif tag == TAG_STR:
+                (length,) = _LENGTH.unpack_from(data, offset)
+                offset += _LENGTH.size
+                value = data[offset : offset + length].decode()
+                offset += length
+            else:
+                value = None
+
+            (timestamp,) = _FLOAT.unpack_from(data, offset)
+            offset += _FLOAT.size
+
+            records.append((control_path, control_type, value, timestamp))
+    except (struct.error, UnicodeDecodeError):
+        print("Snapshot %s is damaged and will be ignored." % (path))
+        return []
+
+    return records
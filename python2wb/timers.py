@@ -0,0 +1,170 @@
+import datetime
+
+# Поля cron-выражения: (имя, минимум, максимум)
+_CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7),
+)
+
+# Псевдонимы выражений
+_CRON_ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+# Поиск следующего срабатывания ограничен, чтобы выражения вроде '0 0 30 2 *' не зацикливались
+_CRON_SEARCH_YEARS = 5
+
+
+def _parse_cron_field(text, name, low, high):
+    """Значения поля cron: '*', '5', '1-5', '*/15', '0-30/10' и их списки через запятую
+
+    Returns:
+        frozenset: Допустимые значения
+
+    Raises:
+        ValueError: Поле не разобрано или значение вне диапазона
+    """
+
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError("Invalid step in cron %s field: %s" % (name, text))
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(item) for item in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(
+                "Cron %s field out of range %d-%d: %s" % (name, low, high, text)
+            )
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    """Расписание в формате cron из пяти полей: минута, час, день месяца, месяц,
+    день недели (0 и 7 — воскресенье). Если заданы и день месяца, и день недели,
+    достаточно совпадения одного из них, как в cron.
+
+    Args:
+        expression (string): Выражение, например '*/5 * * * *', '30 7 * * 1-5' или '@daily'
+
+    Raises:
+        ValueError: Выражение не разобрано
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = _CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(_CRON_FIELDS):
+            raise ValueError(
+                "Cron expression must have %d fields: %s"
+                % (len(_CRON_FIELDS), expression)
+            )
+
+        try:
+            parsed = [
+                _parse_cron_field(text, name, low, high)
+                for text, (name, low, high) in zip(fields, _CRON_FIELDS)
+            ]
+        except ValueError as e:
+            raise ValueError("Invalid cron expression %r: %s" % (expression, e))
+
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        # В cron воскресенье — 0 или 7, в datetime.weekday() понедельник — 0
+        self.weekdays = frozenset((day - 1) % 7 for day in weekdays)
+        # Как в cron, поле, начинающееся с '*' (в том числе '*/2'), не ограничивает
+        # день: тогда должны совпасть оба поля, иначе достаточно одного из них
+        self._either_day = not (fields[2].startswith("*") or fields[4].startswith("*"))
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = moment.weekday() in self.weekdays
+        if self._either_day:
+            return day or weekday
+        return day and weekday
+
+    def next_after(self, moment):
+        """Ближайшее время срабатывания строго после moment
+
+        Args:
+            moment (datetime): Текущее локальное время
+
+        Returns:
+            datetime: Время срабатывания с точностью до минуты
+
+        Raises:
+            ValueError: Расписание не срабатывает в ближайшие годы, например 30 февраля
+        """
+
+        moment = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment.year + _CRON_SEARCH_YEARS
+
+        while moment.year <= limit:
+            if moment.month not in self.months:
+                if moment.month == 12:
+                    moment = moment.replace(year=moment.year + 1, month=1, day=1)
+                else:
+                    moment = moment.replace(month=moment.month + 1, day=1)
+                moment = moment.replace(hour=0, minute=0)
+                continue
+            if not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            if moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            if moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+                continue
+            return moment
+
+        raise ValueError("Cron expression never matches: %s" % (self.expression))
+
+    def __repr__(self):
+        return "CronSchedule(%r)" % (self.expression)
+
+
+class TimerHandle:
+    """Таймер every(), cron(), debounce() и throttle(). cancel() отменяет следующие вызовы.
+
+    Attributes:
+        calls (int): Количество вызовов обработчика
+        cancelled (bool): Таймер отменён
+    """
+
+    __slots__ = ("timer", "calls", "cancelled", "_on_cancel")
+
+    def __init__(self, on_cancel=None):
+        self.timer = None
+        self.calls = 0
+        self.cancelled = False
+        self._on_cancel = on_cancel
+
+    def cancel(self):
+        """Отмена таймера"""
+
+        self.cancelled = True
+        timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        on_cancel = self._on_cancel
+        self._on_cancel = None
+        if on_cancel is not None:
+            on_cancel()
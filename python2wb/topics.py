@@ -0,0 +1,283 @@
+import threading
+
+
+def topic_covers(topic_filter, other_filter):
+    """Проверка, что фильтр topic_filter покрывает все топики, которые покрывает other_filter
+
+    Args:
+        topic_filter (string): MQTT-фильтр, например '/devices/+/controls/+'
+        other_filter (string): Проверяемый MQTT-фильтр
+
+    Returns:
+        bool: True, если любой топик, подходящий под other_filter, подходит и под topic_filter
+    """
+
+    levels = topic_filter.split("/")
+    other_levels = other_filter.split("/")
+
+    for index, level in enumerate(levels):
+        if level == "#":
+            return True
+        if index >= len(other_levels):
+            return False
+
+        other_level = other_levels[index]
+        if level == "+":
+            if other_level == "#":
+                return False
+        elif level != other_level:
+            return False
+
+    return len(levels) == len(other_levels)
+
+
+class _Node:
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        # Кортеж пар (ключ, обработчик). Пересобирается целиком при изменении,
+        # чтобы сетевой поток мог читать его без блокировки.
+        self.handlers = ()
+
+
+class TopicTrie:
+    """Префиксное дерево MQTT-фильтров с поддержкой '+' и '#'.
+
+    Одному фильтру можно назначить несколько обработчиков с разными ключами,
+    повторная регистрация с тем же ключом заменяет обработчик, как message_callback_add в paho.
+    Результат сопоставления кэшируется по топику и сбрасывается при изменении дерева.
+    Одинаковые результаты разных топиков хранятся одним кортежем.
+    """
+
+    cache_limit = 65536
+
+    def __init__(self):
+        self._root = _Node()
+        self._cache = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter, handler, key=None):
+        """Добавление обработчика для фильтра
+
+        Args:
+            topic_filter (string): MQTT-фильтр
+            handler (function): Обработчик
+            key (object, optional): Ключ обработчика внутри фильтра
+
+        Returns:
+            bool: True, если для фильтра с этим ключом обработчика ещё не было
+        """
+
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                child = node.children.get(level)
+                if child is None:
+                    child = _Node()
+                    node.children[level] = child
+                node = child
+
+            handlers = [item for item in node.handlers if item[0] != key]
+            is_new = len(handlers) == len(node.handlers)
+            handlers.append((key, handler))
+            node.handlers = tuple(handlers)
+            self._cache = {}
+            self._results = {}
+
+        return is_new
+
+    def remove(self, topic_filter, key=None):
+        """Удаление обработчика фильтра
+
+        Args:
+            topic_filter (string): MQTT-фильтр
+            key (object, optional): Ключ обработчика внутри фильтра
+
+        Returns:
+            bool: True, если обработчик был найден и удалён
+        """
+
+        with self._lock:
+            path = [self._root]
+            levels = topic_filter.split("/")
+            for level in levels:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+
+            node = path[-1]
+            handlers = tuple(item for item in node.handlers if item[0] != key)
+            if len(handlers) == len(node.handlers):
+                return False
+            node.handlers = handlers
+
+            # Убираем опустевшие ветки
+            for index in range(len(levels), 0, -1):
+                node = path[index]
+                if node.handlers or node.children:
+                    break
+                del path[index - 1].children[levels[index - 1]]
+
+            self._cache = {}
+            self._results = {}
+
+        return True
+
+    def get(self, topic_filter, key=None):
+        """Получение обработчика фильтра по ключу
+
+        Returns:
+            function: Обработчик или None
+        """
+
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.get(level)
+            if node is None:
+                return None
+
+        for item_key, handler in node.handlers:
+            if item_key == key:
+                return handler
+        return None
+
+    def match(self, topic):
+        """Поиск всех обработчиков, фильтры которых подходят под топик
+
+        Args:
+            topic (string): Топик пришедшего сообщения
+
+        Returns:
+            tuple: Обработчики в порядке от более общих фильтров к более точным
+        """
+
+        cache = self._cache
+        results = self._results
+        handlers = cache.get(topic)
+        if handlers is not None:
+            return handlers
+
+        result = []
+        levels = topic.split("/")
+        nodes = [self._root]
+        # По стандарту MQTT топики, начинающиеся с '$', не попадают под wildcard первого уровня
+        wildcards = not topic.startswith("$")
+
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if wildcards:
+                    child = children.get("#")
+                    if child is not None:
+                        result.extend(child.handlers)
+                    child = children.get("+")
+                    if child is not None:
+                        next_nodes.append(child)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            wildcards = True
+            nodes = next_nodes
+            if not nodes:
+                break
+
+        for node in nodes:
+            result.extend(node.handlers)
+            # 'a/#' подходит и для самого 'a'
+            child = node.children.get("#")
+            if child is not None:
+                result.extend(child.handlers)
+
+        handlers = tuple(handler for key, handler in result)
+        handlers = results.setdefault(handlers, handlers)
+        if len(cache) >= self.cache_limit:
+            cache.clear()
+        cache[topic] = handlers
+
+        return handlers
+
+
+class BrokerSubscriptions:
+    """Подсчёт ссылок на подписки у брокера.
+
+    Каждый фильтр учитывается отдельно, но у брокера подписываемся только на те,
+    которые не покрываются другим активным фильтром. Методы возвращают списки
+    фильтров, на которые нужно подписаться и от которых нужно отписаться.
+    """
+
+    def __init__(self):
+        self._refs = {}
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, topic_filter):
+        """Увеличение счётчика ссылок на фильтр
+
+        Returns:
+            tuple: (список фильтров для подписки, список фильтров для отписки)
+        """
+
+        with self._lock:
+            count = self._refs.get(topic_filter, 0)
+            self._refs[topic_filter] = count + 1
+            if count:
+                return [], []
+
+            for active in self._active:
+                if topic_covers(active, topic_filter):
+                    return [], []
+
+            covered = [f for f in self._active if topic_covers(topic_filter, f)]
+            self._active.difference_update(covered)
+            self._active.add(topic_filter)
+
+            return [topic_filter], covered
+
+    def release(self, topic_filter):
+        """Уменьшение счётчика ссылок на фильтр
+
+        Returns:
+            tuple: (список фильтров для подписки, список фильтров для отписки)
+        """
+
+        with self._lock:
+            count = self._refs.get(topic_filter, 0)
+            if count > 1:
+                self._refs[topic_filter] = count - 1
+                return [], []
+            if not count:
+                return [], []
+
+            del self._refs[topic_filter]
+            if topic_filter not in self._active:
+                return [], []
+            self._active.discard(topic_filter)
+
+            # Фильтры, которые раньше покрывались удалённым, снова нужны брокеру
+            orphans = [
+                f
+                for f in self._refs
+                if topic_covers(topic_filter, f)
+                and not any(topic_covers(a, f) for a in self._active)
+            ]
+            restored = [
+                f
+                for f in orphans
+                if not any(o != f and topic_covers(o, f) for o in orphans)
+            ]
+            self._active.update(restored)
+
+            return restored, [topic_filter]
+
+    def active(self):
+        """Список фильтров, на которые нужно быть подписанным у брокера"""
+
+        with self._lock:
+            return sorted(self._active)
+
+    def __contains__(self, topic_filter):
+        return topic_filter in self._refs
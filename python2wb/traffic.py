@@ -0,0 +1,330 @@
+import struct
+import threading
+import time
+
+from .metrics import Histogram
+
+# Формат журнала: последовательность записей, каждая начинается с байта типа.
+# Сеанс записи начинается с заголовка: MAGIC, версия и время начала (double).
+# Топик передаётся один раз записью TOPIC, дальше сообщения ссылаются на его номер.
+# Сообщение: смещение времени от предыдущей записи в микросекундах, номер топика,
+# длина payload и сам payload, целые числа — varint. Журнал можно дописывать
+# новыми сеансами и читать, пока он пишется.
+MAGIC = b"P2WB"
+VERSION = 1
+
+RECORD_SESSION = 0xFF
+RECORD_TOPIC = 0x00
+RECORD_MESSAGE = 0x01
+RECORD_RETAINED = 0x02
+
+_SESSION = struct.Struct("<4sBd")
+
+# Записанное сбрасывается на диск не реже, чем раз в FLUSH_INTERVAL секунд
+FLUSH_INTERVAL = 1.0
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+class TrafficRecorder:
+    """Запись входящих сообщений в компактный двоичный журнал.
+
+    Args:
+        path (string): Путь к файлу журнала, запись дописывается в конец
+        flush_interval (float, optional): Интервал сброса буфера на диск в секундах
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.messages = 0
+        self._flush_interval = flush_interval
+        self._file = open(path, "ab")
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._last = time.time()
+        self._flushed = time.monotonic()
+        self._file.write(
+            bytes((RECORD_SESSION,)) + _SESSION.pack(MAGIC, VERSION, self._last)
+        )
+
+    def write(self, topic, payload, retain=False, timestamp=None):
+        """Запись одного сообщения
+
+        Args:
+            topic (string): Топик
+            payload (bytes, string): Значение
+            retain (bool, optional): Retain-флаг
+            timestamp (float, optional): Время получения по time.time(). По умолчанию текущее.
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+        if type(payload) != bytes:
+            payload = str(payload).encode()
+
+        with self._lock:
+            file = self._file
+            if file is None:
+                return
+            topic_id = self._topics.get(topic)
+            if topic_id is None:
+                topic_id = self._topics[topic] = len(self._topics)
+                name = topic.encode()
+                file.write(
+                    bytes((RECORD_TOPIC,))
+                    + _varint(topic_id)
+                    + _varint(len(name))
+                    + name
+                )
+
+            delta = max(0, int(round((timestamp - self._last) * 1e6)))
+            self._last += delta / 1e6
+            file.write(
+                bytes((RECORD_RETAINED if retain else RECORD_MESSAGE,))
+                + _varint(delta)
+                + _varint(topic_id)
+                + _varint(len(payload))
+            )
+            file.write(payload)
+            self.messages += 1
+
+            now = time.monotonic()
+            if now - self._flushed >= self._flush_interval:
+                file.flush()
+                self._flushed = now
+
+    def on_message(self, client, userdata, msg):
+        """Запись сообщения paho, сигнатура обработчика on_message"""
+
+        self.write(msg.topic, msg.payload, msg.retain)
+
+    def flush(self):
+        """Сброс буфера на диск"""
+
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """Завершение записи"""
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class _Buffer:
+    """Внутреннее. Чтение файла блоками с разбором varint"""
+
+    def __init__(self, file, block=65536):
+        self._file = file
+        self._block = block
+        self.data = b""
+        self.position = 0
+
+    def need(self, count):
+        """Наличие count байт от текущей позиции, при нехватке дочитывается блок
+
+        Raises:
+            EOFError: Файл закончился
+        """
+
+        while len(self.data) - self.position < count:
+            chunk = self._file.read(max(self._block, count))
+            if not chunk:
+                raise EOFError
+            self.data = self.data[self.position :] + chunk
+            self.position = 0
+
+    def byte(self):
+        self.need(1)
+        value = self.data[self.position]
+        self.position += 1
+        return value
+
+    def take(self, count):
+        self.need(count)
+        start = self.position
+        self.position += count
+        return self.data[start : self.position]
+
+    def varint(self):
+        result = 0
+        shift = 0
+        while True:
+            byte = self.byte()
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+
+def read_traffic(path):
+    """Потоковое чтение журнала блоками. Незаконченная последняя запись, например
+        при чтении журнала, который ещё пишется, пропускается.
+
+    Args:
+        path (string): Путь к файлу журнала
+
+    Yields:
+        tuple: (время получения, топик, payload, retain)
+
+    Raises:
+        ValueError: Файл не является журналом python2wb
+    """
+
+    for timestamp, topic, payload, retain, _ in _read_records(path):
+        yield timestamp, topic, payload, retain
+
+
+def _read_records(path):
+    """Внутреннее. Чтение журнала с номером сеанса записи у каждого сообщения
+
+    Yields:
+        tuple: (время получения, топик, payload, retain, номер сеанса)
+    """
+
+    topics = {}
+    timestamp = None
+    session = -1
+
+    with open(path, "rb") as file:
+        buffer = _Buffer(file)
+        try:
+            while True:
+                kind = buffer.byte()
+
+                if kind == RECORD_SESSION:
+                    magic, version, timestamp = _SESSION.unpack(
+                        buffer.take(_SESSION.size)
+                    )
+                    if magic != MAGIC or version != VERSION:
+                        raise ValueError("Unsupported traffic log %s" % (path))
+                    topics = {}
+                    session += 1
+                elif timestamp is None:
+                    raise ValueError("Not a python2wb traffic log: %s" % (path))
+                elif kind == RECORD_TOPIC:
+                    topic_id = buffer.varint()
+                    topics[topic_id] = buffer.take(buffer.varint()).decode()
+                elif kind == RECORD_MESSAGE or kind == RECORD_RETAINED:
+                    delta = buffer.varint()
+                    topic_id = buffer.varint()
+                    payload = buffer.take(buffer.varint())
+                    timestamp += delta / 1e6
+                    yield (
+                        timestamp,
+                        topics[topic_id],
+                        payload,
+                        kind == RECORD_RETAINED,
+                        session,
+                    )
+                else:
+                    raise ValueError("Corrupted traffic log %s" % (path))
+        except EOFError:
+            return
+
+
+class ReplayMessage:
+    """Сообщение журнала с интерфейсом MQTTMessage paho"""
+
+    __slots__ = ("topic", "payload", "retain", "qos", "mid", "timestamp")
+
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.qos = 0
+        self.mid = 0
+        self.timestamp = 0.0
+
+
+def replay(wb, path, speed=1.0):
+    """Воспроизведение журнала через разбор входящих сообщений WbMqtt, как будто
+        сообщения пришли от брокера: обновляется кэш, вызываются подписки и правила.
+        Перерывы между сеансами записи не воспроизводятся: первое сообщение сеанса
+        идёт сразу за последним сообщением предыдущего. Счётчики обработчиков
+        в stats() сбрасываются в начале воспроизведения.
+
+    Args:
+        wb (WbMqtt): Клиент, например созданный с connect=False
+        path (string): Путь к файлу журнала
+        speed (float, optional): Скорость относительно записи: 1 — реальное время,
+            10 — в 10 раз быстрее, 0 или None — максимально быстро
+
+    Returns:
+        dict: messages, elapsed, recorded (длительность записи), msgs_per_sec,
+            dispatch — время разбора одного сообщения вместе с обработчиками,
+            вызванными в сетевом потоке, max_lag — наибольшее отставание от
+            расписания, callback_time — время обработчиков из stats() за это
+            воспроизведение. Времена в секундах.
+    """
+
+    on_message = wb._on_message
+    client = wb.client
+    dispatch = Histogram()
+    clock = time.perf_counter
+    if wb._metrics is not None:
+        wb._metrics.reset_callbacks()
+
+    messages = 0
+    max_lag = 0.0
+    first = None
+    last = None
+    # Сумма перерывов между сеансами записи, они не воспроизводятся
+    skipped = 0.0
+    sessions = 0
+    session = None
+    started = clock()
+
+    for timestamp, topic, payload, retain, number in _read_records(path):
+        if first is None:
+            first = timestamp
+        elif number != session:
+            skipped += timestamp - last
+        if number != session:
+            session = number
+            sessions += 1
+        last = timestamp
+
+        if speed:
+            due = started + (timestamp - first - skipped) / speed
+            now = clock()
+            if due > now:
+                time.sleep(due - now)
+            else:
+                max_lag = max(max_lag, now - due)
+
+        msg = ReplayMessage(topic, payload, retain)
+        msg.timestamp = timestamp
+        begin = clock()
+        on_message(client, None, msg)
+        dispatch.observe(clock() - begin)
+        messages += 1
+
+    elapsed = clock() - started
+    result = {
+        "messages": messages,
+        "elapsed": elapsed,
+        "recorded": (last - first - skipped) if messages else 0.0,
+        "sessions": sessions,
+        "speed": speed or None,
+        "msgs_per_sec": messages / elapsed if elapsed > 0 else None,
+        "dispatch": dispatch.as_dict(),
+        "max_lag": max_lag,
+    }
+
+    stats = wb.stats()
+    if stats is not None:
+        result["callback_calls"] = stats["callback_calls"]
+        result["callback_errors"] = stats["callback_errors"]
+        result["callback_time"] = stats["callback_time"]
+    return result
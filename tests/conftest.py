@@ -0,0 +1,33 @@
+from unittest import mock
+
+import pytest
+
+import python2wb.mqtt
+from python2wb.mqtt import WbMqtt
+
+from benchmarks.fake_broker import FakeBroker
+
+
+@pytest.fixture
+def broker():
+    return FakeBroker()
+
+
+@pytest.fixture
+def make_wb(broker):
+    """Factory of clients connected to the in-process broker. The network loop is
+    not started: tests call wb.client.loop() to deliver queued messages.
+    """
+
+    clients = []
+
+    def make(**kwargs):
+        with mock.patch.object(python2wb.mqtt.mqtt, "Client", broker.client_factory()):
+            wb = WbMqtt("localhost", 1883, **kwargs)
+        wb.client.loop()
+        clients.append(wb)
+        return wb
+
+    yield make
+    for wb in clients:
+        wb.clear()
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import python2wb.mqtt
+from python2wb.aio import AsyncWbMqtt
+
+from benchmarks.fake_broker import FakeClient
+
+
+def _slow_client_factory(broker, delay, failures=0):
+    """Clients whose reconnect() blocks like a slow broker and fails `failures` times"""
+
+    attempts = []
+
+    class SlowClient(FakeClient):
+        def reconnect(self):
+            attempts.append(threading.current_thread())
+            time.sleep(delay)
+            if len(attempts) <= failures:
+                raise OSError("connection refused")
+            return FakeClient.reconnect(self)
+
+    def factory(*args, **kwargs):
+        return SlowClient(broker, *args, **kwargs)
+
+    return factory, attempts
+
+
+def test_connect_does_not_block_event_loop(broker):
+    factory, attempts = _slow_client_factory(broker, 0.3)
+
+    async def main():
+        with mock.patch.object(python2wb.mqtt.mqtt, "Client", factory):
+            wb = AsyncWbMqtt("localhost", 1883)
+        ticks = 0
+        started = time.monotonic()
+        while wb.client not in broker.clients and time.monotonic() - started < 2:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        wb.client.loop()
+        await wb.close()
+        return wb, ticks
+
+    wb, ticks = asyncio.run(main())
+    assert ticks >= 10
+    assert attempts and attempts[0] is not threading.main_thread()
+    assert wb.client.connected is False
+
+
+def test_failed_connect_is_retried(broker):
+    factory, attempts = _slow_client_factory(broker, 0, failures=2)
+
+    async def main():
+        with mock.patch.object(python2wb.mqtt.mqtt, "Client", factory):
+            wb = AsyncWbMqtt("localhost", 1883, reconnect_min_delay=0.01)
+        started = time.monotonic()
+        while wb.client not in broker.clients and time.monotonic() - started < 2:
+            await asyncio.sleep(0.01)
+        connected = wb.client in broker.clients
+        await wb.close()
+        return connected
+
+    assert asyncio.run(main())
+    assert len(attempts) == 3
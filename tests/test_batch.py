@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+
+def inject(broker, wb, values, control="a"):
+    for value in values:
+        broker.inject("/devices/dev/controls/%s" % (control), str(value))
+    wb.client.loop()
+
+
+def test_batch_is_delivered_by_size(make_wb, broker):
+    wb = make_wb()
+    batches = []
+    handle = wb.subscribe_batch("dev/+", batches.append, max_items=3, max_latency=60)
+
+    inject(broker, wb, range(7))
+    assert [[row[2] for row in batch] for batch in batches] == [[0, 1, 2], [3, 4, 5]]
+    device_id, control_id, value, timestamp = batches[0][0]
+    assert (device_id, control_id) == ("dev", "a")
+    assert timestamp > 0
+
+    # cancel() delivers the collected rest and removes the subscription
+    handle.cancel()
+    assert [row[2] for row in batches[-1]] == [6]
+    assert handle.calls == 3
+    inject(broker, wb, [7])
+    assert len(batches) == 3
+
+
+def test_batch_is_delivered_by_latency(make_wb, broker):
+    wb = make_wb()
+    delivered = threading.Event()
+    batches = []
+
+    def callback(batch):
+        batches.append(batch)
+        delivered.set()
+
+    wb.subscribe_batch("dev/a", callback, max_items=100, max_latency=0.05)
+    started = time.monotonic()
+    inject(broker, wb, [1, 2])
+    assert batches == []
+    assert delivered.wait(5)
+    assert time.monotonic() - started >= 0.05
+    assert [row[2] for row in batches[0]] == [1, 2]
+
+
+def test_columnar_batch(make_wb, broker):
+    wb = make_wb()
+    batches = []
+    wb.subscribe_batch(["dev/a", "dev/b"], batches.append, max_items=2, columnar=True)
+    broker.inject("/devices/dev/controls/a", "1")
+    broker.inject("/devices/dev/controls/b", "2")
+    wb.client.loop()
+
+    (batch,) = batches
+    assert batch["device_id"] == ["dev", "dev"]
+    assert batch["control_id"] == ["a", "b"]
+    assert batch["value"] == [1, 2]
+    assert len(batch["timestamp"]) == 2
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_batches_are_delivered_in_order(make_wb, broker, workers):
+    wb = make_wb(workers=workers)
+    wb.loop_start()
+    values = []
+    running = []
+    overlaps = []
+
+    def callback(batch):
+        running.append(batch)
+        if len(running) > 1:
+            overlaps.append(len(running))
+        time.sleep(0.002)
+        values.extend(row[2] for row in batch)
+        running.remove(batch)
+
+    # Small batches and a short latency: size and timer flushes interleave
+    handle = wb.subscribe_batch("dev/a", callback, max_items=5, max_latency=0.003)
+    for value in range(300):
+        broker.inject("/devices/dev/controls/a", str(value))
+        if value % 7 == 0:
+            time.sleep(0.004)
+    deadline = time.monotonic() + 5
+    while wb.get("dev/a") != 299 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    handle.cancel()
+    while len(values) < 300 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert values == list(range(300))
+    assert overlaps == []
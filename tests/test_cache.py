@@ -0,0 +1,32 @@
+import json
+
+from python2wb.cache import ControlCache
+
+
+def test_copy_is_a_snapshot():
+    cache = ControlCache()
+    cache.set_type("dev/temp", "temperature")
+    cache.update("dev/temp", "21.5")
+    cache.update("dev/name", "hall")
+
+    copy = cache.copy()
+    assert type(copy) == dict
+    assert copy == {"dev/temp": 21.5, "dev/name": "hall"}
+
+    cache.update("dev/temp", "22")
+    cache.pop("dev/name")
+    assert copy == {"dev/temp": 21.5, "dev/name": "hall"}
+
+
+def test_get_all_returns_dict(make_wb, broker):
+    broker.inject("/devices/dev/controls/temp/meta/type", "temperature", retain=True)
+    broker.inject("/devices/dev/controls/temp", "21.5", retain=True)
+    wb = make_wb()
+
+    controls = wb.get_all()
+    assert json.loads(json.dumps(controls)) == {"dev/temp": 21.5}
+
+    broker.inject("/devices/dev/controls/temp", "23", retain=True)
+    wb.client.loop()
+    assert wb.get_all() == {"dev/temp": 23.0}
+    assert controls == {"dev/temp": 21.5}
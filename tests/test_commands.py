@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+
+from python2wb.commands import Command, CommandError, CommandTracker
+
+
+def echo_device(broker, reply=None):
+    """The device confirms every command: the value of /on comes back in the state topic"""
+
+    publish = broker.publish
+
+    def device(topic, payload, retain):
+        publish(topic, payload, retain)
+        if topic.endswith("/on"):
+            publish(topic[: -len("/on")], payload if reply is None else reply, True)
+
+    broker.publish = device
+
+
+def test_tracker_confirms_matching_value():
+    tracker = CommandTracker()
+    notified = []
+    command = Command("dev/a", 5, 0, lambda: notified.append(1))
+    assert tracker.add(command)
+    assert not tracker.add(Command("dev/a", 7, 0, lambda: None))
+
+    # An intermediate value does not finish the command
+    assert not tracker.confirm("dev/a", 4)
+    assert not command.done
+    assert not tracker.confirm("dev/a", 5)
+    assert command.done and command.value == 5
+    assert notified == [1]
+    assert len(tracker) == 1
+    assert tracker.stats()["dev"]["confirmed"] == 1
+
+
+def test_tracker_tolerance():
+    tracker = CommandTracker()
+    command = Command("dev/a", 21.5, 0.1, lambda: None)
+    tracker.add(command)
+    assert not tracker.confirm("dev/a", 21.7)
+    assert tracker.confirm("dev/a", 21.55)
+    assert command.value == 21.55
+    # Strings are compared exactly
+    assert Command("dev/a", "on", 1, None).matches("on")
+    assert not Command("dev/a", "on", 1, None).matches("off")
+
+
+def test_tracker_fail_and_discard():
+    tracker = CommandTracker()
+    first = Command("dev/a", 1, 0, lambda: None)
+    second = Command("dev/b", 1, 0, lambda: None)
+    tracker.add(first)
+    tracker.add(second)
+
+    assert tracker.fail("dev/a", "w")
+    assert first.error == "w"
+    assert not tracker.fail("dev/a", "w")
+    assert not tracker.discard(first)
+
+    assert tracker.discard(second)
+    assert tracker.pending == {}
+    stats = tracker.stats()
+    assert stats["dev"]["errors"] == 1
+    assert stats["dev"]["timeouts"] == 1
+
+
+def test_set_and_confirm(make_wb, broker):
+    broker.inject("/devices/dev/controls/level/meta/type", "value", retain=True)
+    echo_device(broker)
+    wb = make_wb()
+    assert wb.set_and_confirm("dev/level", 42, timeout=1) == 42
+    assert wb.command_stats()["dev"]["confirmed"] == 1
+    assert wb._commands.pending == {}
+
+
+def test_set_and_confirm_tolerance(make_wb, broker):
+    broker.inject("/devices/dev/controls/level/meta/type", "value", retain=True)
+    # The device rounds the written value
+    echo_device(broker, reply=b"21.5")
+    wb = make_wb()
+    with pytest.raises(TimeoutError):
+        wb.set_and_confirm("dev/level", 21.47, timeout=0.1)
+    assert wb.set_and_confirm("dev/level", 21.47, timeout=1, tolerance=0.05) == 21.5
+
+
+def test_set_and_confirm_error(make_wb, broker):
+    wb = make_wb()
+    publish = broker.publish
+
+    def device(topic, payload, retain):
+        publish(topic, payload, retain)
+        if topic == "/devices/dev/controls/relay/on":
+            publish("/devices/dev/controls/relay/meta/error", b"w", False)
+
+    broker.publish = device
+    with pytest.raises(CommandError) as info:
+        wb.set_and_confirm("dev/relay", 1, timeout=1)
+    assert info.value.control_path == "dev/relay"
+    assert info.value.error == "w"
+    assert wb.command_stats()["dev"]["errors"] == 1
+
+
+def test_retained_error_is_ignored(make_wb, broker):
+    # The error of a previous command is still retained. In targeted mode the
+    # broker sends it again when the command subscribes to /meta/error.
+    broker.inject("/devices/dev/controls/relay/meta/error", "w", retain=True)
+    echo_device(broker)
+    wb = make_wb(base_subscribe_topic=None)
+    assert wb.set_and_confirm("dev/relay", 1, timeout=1) == 1
+
+
+def test_set_and_confirm_timeout(make_wb, broker):
+    wb = make_wb()
+    with pytest.raises(TimeoutError):
+        wb.set_and_confirm("dev/relay", 1, timeout=0.1)
+    assert wb.command_stats()["dev"]["timeouts"] == 1
+    # The route to /meta/error is removed with the last command
+    assert wb._commands.pending == {}
+    assert not wb._routes.match("/devices/dev/controls/relay/meta/error")
+
+
+def test_set_and_confirm_refused_on_network_thread(make_wb, broker):
+    echo_device(broker)
+    wb = make_wb()
+    wb.loop_start()
+    errors = []
+    done = threading.Event()
+
+    def callback(topic, value):
+        try:
+            wb.set_and_confirm("dev/relay", 1, timeout=5)
+        except RuntimeError as e:
+            errors.append(e)
+        done.set()
+
+    wb.subscribe_raw("/trigger", callback)
+    wb.publish_raw("/trigger", 1)
+    assert done.wait(2)
+    assert len(errors) == 1
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from python2wb.executor import CallbackExecutor
+
+
+def _blocked(executor, key="dev"):
+    """Occupies the worker of key until the returned event is set"""
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        started.set()
+        release.wait(5)
+
+    executor.submit(key, hold, ())
+    assert started.wait(5)
+    return release
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        CallbackExecutor(1, 10, "latest")
+
+
+def test_order_is_kept_per_key():
+    executor = CallbackExecutor(4, 1000)
+    results = {}
+    lock = threading.Lock()
+
+    def record(key, value):
+        with lock:
+            results.setdefault(key, []).append(value)
+
+    for value in range(200):
+        for key in ("a", "b", "c"):
+            executor.submit(key, record, (key, value))
+    executor.shutdown()
+
+    assert results == {key: list(range(200)) for key in ("a", "b", "c")}
+
+
+def test_drop_oldest():
+    executor = CallbackExecutor(1, 3, "drop_oldest")
+    release = _blocked(executor)
+    results = []
+    for value in range(5):
+        executor.submit("dev", results.append, (value,))
+
+    assert executor.qsize() == 3
+    assert executor.dropped == 2
+    release.set()
+    executor.shutdown()
+    assert results == [2, 3, 4]
+
+
+def test_coalesce_replaces_pending_value():
+    executor = CallbackExecutor(1, 3, "coalesce")
+    release = _blocked(executor)
+    results = []
+    for value in range(5):
+        executor.submit("dev", results.append, ("a%d" % value,), "dev/a")
+    executor.submit("dev", results.append, ("b",), "dev/b")
+
+    assert executor.qsize() == 2
+    assert executor.coalesced == 4
+    release.set()
+    executor.shutdown()
+    assert results == ["a4", "b"]
+
+
+def test_coalesce_drops_oldest_without_pending_control():
+    executor = CallbackExecutor(1, 2, "coalesce")
+    release = _blocked(executor)
+    results = []
+    for name in ("a", "b", "c"):
+        executor.submit("dev", results.append, (name,), "dev/" + name)
+
+    assert executor.dropped == 1
+    release.set()
+    executor.shutdown()
+    assert results == ["b", "c"]
+
+
+def test_block_waits_for_free_space():
+    executor = CallbackExecutor(1, 2, "block")
+    release = _blocked(executor)
+    results = []
+    executor.submit("dev", results.append, (1,))
+    executor.submit("dev", results.append, (2,))
+
+    submitted = threading.Event()
+
+    def submit():
+        executor.submit("dev", results.append, (3,))
+        submitted.set()
+
+    thread = threading.Thread(target=submit)
+    thread.start()
+    time.sleep(0.05)
+    assert not submitted.is_set()
+
+    release.set()
+    assert submitted.wait(5)
+    thread.join()
+    executor.shutdown()
+    assert results == [1, 2, 3]
+    assert executor.dropped == 0
+
+
+def test_callback_errors_do_not_stop_worker(capsys):
+    executor = CallbackExecutor(1, 10)
+    results = []
+    executor.submit("dev", lambda: 1 / 0, ())
+    executor.submit("dev", results.append, (1,))
+    executor.shutdown()
+
+    assert results == [1]
+    assert "ZeroDivisionError" in capsys.readouterr().err
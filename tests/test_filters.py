@@ -0,0 +1,137 @@
+import threading
+import time
+
+from python2wb.filters import ACCEPT, REJECT, ChangeFilter, parse_deadband
+
+
+def test_parse_deadband():
+    assert parse_deadband(None) == (0, 0)
+    assert parse_deadband(0.5) == (0.5, 0)
+    assert parse_deadband("0.5") == (0.5, 0)
+    assert parse_deadband(" 2% ") == (0, 0.02)
+
+
+def test_without_on_change_every_value_passes():
+    change_filter = ChangeFilter()
+    assert change_filter.check("dev/a", 1, 0) == ACCEPT
+    assert change_filter.check("dev/a", 1, 1) == ACCEPT
+
+
+def test_on_change_rejects_repeats():
+    change_filter = ChangeFilter(on_change=True)
+    assert change_filter.check("dev/a", 1, 0) == ACCEPT
+    assert change_filter.check("dev/a", 1, 1) == REJECT
+    assert change_filter.check("dev/a", 2, 2) == ACCEPT
+    # Controls are compared separately
+    assert change_filter.check("dev/b", 2, 2) == ACCEPT
+    # 1 and 1.0 are different values
+    assert change_filter.check("dev/a", 2.0, 3) == ACCEPT
+
+
+def test_absolute_deadband_compares_with_last_delivered():
+    change_filter = ChangeFilter(deadband=0.5)
+    assert change_filter.on_change
+    assert change_filter.check("dev/t", 20.0, 0) == ACCEPT
+    assert change_filter.check("dev/t", 20.3, 1) == REJECT
+    # Slow drift is delivered once it leaves the band around the delivered value
+    assert change_filter.check("dev/t", 20.4, 2) == REJECT
+    assert change_filter.check("dev/t", 20.5, 3) == ACCEPT
+    assert change_filter.check("dev/t", 20.1, 4) == REJECT
+    assert change_filter.check("dev/t", 19.9, 5) == ACCEPT
+
+
+def test_relative_deadband():
+    change_filter = ChangeFilter(deadband="10%")
+    assert change_filter.check("dev/p", 100, 0) == ACCEPT
+    assert change_filter.check("dev/p", 109, 1) == REJECT
+    assert change_filter.check("dev/p", 110, 2) == ACCEPT
+
+
+def test_deadband_does_not_apply_to_text():
+    change_filter = ChangeFilter(deadband=1)
+    assert change_filter.check("dev/s", "on", 0) == ACCEPT
+    assert change_filter.check("dev/s", "on", 1) == REJECT
+    assert change_filter.check("dev/s", "off", 2) == ACCEPT
+
+
+def test_min_interval_defers_latest_value():
+    change_filter = ChangeFilter(min_interval=10)
+    assert change_filter.check("dev/a", 1, 0) == ACCEPT
+    # The first early value asks for a timer, later ones only replace the value
+    assert change_filter.check("dev/a", 2, 4) == 6
+    assert change_filter.check("dev/a", 3, 5) == REJECT
+    assert change_filter.take_pending("dev/a", 10) == (True, 3)
+    assert change_filter.take_pending("dev/a", 10) == (False, None)
+    # The interval counts from the deferred delivery
+    assert change_filter.check("dev/a", 4, 15) == 5
+    assert change_filter.take_pending("dev/a", 20) == (True, 4)
+    assert change_filter.check("dev/a", 5, 31) == ACCEPT
+
+
+def test_min_interval_with_on_change_drops_pending_repeat():
+    change_filter = ChangeFilter(on_change=True, min_interval=10)
+    assert change_filter.check("dev/a", 1, 0) == ACCEPT
+    assert change_filter.check("dev/a", 2, 1) == 9
+    # The value came back to the delivered one: nothing to deliver
+    assert change_filter.check("dev/a", 1, 2) == REJECT
+    assert change_filter.take_pending("dev/a", 10) == (False, None)
+
+
+def test_deferred_value_does_not_run_with_message_callbacks(make_wb, broker):
+    wb = make_wb()
+    wb.loop_start()
+    published = broker.published
+    delivered = threading.Event()
+    calls = []
+    running = []
+    overlaps = []
+
+    def slow(device_id, control_id, new_value):
+        running.append(control_id)
+        if len(running) > 1:
+            overlaps.append(list(running))
+        time.sleep(0.01)
+        running.remove(control_id)
+
+    def callback(device_id, control_id, new_value):
+        slow(device_id, control_id, new_value)
+        calls.append(new_value)
+        if new_value == 3:
+            delivered.set()
+
+    wb.subscribe("dev/a", callback, min_interval=0.05)
+    wb.subscribe("dev/b", slow)
+    for value in (1, 2, 3):
+        broker.inject("/devices/dev/controls/a", str(value))
+        time.sleep(0.005)
+    for value in range(20):
+        broker.inject("/devices/dev/controls/b", str(value))
+
+    assert delivered.wait(5)
+    assert calls == [1, 3]
+    assert overlaps == []
+    # Only the injected values went through the broker, nothing to wake a thread
+    assert broker.published == published + 23
+
+
+def test_calls_are_queued_while_another_runs(make_wb):
+    wb = make_wb()
+    order = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking():
+        order.append("first")
+        started.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=wb._call_deferred, args=(blocking,))
+    thread.start()
+    assert started.wait(5)
+    # The lock is busy: the call is queued and returns at once
+    wb._call_deferred(order.append, "second")
+    wb._call_deferred(order.append, "third")
+    assert order == ["first"]
+    release.set()
+    thread.join(5)
+    assert order == ["first", "second", "third"]
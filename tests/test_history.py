@@ -0,0 +1,144 @@
+import pytest
+
+from python2wb.history import History
+
+
+def reference_slope(points):
+    count = len(points)
+    mean_t = sum(t for t, v in points) / count
+    mean_v = sum(v for t, v in points) / count
+    numerator = sum((t - mean_t) * (v - mean_v) for t, v in points)
+    denominator = sum((t - mean_t) ** 2 for t, v in points)
+    return numerator / denominator
+
+
+def test_empty():
+    history = History(capacity=4)
+    assert len(history) == 0
+    assert history.mean() is None
+    assert history.min() is None
+    assert history.max() is None
+    assert history.slope() is None
+    assert history.count() == 0
+    assert history.last() is None
+    assert list(history.samples()) == []
+
+
+def test_non_numeric_values_are_skipped():
+    history = History(capacity=4)
+    assert not history.append(1.0, "text")
+    assert not history.append(1.0, None)
+    assert history.append(1.0, 5)
+    assert len(history) == 1
+
+
+def test_aggregates():
+    history = History(capacity=16)
+    points = [(100.0 + t, 2.0 * t + 1) for t in range(10)]
+    for t, v in points:
+        history.append(t, v)
+
+    assert history.count() == 10
+    assert history.mean() == pytest.approx(10.0)
+    assert history.min() == 1.0
+    assert history.max() == 19.0
+    assert history.slope() == pytest.approx(2.0)
+    assert history.last() == (109.0, 19.0)
+    assert list(history.samples()) == points
+
+
+def test_window():
+    history = History(capacity=16, window=3)
+    for t in range(10):
+        history.append(100.0 + t, t)
+
+    # The default window comes from the constructor
+    assert history.count(now=109.0) == 4
+    assert history.mean(now=109.0) == pytest.approx(7.5)
+    assert history.min(now=109.0) == 6
+    assert history.max(now=109.0) == 9
+    assert list(history.samples(now=109.0)) == [
+        (106.0, 6),
+        (107.0, 7),
+        (108.0, 8),
+        (109.0, 9),
+    ]
+    # An explicit window overrides it
+    assert history.count(window=100, now=109.0) == 10
+    # Nothing in the window
+    assert history.count(window=1, now=200.0) == 0
+    assert history.mean(window=1, now=200.0) is None
+    assert history.slope(window=1, now=109.0) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("capacity", [2, 3, 7, 16])
+def test_wraparound_matches_reference(capacity):
+    history = History(capacity=capacity)
+    points = []
+    # Several passes over the ring, including rebases of the running sums
+    for step in range(5 * capacity + 3):
+        t, v = 1000.0 + step * 0.5, float((step * 7) % 11) - 3
+        history.append(t, v)
+        points.append((t, v))
+        kept = points[-capacity:]
+
+        assert len(history) == len(kept)
+        assert list(history.samples()) == kept
+        assert history.last() == kept[-1]
+        assert history.mean() == pytest.approx(sum(v for t, v in kept) / len(kept))
+        assert history.min() == min(v for t, v in kept)
+        assert history.max() == max(v for t, v in kept)
+        if len(kept) >= 2:
+            assert history.slope() == pytest.approx(reference_slope(kept), abs=1e-9)
+
+        # A window that starts in the middle of the ring
+        now = kept[-1][0]
+        in_window = [(t, v) for t, v in kept if t >= now - 1.0]
+        assert history.count(window=1.0, now=now) == len(in_window)
+        assert history.min(window=1.0, now=now) == min(v for t, v in in_window)
+        assert history.max(window=1.0, now=now) == max(v for t, v in in_window)
+        assert history.mean(window=1.0, now=now) == pytest.approx(
+            sum(v for t, v in in_window) / len(in_window)
+        )
+
+
+def test_time_does_not_go_back():
+    history = History(capacity=4)
+    history.append(10.0, 1)
+    history.append(5.0, 2)
+    assert history.last() == (10.0, 2.0)
+
+
+def test_slope_needs_distinct_times():
+    history = History(capacity=4)
+    history.append(10.0, 1)
+    assert history.slope() is None
+    history.append(10.0, 2)
+    assert history.slope() is None
+
+
+def test_clear():
+    history = History(capacity=4)
+    for t in range(6):
+        history.append(float(t), t)
+    history.clear()
+    assert len(history) == 0
+    history.append(50.0, 3)
+    assert list(history.samples()) == [(50.0, 3.0)]
+    assert history.mean() == 3.0
+
+
+def test_track(make_wb, broker):
+    broker.inject("/devices/dev/controls/temp/meta/type", "value", retain=True)
+    wb = make_wb()
+    wb.track("dev/temp", capacity=4)
+    for value in range(6):
+        broker.inject("/devices/dev/controls/temp", str(value), retain=True)
+        wb.client.loop()
+
+    history = wb.history("dev/temp")
+    assert [value for timestamp, value in history.samples()] == [2, 3, 4, 5]
+    assert history.mean() == 3.5
+
+    wb.untrack("dev/temp")
+    assert wb.history("dev/temp") is None
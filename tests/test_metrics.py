@@ -0,0 +1,38 @@
+from python2wb.metrics import Metrics
+
+
+def make_closure(value):
+    def callback(*args):
+        return value
+
+    return callback
+
+
+def test_closures_share_stats_by_name():
+    metrics = Metrics()
+    for value in range(3 * Metrics.cache_limit):
+        callback = make_closure(value)
+        metrics.run(metrics.callback(callback), callback, ())
+
+    assert len(metrics.callbacks) == 1
+    assert len(metrics.by_callback) <= Metrics.cache_limit
+    stats = metrics.stats()
+    assert stats["callback_calls"] == 3 * Metrics.cache_limit
+    (summary,) = stats["callbacks"].values()
+    assert summary["calls"] == 3 * Metrics.cache_limit
+
+
+def test_metrics_disabled_by_default(make_wb):
+    assert make_wb().stats() is None
+    assert make_wb(metrics=True).stats()["messages_in"] == 0
+    assert make_wb(metrics_interval=10).stats() is not None
+
+
+def test_metrics_device_is_published(make_wb, broker):
+    wb = make_wb(metrics=True)
+    wb._publish_metrics()
+    wb.client.loop()
+
+    topic = "/devices/python2wb-metrics/controls/messages_out"
+    assert topic in broker.retained
+    assert wb.stats()["messages_out"] > 0
@@ -0,0 +1,223 @@
+import socket
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+import python2wb.mqtt
+from python2wb.multi import MultiWbMqtt
+
+from benchmarks.fake_broker import MQTT_ERR_SUCCESS, FakeBroker, FakeClient
+
+
+class SocketClient(FakeClient):
+    """FakeClient with a socket that the selector loop of MultiWbMqtt can serve:
+    one byte in the socket for every queued message, loop_read() handles one message
+    """
+
+    def __init__(self, broker, *args, **kwargs):
+        FakeClient.__init__(self, broker, *args, **kwargs)
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._open = False
+
+    def _notify(self, count=1):
+        self._writer.send(b"\0" * count)
+
+    def connect(self, *args, **kwargs):
+        self._open = True
+        rc = FakeClient.connect(self, *args, **kwargs)
+        self._notify()
+        return rc
+
+    def disconnect(self, *args, **kwargs):
+        self._open = False
+        return FakeClient.disconnect(self, *args, **kwargs)
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        queued = len(self._inbox)
+        result = FakeClient.subscribe(self, topic, qos, *args, **kwargs)
+        if len(self._inbox) > queued:
+            self._notify(len(self._inbox) - queued)
+        return result
+
+    def enqueue(self, message):
+        FakeClient.enqueue(self, message)
+        self._notify()
+
+    def loop_read(self, max_packets=1):
+        try:
+            self._reader.recv(1)
+        except BlockingIOError:
+            return MQTT_ERR_SUCCESS
+        item = self._inbox.popleft()
+        if type(item) == tuple:
+            self.connected = True
+            self.on_connect(self, None, {}, item[1])
+        else:
+            self.on_message(self, None, item)
+        return MQTT_ERR_SUCCESS
+
+    def socket(self):
+        return self._reader if self._open else None
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+@pytest.fixture
+def brokers():
+    return {"ctrl1": FakeBroker(), "ctrl2": FakeBroker()}
+
+
+@pytest.fixture
+def make_multi(brokers):
+    """Factory of MultiWbMqtt over one FakeBroker per controller. Without a running
+    loop the tests call serve() to deliver queued messages.
+    """
+
+    multis = []
+
+    def make(client_class=FakeClient, **kwargs):
+        fakes = iter(brokers.values())
+
+        def factory(*args, **kwargs):
+            return client_class(next(fakes), *args, **kwargs)
+
+        with mock.patch.object(python2wb.mqtt.mqtt, "Client", factory):
+            multi = MultiWbMqtt(
+                {name: ("localhost", 1883) for name in brokers}, **kwargs
+            )
+        multis.append(multi)
+        # The first connection is made by the connection thread
+        assert wait_for(
+            lambda: all(multi[name].client in brokers[name].clients for name in brokers)
+        )
+        return multi
+
+    yield make
+    for multi in multis:
+        multi.clear()
+
+
+def serve(multi):
+    for name in multi.names():
+        multi[name].client.loop()
+
+
+def test_namespaced_paths(make_multi, brokers):
+    brokers["ctrl1"].inject("/devices/dev/controls/a", "1", retain=True)
+    brokers["ctrl2"].inject("/devices/dev/controls/a", "2", retain=True)
+    multi = make_multi()
+    serve(multi)
+
+    assert multi.get("ctrl1:dev/a") == 1
+    assert multi.get("ctrl2:dev/a") == 2
+    assert multi.get_entry("ctrl2:dev/a").value == 2
+    with pytest.raises(ValueError, match="broker name"):
+        multi.get("dev/a")
+    with pytest.raises(ValueError, match="Unknown broker"):
+        multi.get("ctrl3:dev/a")
+    with pytest.raises(ValueError):
+        MultiWbMqtt({"bad:name": ("localhost", 1883)})
+
+    received = []
+    multi.subscribe_raw(
+        "ctrl2:/devices/dev/controls/a/on", lambda topic, value: received.append(topic)
+    )
+    multi.set("ctrl2:dev/a", 5)
+    serve(multi)
+    # Only the named broker gets the command, the callback gets the topic with its name
+    assert received == ["ctrl2:/devices/dev/controls/a/on"]
+    assert "/devices/dev/controls/a/on" not in brokers["ctrl1"].retained
+
+
+def test_subscription_to_all_brokers(make_multi, brokers):
+    multi = make_multi()
+    serve(multi)
+    values = []
+    multi.subscribe(
+        "dev/a",
+        lambda device_id, control_id, value: values.append(
+            (device_id, control_id, value)
+        ),
+    )
+    brokers["ctrl1"].inject("/devices/dev/controls/a", "1")
+    brokers["ctrl2"].inject("/devices/dev/controls/a", "2")
+    serve(multi)
+
+    # device_id comes with the broker name and can be passed to set() as is
+    assert values == [("ctrl1:dev", "a", 1), ("ctrl2:dev", "a", 2)]
+
+
+def test_brokers_are_isolated(make_multi, brokers):
+    multi = make_multi()
+    serve(multi)
+    first, second = [], []
+    multi.subscribe(
+        "ctrl1:dev/+", lambda device_id, control_id, value: first.append(value)
+    )
+    multi.subscribe(
+        "*:dev/b", lambda device_id, control_id, value: second.append(value)
+    )
+
+    brokers["ctrl1"].inject("/devices/dev/controls/a", "1")
+    brokers["ctrl2"].inject("/devices/dev/controls/a", "2")
+    brokers["ctrl2"].inject("/devices/dev/controls/only2", "3")
+    serve(multi)
+
+    # Each broker has its own cache
+    assert multi["ctrl1"].get_all() == {"dev/a": 1}
+    assert multi["ctrl2"].get_all() == {"dev/a": 2, "dev/only2": 3}
+    assert first == [1]
+
+    # Unsubscribing on one broker keeps the subscription on the other one
+    multi.unsubscribe("ctrl1:dev/b")
+    brokers["ctrl1"].inject("/devices/dev/controls/b", "4")
+    brokers["ctrl2"].inject("/devices/dev/controls/b", "5")
+    serve(multi)
+    assert first == [1, 4]
+    assert second == [5]
+
+
+def test_overloaded_broker_is_paused(make_multi, brokers):
+    multi = make_multi(SocketClient, workers=2, max_pending=4)
+    multi.loop_start()
+    assert wait_for(lambda: all(multi[name]._connected for name in multi.names()))
+
+    release = threading.Event()
+    values = []
+
+    def slow(device_id, control_id, value):
+        release.wait(5)
+        values.append(value)
+
+    multi.subscribe("ctrl1:dev/a", slow)
+    for value in range(20):
+        brokers["ctrl1"].inject("/devices/dev/controls/a", str(value))
+
+    executor = multi["ctrl1"]._executor
+    assert wait_for(lambda: executor.paused)
+    # Reading stopped at the limit, the rest waits in the socket of the broker
+    time.sleep(0.05)
+    assert executor.pending <= 4
+    assert len(multi["ctrl1"].client._inbox) > 0
+    assert executor.stats()["pauses"] == 1
+
+    # The other broker is still served
+    brokers["ctrl2"].inject("/devices/dev/controls/b", "7")
+    assert wait_for(lambda: multi.get("ctrl2:dev/b") == 7)
+
+    # The queue drains, reading resumes and all values arrive in order
+    release.set()
+    assert wait_for(lambda: len(values) == 20)
+    assert values == list(range(20))
+    assert not executor.paused
+    multi.loop_stop()
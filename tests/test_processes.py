@@ -0,0 +1,115 @@
+import os
+import time
+
+
+def test_pool_is_started_before_network_thread(make_wb):
+    wb = make_wb(processes=1)
+    assert not wb._executor.stats()["started"]
+
+    # The paho network thread must not exist yet when the pool forks
+    threads = []
+    start = wb._executor.start
+
+    def start_and_record():
+        threads.append(wb.client._thread)
+        start()
+
+    wb._executor.start = start_and_record
+    wb.loop_start()
+    try:
+        assert threads == [None]
+        assert wb._executor.stats()["started"]
+    finally:
+        wb.loop_stop()
+
+
+def record_commands(broker):
+    """Values written to /on topics, in the order the broker receives them"""
+
+    commands = []
+    publish = broker.publish
+
+    def record(topic, payload, retain):
+        if topic.endswith("/on"):
+            commands.append((topic.split("/")[4], payload.decode()))
+        publish(topic, payload, retain)
+
+    broker.publish = record
+    return commands
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_set_in_worker_is_published_by_parent(make_wb, broker):
+    commands = record_commands(broker)
+    wb = make_wb(processes=2)
+    parent = os.getpid()
+
+    def callback(device_id, control_id, new_value):
+        # The worker sends the value to the parent, its pid shows where it ran
+        wb.set("out/%s" % (control_id), os.getpid())
+
+    wb.subscribe("dev/+", callback)
+    wb.loop_start()
+    try:
+        broker.inject("/devices/dev/controls/a", "1")
+        assert wait_for(lambda: len(commands) == 1)
+        ((control_id, pid),) = commands
+        assert control_id == "a"
+        assert int(pid) != parent
+    finally:
+        wb.loop_stop()
+
+
+def test_order_is_kept_within_a_device(make_wb, broker):
+    commands = record_commands(broker)
+    wb = make_wb(processes=3)
+
+    def callback(device_id, control_id, new_value):
+        wb.set("out/%s" % (device_id), new_value)
+
+    wb.subscribe("+/value", callback)
+    wb.loop_start()
+    try:
+        devices = ["dev%d" % (index) for index in range(6)]
+        for value in range(50):
+            for device_id in devices:
+                broker.inject("/devices/%s/controls/value" % (device_id), str(value))
+        assert wait_for(lambda: len(commands) == 50 * len(devices))
+        for device_id in devices:
+            values = [
+                int(value) for control_id, value in commands if control_id == device_id
+            ]
+            assert values == list(range(50))
+    finally:
+        wb.loop_stop()
+
+
+def test_worker_errors_are_counted(make_wb, broker, capfd):
+    commands = record_commands(broker)
+    wb = make_wb(processes=2, metrics=True)
+
+    def callback(device_id, control_id, new_value):
+        if new_value % 2:
+            raise ValueError("odd value %s" % (new_value))
+        wb.set("out/even", new_value)
+
+    wb.subscribe("dev/a", callback)
+    wb.loop_start()
+    try:
+        for value in range(10):
+            broker.inject("/devices/dev/controls/a", str(value))
+        assert wait_for(lambda: wb.stats()["executor"]["errors"] == 5)
+        assert wait_for(lambda: len(commands) == 5)
+        # The worker keeps running after an error
+        assert [int(value) for control_id, value in commands] == [0, 2, 4, 6, 8]
+    finally:
+        wb.loop_stop()
+    assert "odd value 1" in capfd.readouterr().err
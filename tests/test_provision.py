@@ -0,0 +1,94 @@
+import threading
+import time
+
+
+def _controls():
+    return [
+        {"name": "temperature", "title": "Temperature", "type": "value", "default": 0},
+        {"name": "enabled", "title": "Enabled", "type": "switch", "default": 1},
+    ]
+
+
+def test_retained_fetch_is_not_delivered_to_callbacks(make_wb, broker):
+    first = make_wb()
+    first.provision_virtual_device("vdev", "Device", _controls())
+    first.client.loop()
+    first.set("vdev/temperature", 21.5)
+    first.client.loop()
+
+    # The fetch filter repeats an active subscription, so the broker resends
+    # the retained messages the callback has already received
+    wb = make_wb(base_subscribe_topic=None)
+    received = []
+    wb.subscribe_raw("/devices/vdev/#", lambda topic, value: received.append(topic))
+    wb.client.loop()
+    initial = len(received)
+    assert initial
+
+    published = wb.provision_virtual_device("vdev", "Device", _controls())
+    wb.client.loop()
+
+    # Only the value is missing from the snapshot of the other client:
+    # everything else is unchanged and the current value is kept
+    assert published == 0
+    assert wb.get("vdev/temperature") == 21.5
+    assert len(received) == initial
+    assert "/devices/vdev/#" in wb.client.subscriptions
+
+
+def test_provision_refused_on_network_thread(make_wb):
+    wb = make_wb()
+    wb.loop_start()
+    errors = []
+    done = threading.Event()
+
+    def callback(topic, value):
+        try:
+            wb.provision_virtual_device("vdev", "Device", _controls())
+        except RuntimeError as e:
+            errors.append(e)
+        done.set()
+
+    wb.subscribe_raw("/trigger", callback)
+    wb.publish_raw("/trigger", 1)
+    assert done.wait(5)
+    assert len(errors) == 1
+
+
+def test_remove_on_network_thread_does_not_wait(make_wb):
+    wb = make_wb()
+    wb.provision_virtual_device("vdev", "Device", _controls(), diff=False)
+    wb.loop_start()
+    done = threading.Event()
+    elapsed = []
+
+    def callback(topic, value):
+        started = time.monotonic()
+        wb.remove_virtual_device("vdev")
+        elapsed.append(time.monotonic() - started)
+        done.set()
+
+    wb.subscribe_raw("/trigger", callback)
+    wb.publish_raw("/trigger", 1)
+    assert done.wait(5)
+    assert elapsed[0] < 1
+    assert "vdev" not in wb.virtual_devices
+
+
+def test_reconnect_republishes_raw_values(make_wb, broker):
+    wb = make_wb()
+    wb.create_virtual_device("vdev", "Device", _controls())
+    wb.set("vdev/temperature", "7")
+    wb.client.loop()
+    broker.inject("/devices/vdev/controls/enabled/on", "0")
+    wb.client.loop()
+    assert wb.get("vdev/temperature") == 7.0
+
+    # The broker lost its retained state and the client reconnects
+    broker.retained.clear()
+    wb._on_connected()
+    wb.client.loop()
+
+    assert broker.retained["/devices/vdev/controls/temperature"] == b"7"
+    assert broker.retained["/devices/vdev/controls/enabled"] == b"0"
+    assert "/devices/vdev/controls/temperature/meta" in broker.retained
@@ -0,0 +1,97 @@
+from python2wb.publisher import OfflineQueue, OutboundQueue, TokenBucket
+
+
+class Sink:
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, topic, payload, qos, retain):
+        self.sent.append((topic, payload))
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2, burst=2, now=100.0)
+    for _ in range(2):
+        assert bucket.delay(100.0) == 0
+        bucket.take()
+    assert bucket.delay(100.0) == 0.5
+    assert bucket.delay(100.5) == 0
+    # The bucket does not grow above its capacity
+    assert bucket.delay(1000.0) == 0
+    assert bucket.tokens == 2
+
+
+def test_coalescing_keeps_position_and_last_value():
+    sink = Sink()
+    queue = OutboundQueue(sink)
+    queue.offer("a", 1, 0, False)
+    queue.offer("b", 2, 0, False)
+    queue.offer("a", 3, 0, False)
+    assert len(queue) == 2
+    assert queue.coalesced == 1
+
+    assert queue.flush(now=0.0) is None
+    assert sink.sent == [("a", 3), ("b", 2)]
+    assert queue.sent == 2
+
+
+def test_global_rate_limit():
+    sink = Sink()
+    queue = OutboundQueue(sink, rate=2, burst=2)
+    now = queue._rate.stamp
+    for index in range(5):
+        queue.offer("t%d" % index, index, 0, False)
+
+    assert queue.flush(now=now) == 0.5
+    assert sink.sent == [("t0", 0), ("t1", 1)]
+    assert queue.flush(now=now + 0.5) == 0.5
+    assert sink.sent[2:] == [("t2", 2)]
+    assert queue.flush(now=now + 10) is None
+    assert len(sink.sent) == 5
+
+
+def test_device_rate_limit_does_not_block_other_devices():
+    sink = Sink()
+    queue = OutboundQueue(sink, device_rate=1)
+    queue.offer("/devices/a/controls/x", 1, 0, False, "a")
+    queue.offer("/devices/a/controls/y", 2, 0, False, "a")
+    queue.offer("/devices/b/controls/x", 3, 0, False, "b")
+
+    # The first message of every idle device is sent on the first flush
+    assert queue.flush(now=100.0) == 1.0
+    assert sink.sent == [("/devices/a/controls/x", 1), ("/devices/b/controls/x", 3)]
+    assert queue.flush(now=100.5) == 0.5
+    assert queue.flush(now=101.0) is None
+    assert sink.sent[2:] == [("/devices/a/controls/y", 2)]
+
+
+def test_new_device_bucket_uses_flush_time():
+    sink = Sink()
+    queue = OutboundQueue(sink, device_rate=0.5, burst=1)
+    queue.offer("topic", 1, 0, False, "dev")
+    # now is far in the past compared to time.monotonic()
+    assert queue.flush(now=1.0) is None
+    assert sink.sent == [("topic", 1)]
+
+
+def test_drain_ignores_limits():
+    sink = Sink()
+    queue = OutboundQueue(sink, rate=1, device_rate=1, burst=1)
+    for index in range(3):
+        queue.offer("t%d" % index, index, 1, True, "dev")
+    queue.drain()
+    assert sink.sent == [("t0", 0), ("t1", 1), ("t2", 2)]
+    assert len(queue) == 0
+    assert queue.flush() is None
+
+
+def test_offline_queue():
+    queue = OfflineQueue(2)
+    queue.offer("a", 1, 0, False)
+    queue.offer("b", 2, 0, False)
+    queue.offer("a", 3, 0, False)
+    queue.offer("c", 4, 1, True)
+    assert queue.coalesced == 1
+    assert queue.dropped == 1
+    assert queue.take() == [("a", 3, 0, False), ("c", 4, 1, True)]
+    assert len(queue) == 0
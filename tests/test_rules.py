@@ -0,0 +1,191 @@
+import time
+
+import pytest
+
+from python2wb.cache import ControlCache
+from python2wb.rules import Rule, RuleEngine
+
+
+class Harness:
+    """RuleEngine over a real control cache. Flushes run when the test calls run()."""
+
+    def __init__(self):
+        self.cache = ControlCache()
+        self.writes = []
+        self.scheduled = []
+        self.engine = RuleEngine(
+            self.cache.entry, self.write, self.cache.convert, self.scheduled.append
+        )
+
+    def write(self, path, value):
+        self.writes.append((path, value))
+
+    def receive(self, path, raw_value):
+        value = self.cache.update(path, raw_value).value
+        self.engine.changed(path, value)
+
+    def run(self):
+        published = 0
+        while self.scheduled:
+            published += self.scheduled.pop(0)()
+        return published
+
+
+def test_rule_waits_for_all_inputs():
+    harness = Harness()
+    harness.engine.add(Rule(lambda a, b: a + b, ["dev/a", "dev/b"], ["dev/sum"]))
+    assert harness.run() == 0
+
+    harness.receive("dev/a", "1")
+    harness.run()
+    assert harness.writes == []
+
+    harness.receive("dev/b", "2")
+    assert harness.run() == 1
+    assert harness.writes == [("dev/sum", 3)]
+
+
+def test_batch_publishes_last_value_once():
+    harness = Harness()
+    harness.engine.add(Rule(lambda a: a * 10, ["dev/a"], ["dev/out"]))
+    harness.run()
+    batches = harness.engine.stats()["batches"]
+
+    for raw in ("1", "2", "3"):
+        harness.receive("dev/a", raw)
+    # One flush is scheduled for the whole batch
+    assert len(harness.scheduled) == 1
+    harness.run()
+    assert harness.writes == [("dev/out", 30)]
+    assert harness.engine.stats()["batches"] == batches + 1
+
+
+def test_repeated_input_does_not_mark_rules():
+    harness = Harness()
+    calls = []
+    harness.engine.add(Rule(lambda a: calls.append(a), ["dev/a"], []))
+    harness.receive("dev/a", "1")
+    harness.run()
+    assert not harness.engine.changed("dev/a", 1)
+    assert harness.scheduled == []
+    assert calls == [1]
+
+
+def test_chain_is_evaluated_in_rank_order_in_one_pass():
+    harness = Harness()
+    order = []
+
+    def second(middle):
+        order.append("second")
+        return middle + 1
+
+    def first(a):
+        order.append("first")
+        return a * 2
+
+    # Added in reverse order: ranks decide the evaluation order
+    harness.engine.add(Rule(second, ["dev/middle"], ["dev/out"]))
+    harness.engine.add(Rule(first, ["dev/a"], ["dev/middle"]))
+    assert [rule.func for rule in harness.engine.rules()] == [first, second]
+
+    harness.receive("dev/a", "5")
+    assert harness.run() == 2
+    assert order == ["first", "second"]
+    assert harness.writes == [("dev/middle", 10), ("dev/out", 11)]
+
+
+def test_unchanged_output_is_not_published():
+    harness = Harness()
+    harness.engine.add(Rule(lambda a: a > 10, ["dev/a"], ["dev/alarm"]))
+    harness.receive("dev/a", "5")
+    harness.run()
+    # The echo of the published value comes back from the broker
+    harness.receive("dev/alarm", "False")
+    harness.run()
+    harness.receive("dev/a", "7")
+    harness.run()
+    assert harness.writes == [("dev/alarm", False)]
+
+
+def test_pending_output_is_used_before_echo():
+    harness = Harness()
+    harness.engine.add(Rule(lambda a: a, ["dev/a"], ["dev/copy"]))
+    harness.receive("dev/a", "1")
+    harness.run()
+    # The echo has not arrived yet, the same value is not published twice
+    harness.engine.add(Rule(lambda a: a, ["dev/a"], ["dev/copy"], name="again"))
+    harness.run()
+    assert harness.writes == [("dev/copy", 1)]
+
+
+def test_cycle_is_rejected():
+    harness = Harness()
+    harness.engine.add(Rule(lambda a: a, ["dev/a"], ["dev/b"], name="forward"))
+    with pytest.raises(ValueError, match="Rule cycle"):
+        harness.engine.add(Rule(lambda b: b, ["dev/b"], ["dev/a"], name="back"))
+    assert len(harness.engine.rules()) == 1
+
+
+def test_results():
+    rule = Rule(lambda: None, [], ["dev/x", "dev/y"], name="pair")
+    assert rule.results((1, None)) == [("dev/x", 1)]
+    assert sorted(rule.results({"dev/y": 2})) == [("dev/y", 2)]
+    with pytest.raises(ValueError):
+        rule.results((1, 2, 3))
+    with pytest.raises(ValueError):
+        rule.results({"dev/z": 1})
+
+
+def test_errors_are_counted_and_other_rules_run(capsys):
+    harness = Harness()
+
+    def broken(a):
+        raise RuntimeError("boom")
+
+    harness.engine.add(Rule(broken, ["dev/a"], ["dev/x"], name="broken"))
+    harness.engine.add(Rule(lambda a: a + 1, ["dev/a"], ["dev/y"]))
+    harness.receive("dev/a", "1")
+    harness.run()
+
+    assert harness.writes == [("dev/y", 2)]
+    stats = harness.engine.stats()
+    assert stats["by_rule"]["broken"] == {"calls": 1, "errors": 1}
+    assert "boom" in capsys.readouterr().err
+
+
+def test_remove():
+    harness = Harness()
+
+    def copy(a):
+        return a
+
+    harness.engine.add(Rule(copy, ["dev/a"], ["dev/b"]))
+    harness.run()
+    assert harness.engine.remove(copy) == 1
+    assert harness.engine.inputs == {}
+    harness.receive("dev/a", "1")
+    harness.run()
+    assert harness.writes == []
+
+
+def test_rule_decorator(make_wb, broker):
+    broker.inject("/devices/dev/controls/a", "2", retain=True)
+    wb = make_wb()
+    sent = []
+    wb.subscribe_raw(
+        "/devices/dev/controls/double/on", lambda topic, value: sent.append(value)
+    )
+
+    @wb.rule("dev/a", "dev/double")
+    def double(a):
+        return a * 2
+
+    deadline = time.monotonic() + 2
+    while not sent and time.monotonic() < deadline:
+        wb.client.loop()
+        time.sleep(0.01)
+    assert sent == [4]
+    assert wb.remove_rule(double) == 1
+
+    with pytest.raises(ValueError):
+        wb.rule("dev/+", "dev/x")
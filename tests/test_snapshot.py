@@ -0,0 +1,81 @@
+import struct
+
+from python2wb.snapshot import MAGIC, load_snapshot, save_snapshot
+
+RECORDS = [
+    ("wb-msw/temperature", "temperature", 21.5, 1700000000.25),
+    ("wb-gpio/A1_OUT", "switch", 1, 1700000001.0),
+    ("wb-gpio/big", None, -(2**63), 1700000002.0),
+    ("wb-mr6c/text", "text", "привет", 1700000003.0),
+    ("wb-mr6c/empty", "text", "", 1700000004.0),
+    ("wb-mr6c/none", None, None, 1700000005.0),
+]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "controls.snapshot")
+    assert save_snapshot(path, RECORDS) == len(RECORDS)
+    assert load_snapshot(path) == RECORDS
+    assert not (tmp_path / "controls.snapshot.tmp").exists()
+
+
+def test_values_out_of_int64_are_saved_as_text(tmp_path):
+    path = str(tmp_path / "controls.snapshot")
+    save_snapshot(path, [("dev/huge", None, 2**64, 0.0)])
+    assert load_snapshot(path) == [("dev/huge", None, str(2**64), 0.0)]
+
+
+def test_missing_file(tmp_path):
+    assert load_snapshot(str(tmp_path / "missing")) == []
+
+
+def test_wrong_magic_or_version(tmp_path):
+    path = tmp_path / "controls.snapshot"
+    save_snapshot(str(path), RECORDS)
+    data = path.read_bytes()
+
+    path.write_bytes(b"X" + data[1:])
+    assert load_snapshot(str(path)) == []
+
+    path.write_bytes(MAGIC + struct.pack("<B", 99) + data[len(MAGIC) + 1 :])
+    assert load_snapshot(str(path)) == []
+
+
+def test_truncated_file_is_ignored(tmp_path, capsys):
+    path = tmp_path / "controls.snapshot"
+    save_snapshot(str(path), RECORDS)
+    data = path.read_bytes()
+
+    for size in range(len(data)):
+        path.write_bytes(data[:size])
+        assert load_snapshot(str(path)) == []
+    assert "damaged" in capsys.readouterr().out
+
+
+def test_invalid_utf8_is_ignored(tmp_path):
+    path = tmp_path / "controls.snapshot"
+    save_snapshot(str(path), [("dev/a", None, "a", 0.0)])
+    data = bytearray(path.read_bytes())
+    # The first byte of the control path
+    data[len(MAGIC) + 5 + 2] = 0xFF
+    path.write_bytes(bytes(data))
+    assert load_snapshot(str(path)) == []
+
+
+def test_warm_start_marks_values_stale(make_wb, broker, tmp_path):
+    path = str(tmp_path / "controls.snapshot")
+    save_snapshot(path, [("dev/a", "value", 1.5, 100.0), ("dev/b", "text", "x", 100.0)])
+    broker.inject("/devices/dev/controls/b", "y", retain=True)
+
+    wb = make_wb(snapshot_path=path, snapshot_interval=0)
+
+    entry = wb.get_entry("dev/a")
+    assert entry.value == 1.5
+    assert entry.stale
+    # The broker confirmed dev/b after the start
+    assert wb.get("dev/b") == "y"
+    assert not wb.get_entry("dev/b").stale
+
+    assert wb.save_snapshot() == 2
+    assert wb.save_snapshot() == 0
+    assert sorted(load_snapshot(path))[1][2] == "y"
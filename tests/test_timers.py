@@ -0,0 +1,146 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from python2wb.timers import CronSchedule
+
+
+def at(text):
+    return datetime.datetime.strptime(text, "%Y-%m-%d %H:%M")
+
+
+def next_run(expression, moment):
+    return CronSchedule(expression).next_after(at(moment)).strftime("%Y-%m-%d %H:%M")
+
+
+def test_fields():
+    schedule = CronSchedule("0-30/10 8-10 1,15 */3 1-5")
+    assert schedule.minutes == {0, 10, 20, 30}
+    assert schedule.hours == {8, 9, 10}
+    assert schedule.days == {1, 15}
+    assert schedule.months == {1, 4, 7, 10}
+    # Monday to Friday in datetime.weekday() numbering
+    assert schedule.weekdays == {0, 1, 2, 3, 4}
+
+
+def test_step_from_single_value_runs_to_the_end():
+    assert CronSchedule("50/5 * * * *").minutes == {50, 55}
+
+
+def test_sunday_is_zero_and_seven():
+    assert CronSchedule("0 0 * * 0").weekdays == {6}
+    assert CronSchedule("0 0 * * 7").weekdays == {6}
+    assert CronSchedule("0 0 * * 5-7").weekdays == {4, 5, 6}
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "* * * *",
+        "* * * * * *",
+        "60 * * * *",
+        "* 24 * * *",
+        "* * 0 * *",
+        "* * * 13 *",
+        "* * * * 8",
+        "*/0 * * * *",
+        "5-1 * * * *",
+        "a * * * *",
+    ],
+)
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+@pytest.mark.parametrize(
+    "expression, moment, expected",
+    [
+        ("*/15 * * * *", "2026-03-10 12:07", "2026-03-10 12:15"),
+        # Strictly after the current minute
+        ("*/15 * * * *", "2026-03-10 12:15", "2026-03-10 12:30"),
+        ("*/15 * * * *", "2026-03-10 23:50", "2026-03-11 00:00"),
+        ("30 7 * * *", "2026-03-10 08:00", "2026-03-11 07:30"),
+        ("@hourly", "2026-03-10 08:00", "2026-03-10 09:00"),
+        ("@daily", "2026-12-31 12:00", "2027-01-01 00:00"),
+        ("@monthly", "2026-01-31 00:00", "2026-02-01 00:00"),
+        ("@yearly", "2026-03-10 08:00", "2027-01-01 00:00"),
+        # 2026-03-14 is a Saturday
+        ("30 7 * * 1-5", "2026-03-13 08:00", "2026-03-16 07:30"),
+        ("@weekly", "2026-03-10 08:00", "2026-03-15 00:00"),
+        ("0 0 29 2 *", "2026-03-01 00:00", "2028-02-29 00:00"),
+        ("0 12 31 * *", "2026-04-01 00:00", "2026-05-31 12:00"),
+    ],
+)
+def test_next_after(expression, moment, expected):
+    assert next_run(expression, moment) == expected
+
+
+def test_day_of_month_or_day_of_week():
+    # Both fields are restricted: either of them is enough, as in cron.
+    # 2026-03-10 is a Tuesday, the next Friday is the 13th, the 15th is a Sunday
+    schedule = "0 9 15 * 5"
+    assert next_run(schedule, "2026-03-10 10:00") == "2026-03-13 09:00"
+    assert next_run(schedule, "2026-03-13 10:00") == "2026-03-15 09:00"
+    assert next_run(schedule, "2026-03-15 10:00") == "2026-03-20 09:00"
+
+
+def test_only_restricted_day_field_is_used():
+    # With '*' in the day of week only the day of month counts, and vice versa
+    assert next_run("0 9 15 * *", "2026-03-10 10:00") == "2026-03-15 09:00"
+    assert next_run("0 9 * * 5", "2026-03-10 10:00") == "2026-03-13 09:00"
+
+
+def test_day_field_with_step_is_not_restricting():
+    # '*/2' in the day of month starts with '*': both fields must match.
+    # 2026-03-10 is a Tuesday, the 13th is an odd Friday, the 20th an even one
+    assert next_run("0 9 */2 * 5", "2026-03-10 10:00") == "2026-03-13 09:00"
+    assert next_run("0 9 */2 * 5", "2026-03-13 10:00") == "2026-03-27 09:00"
+    # The same for '*/2' in the day of week (Sunday, Tuesday, Thursday, Saturday):
+    # 2026-03-15 is a Sunday, the next 15th on one of these days is a Saturday
+    assert next_run("0 9 15 * */2", "2026-03-10 10:00") == "2026-03-15 09:00"
+    assert next_run("0 9 15 * */2", "2026-03-16 10:00") == "2026-08-15 09:00"
+
+
+def test_never_matches():
+    with pytest.raises(ValueError, match="never matches"):
+        CronSchedule("0 0 30 2 *").next_after(at("2026-03-10 10:00"))
+
+
+def test_timers_do_not_run_with_message_callbacks(make_wb, broker):
+    wb = make_wb()
+    wb.loop_start()
+    order = []
+    started = threading.Event()
+    release = threading.Event()
+    fired = threading.Event()
+
+    def on_value(device_id, control_id, new_value):
+        order.append("message")
+        started.set()
+        release.wait(5)
+        order.append("message done")
+
+    def on_timer(name):
+        order.append(name)
+        if name == "debounce":
+            fired.set()
+
+    wb.subscribe("dev/a", on_value)
+    wb.debounce(
+        "dev/b", 0.05, lambda device_id, control_id, value: on_timer("debounce")
+    )
+    broker.inject("/devices/dev/controls/b", "1")
+    broker.inject("/devices/dev/controls/a", "1")
+    assert started.wait(5)
+
+    # The timers are due while the message callback runs: they wait for it
+    wb.call_later(0, on_timer, "call_later")
+    time.sleep(0.2)
+    assert order == ["message"]
+    release.set()
+    assert fired.wait(5)
+    assert order[:2] == ["message", "message done"]
+    assert sorted(order[2:]) == ["call_later", "debounce"]
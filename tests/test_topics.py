@@ -0,0 +1,210 @@
+from python2wb.topics import BrokerSubscriptions, TopicTrie, topic_covers
+
+
+def test_topic_covers():
+    assert topic_covers("#", "/devices/a/controls/b")
+    assert topic_covers("/devices/+/controls/+", "/devices/a/controls/b")
+    assert topic_covers("/devices/#", "/devices/+/controls/+")
+    assert not topic_covers("/devices/+/controls/+", "/devices/a/controls/b/meta")
+    assert not topic_covers("/devices/+/controls/+", "/devices/#")
+    assert not topic_covers("/devices/a/controls/+", "/devices/+/controls/b")
+
+
+def test_trie_wildcards():
+    trie = TopicTrie()
+    trie.add("/devices/+/controls/+", "plus")
+    trie.add("/devices/#", "hash")
+    trie.add("/devices/a/controls/b", "exact")
+    trie.add("#", "all")
+
+    assert set(trie.match("/devices/a/controls/b")) == {"plus", "hash", "exact", "all"}
+    assert set(trie.match("/devices/x/controls/y")) == {"plus", "hash", "all"}
+    assert set(trie.match("/devices/x/controls/y/meta")) == {"hash", "all"}
+    # 'a/#' matches the parent level itself
+    assert set(trie.match("/devices")) == {"hash", "all"}
+    assert trie.match("/other") == ("all",)
+
+
+def test_trie_dollar_topics_skip_first_level_wildcards():
+    trie = TopicTrie()
+    trie.add("#", "all")
+    trie.add("+/broker/load", "plus")
+    trie.add("$SYS/#", "sys")
+
+    assert trie.match("$SYS/broker/load") == ("sys",)
+
+
+def test_trie_keys_replace_and_remove():
+    trie = TopicTrie()
+    assert trie.add("a/+", "first", "user")
+    assert not trie.add("a/+", "second", "user")
+    assert trie.add("a/+", "watch", "watch")
+    assert set(trie.match("a/b")) == {"second", "watch"}
+    assert trie.get("a/+", "user") == "second"
+
+    assert trie.remove("a/+", "user")
+    assert not trie.remove("a/+", "user")
+    assert trie.match("a/b") == ("watch",)
+    assert trie.remove("a/+", "watch")
+    assert trie.match("a/b") == ()
+    assert not trie.remove("a/b/c", "user")
+
+
+def test_trie_cache_is_reset_on_change():
+    trie = TopicTrie()
+    trie.add("a/b", "exact")
+    assert trie.match("a/b") == ("exact",)
+    trie.add("a/+", "plus")
+    assert set(trie.match("a/b")) == {"exact", "plus"}
+
+
+def test_broker_subscriptions_refcount():
+    subscriptions = BrokerSubscriptions()
+    assert subscriptions.acquire("a/b") == (["a/b"], [])
+    assert subscriptions.acquire("a/b") == ([], [])
+    assert subscriptions.release("a/b") == ([], [])
+    assert "a/b" in subscriptions
+    assert subscriptions.release("a/b") == ([], ["a/b"])
+    assert "a/b" not in subscriptions
+    assert subscriptions.release("a/b") == ([], [])
+    assert subscriptions.active() == []
+
+
+def test_broker_subscriptions_cover_and_restore():
+    subscriptions = BrokerSubscriptions()
+    subscriptions.acquire("a/b")
+    subscriptions.acquire("a/c/d")
+    # The wildcard replaces the filters it covers
+    subscribe, unsubscribe = subscriptions.acquire("a/#")
+    assert subscribe == ["a/#"]
+    assert sorted(unsubscribe) == ["a/b", "a/c/d"]
+    assert subscriptions.active() == ["a/#"]
+    # A covered filter does not reach the broker
+    assert subscriptions.acquire("a/+") == ([], [])
+
+    # Without the wildcard the most general remaining filters come back
+    subscribe, unsubscribe = subscriptions.release("a/#")
+    assert unsubscribe == ["a/#"]
+    assert sorted(subscribe) == ["a/+", "a/c/d"]
+    assert subscriptions.active() == ["a/+", "a/c/d"]
+
+    subscribe, unsubscribe = subscriptions.release("a/+")
+    assert sorted(subscribe) == ["a/b"]
+    assert unsubscribe == ["a/+"]
+
+
+def _subscriptions(wb):
+    return set(wb.client.subscriptions)
+
+
+def test_targeted_mode_subscribes_only_needed_controls(make_wb, broker):
+    broker.inject("/devices/dev/controls/a", "1", retain=True)
+    broker.inject("/devices/dev/controls/b", "2", retain=True)
+    broker.inject("/devices/other/controls/c", "3", retain=True)
+
+    wb = make_wb(base_subscribe_topic=None)
+    assert _subscriptions(wb) == set()
+
+    values = []
+    wb.subscribe("dev/a", lambda device, control, value: values.append(value))
+    wb.track("dev/b")
+    wb.client.loop()
+
+    assert _subscriptions(wb) == {
+        "/devices/dev/controls/a",
+        "/devices/dev/controls/a/meta",
+        "/devices/dev/controls/a/meta/type",
+        "/devices/dev/controls/b",
+        "/devices/dev/controls/b/meta",
+        "/devices/dev/controls/b/meta/type",
+    }
+    assert values == [1]
+    assert wb.get("dev/b") == 2
+    assert wb.history("dev/b").last() is not None
+    assert wb.get("other/c") is None
+
+    wb.unsubscribe("dev/a")
+    wb.untrack("dev/b")
+    assert _subscriptions(wb) == set()
+
+
+def test_targeted_mode_rules_subscribe_inputs_and_outputs(make_wb, broker):
+    broker.inject("/devices/dev/controls/in", "4", retain=True)
+    wb = make_wb(base_subscribe_topic=None)
+
+    def double(value):
+        return value * 2
+
+    wb.rule("dev/in", "dev/out")(double)
+    assert {topic for topic in _subscriptions(wb) if "/meta" not in topic} == {
+        "/devices/dev/controls/in",
+        "/devices/dev/controls/out",
+    }
+
+    assert wb.remove_rule(double) == 1
+    assert _subscriptions(wb) == set()
+
+
+def test_default_mode_keeps_single_subscription(make_wb):
+    wb = make_wb()
+    wb.subscribe("dev/a", lambda device, control, value: None)
+    assert wb.client.subscriptions == {"#"}
+
+
+def test_targeted_mode_reads_type_of_watched_controls(make_wb, broker):
+    broker.inject("/devices/dev/controls/code/meta/type", "text", retain=True)
+    broker.inject("/devices/dev/controls/code", "007", retain=True)
+    wb = make_wb(base_subscribe_topic=None)
+
+    wb.subscribe("dev/code", lambda device, control, value: None)
+    wb.client.loop()
+
+    assert wb.get("dev/code") == "007"
+
+
+def test_targeted_mode_watches_meta_on_first_query(make_wb, broker):
+    broker.inject("/devices/dev/meta", '{"driver": "wb-modbus"}', retain=True)
+    broker.inject(
+        "/devices/dev/controls/t/meta", '{"type": "temperature"}', retain=True
+    )
+    broker.inject("/devices/dev/controls/t", "21.5", retain=True)
+    wb = make_wb(base_subscribe_topic=None)
+    assert _subscriptions(wb) == set()
+
+    values = []
+    wb.subscribe(
+        {"driver": "wb-modbus", "type": "temperature"},
+        lambda device, control, value: values.append(value),
+    )
+    wb.client.loop()
+
+    assert _subscriptions(wb) == {
+        "/devices/+/meta",
+        "/devices/+/controls/+/meta",
+        "/devices/+/controls/+/meta/type",
+        # The control /meta topics are covered by the wildcards
+        "/devices/dev/controls/t",
+    }
+    assert wb.meta.device("dev").driver == "wb-modbus"
+    assert values == [21.5]
+
+
+def test_default_mode_reads_device_meta_on_first_query(make_wb, broker):
+    broker.inject("/devices/dev/meta", '{"driver": "wb-modbus"}', retain=True)
+    broker.inject(
+        "/devices/dev/controls/t/meta", '{"type": "temperature"}', retain=True
+    )
+    wb = make_wb()
+    received = []
+    wb.subscribe_raw("/devices/+/meta", lambda topic, value: received.append(topic))
+    wb.client.loop()
+
+    # Device /meta is not parsed until the index is used
+    assert wb.meta.devices == {}
+    assert wb.meta.query({"driver": "wb-modbus"}) == set()
+    wb.client.loop()
+
+    # The retained /meta is read again and is not passed to the subscription
+    assert wb.meta.query({"driver": "wb-modbus"}) == {"dev/t"}
+    assert received == []
+    assert wb.client.subscriptions == {"#", "/devices/+/meta"}
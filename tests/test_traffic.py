@@ -0,0 +1,63 @@
+import time
+
+from python2wb.mqtt import WbMqtt
+from python2wb.traffic import TrafficRecorder, read_traffic
+
+
+def _record(path, started, values):
+    """A recording session with messages every 10 ms from started,
+    which must not be earlier than the current time
+    """
+
+    recorder = TrafficRecorder(str(path))
+    for offset, value in enumerate(values):
+        recorder.write(
+            "/devices/dev/controls/a", str(value), timestamp=started + offset * 0.01
+        )
+    recorder.close()
+
+
+def test_read_traffic(tmp_path):
+    path = tmp_path / "traffic.p2wb"
+    started = time.time() + 1
+    _record(path, started, [1, 2])
+    _record(path, started + 1000, [3])
+
+    records = list(read_traffic(str(path)))
+    assert [(topic, payload) for _, topic, payload, _ in records] == [
+        ("/devices/dev/controls/a", b"1"),
+        ("/devices/dev/controls/a", b"2"),
+        ("/devices/dev/controls/a", b"3"),
+    ]
+    assert abs(records[1][0] - records[0][0] - 0.01) < 1e-5
+    assert abs(records[2][0] - started - 1000) < 1e-5
+
+
+def test_replay_skips_gaps_between_sessions(tmp_path):
+    path = tmp_path / "traffic.p2wb"
+    # The second session was recorded an hour later
+    started = time.time() + 1
+    _record(path, started, [1, 2])
+    _record(path, started + 3600, [3, 4])
+
+    wb = WbMqtt("localhost", 1883, connect=False)
+    report = wb.replay(str(path), speed=1)
+
+    assert report["messages"] == 4
+    assert report["sessions"] == 2
+    assert report["elapsed"] < 1
+    assert abs(report["recorded"] - 0.02) < 1e-3
+    assert wb.get("dev/a") == 4
+
+
+def test_replay_reports_callbacks_of_each_call(tmp_path):
+    path = tmp_path / "traffic.p2wb"
+    _record(path, time.time(), [1, 2, 3])
+
+    wb = WbMqtt("localhost", 1883, connect=False, metrics=True)
+    wb.subscribe("dev/a", lambda device, control, value: None)
+
+    for _ in range(2):
+        report = wb.replay(str(path), speed=0)
+        assert report["callback_calls"] == 3
+        assert report["callback_time"]["samples"] == 0